@@ -0,0 +1,83 @@
+'''
+Shared parts of the extraction benchmarks: a synthetic CT image with
+noise, a skull shaped shell and an 8x8 grid of contacts, and running each
+measurement in its own process so that the peak memory of one does not
+hide that of another.
+'''
+from __future__ import division
+import os
+import resource
+import subprocess
+import sys
+import numpy as np
+import nibabel as nib
+
+#the benchmarks import the extraction module directly, without the GUI
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'ielu'))
+
+def make_ct(shape=(256, 256, 200), skull_thickness=5.5, seed=0):
+    '''
+    Build the synthetic CT image.
+
+    Parameters
+    ----------
+    shape : 3-tuple(int)
+        The shape of the image
+    skull_thickness : float
+        The thickness of the shell in voxels. With the default shape, the
+        shell has about 0.9 million voxels above 1000.
+    seed : int
+        The seed of the noise
+
+    Returns
+    -------
+    image : 3D np.ndarray of int16
+        The image, with noise around 0, the shell at 1500 and the contacts
+        at 3000
+    '''
+    rng = np.random.RandomState(seed)
+    image = rng.normal(0, 20, shape).astype(np.int16)
+
+    center = (np.array(shape) - 1) / 2
+    radii = np.array(shape) * .45
+    x, y, z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    r = np.sqrt(((x - center[0]) / radii[0])**2 +
+        ((y - center[1]) / radii[1])**2 + ((z - center[2]) / radii[2])**2)
+    shell = np.abs(r - 1) * np.min(radii) < skull_thickness / 2
+    image[shell] = 1500
+    del r, shell
+
+    #an 8x8 grid of 3x3x3 contacts inside the shell, 5 voxels apart
+    for i in xrange(8):
+        for j in xrange(8):
+            cx = int(center[0]) - 18 + 5*i
+            cy = int(center[1]) - 18 + 5*j
+            cz = int(center[2] + radii[2] * .6)
+            image[cx-1:cx+2, cy-1:cy+2, cz-1:cz+2] = 3000
+
+    return image
+
+def save_ct(image, filename):
+    '''
+    Save the image with an identity affine.
+    '''
+    nib.save(nib.Nifti1Image(image, np.eye(4)), filename)
+    return filename
+
+def peak_rss_mb(children=False):
+    '''
+    The peak resident set size of this process, or of its largest waited
+    for child process, in MB.
+    '''
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    #ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def run_child(script, *args):
+    '''
+    Run script --child args in a new python process and return the words it
+    prints.
+    '''
+    return subprocess.check_output([sys.executable, os.path.abspath(script),
+        '--child'] + map(str, args)).split()
@@ -0,0 +1,74 @@
+'''
+Measure the peak memory of in-memory and slab streamed CT extraction.
+
+Each mode runs in its own process, and the increase of the peak resident
+set size over the process after its imports is reported, so the modes do
+not see each other's allocations. The threshold of 1000 keeps the whole
+skull shaped shell of the synthetic image, about 0.9 million voxels, as
+happens when a threshold preview is built down to bone intensities.
+
+Usage: python extraction_memory.py [slab_size ...]
+'''
+from __future__ import division
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from common import make_ct, save_ct, peak_rss_mb, run_child
+import extraction as ext
+
+THRESHOLD = 1000
+
+def extract_in_memory(filename):
+    #what identify_electrodes_in_ctspace does without slab_size
+    ctd = np.asarray(nib.load(filename).dataobj)
+    mask = ndimage.binary_erosion(ctd > THRESHOLD)
+    return ext.isolate_masked_components(mask, ctd)
+
+def extract_by_slabs(filename, slab_size):
+    coords, values, labels, nr_components, _, _ = ext.label_by_slabs(
+        nib.load(filename).dataobj, THRESHOLD, slab_size=slab_size)
+    return ext.isolate_sparse_components(coords, values, labels,
+        nr_components)
+
+def measure(filename, slab_size):
+    baseline = peak_rss_mb()
+    start = time.time()
+    if slab_size == 0:
+        centroids = extract_in_memory(filename)
+    else:
+        centroids = extract_by_slabs(filename, slab_size)
+    print '{0} {1:.1f} {2:.2f}'.format(len(centroids),
+        peak_rss_mb() - baseline, time.time() - start)
+
+def main(slab_sizes):
+    fd, filename = tempfile.mkstemp(suffix='.nii')
+    os.close(fd)
+    try:
+        image = make_ct()
+        print 'image {0}, {1:.0f} MB, {2} voxels above {3}'.format(
+            image.shape, image.nbytes / 2**20,
+            np.count_nonzero(image > THRESHOLD), THRESHOLD)
+        save_ct(image, filename)
+        del image
+
+        print '{0:>12} {1:>10} {2:>14} {3:>8}'.format('mode', 'centroids',
+            'peak MB', 'seconds')
+        for slab_size in [0] + slab_sizes:
+            nr, peak, seconds = run_child(__file__, filename, slab_size)
+            mode = 'in memory' if slab_size == 0 else 'slabs of {0}'.format(
+                slab_size)
+            print '{0:>12} {1:>10} {2:>14} {3:>8}'.format(mode, nr, peak,
+                seconds)
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(map(int, sys.argv[1:]) or [8, 32])
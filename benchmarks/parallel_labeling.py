@@ -0,0 +1,75 @@
+'''
+Compare the serial in-memory labeling of a CT image with
+isolate_components_in_parallel on a pool of workers.
+
+Each mode runs in its own process, which loads the image before the
+measurement starts, as identify_electrodes_in_ctspace does. The runtime is
+the best of three runs. The peak memory is the increase of the peak
+resident set size over the loaded process, for the process itself and
+for its largest worker. Worker memory shared with the parent by fork is
+counted in both.
+
+Usage: python parallel_labeling.py [nr_workers ...]
+'''
+from __future__ import division
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from common import make_ct, save_ct, peak_rss_mb, run_child
+import extraction as ext
+
+THRESHOLD = 1000
+
+def measure(filename, nr_workers):
+    image = np.asarray(nib.load(filename).dataobj)
+    baseline = peak_rss_mb()
+
+    times = []
+    for _ in xrange(3):
+        start = time.time()
+        if nr_workers == 0:
+            mask = ndimage.binary_erosion(image > THRESHOLD)
+            centroids = ext.isolate_masked_components(mask, image)
+            del mask
+        else:
+            centroids = ext.isolate_components_in_parallel(image, THRESHOLD,
+                nr_workers=nr_workers)
+        times.append(time.time() - start)
+
+    workers = peak_rss_mb(children=True) - baseline if nr_workers else 0
+    print '{0} {1:.2f} {2:.1f} {3:.1f}'.format(len(centroids), min(times),
+        peak_rss_mb() - baseline, max(workers, 0))
+
+def main(worker_counts):
+    fd, filename = tempfile.mkstemp(suffix='.nii')
+    os.close(fd)
+    try:
+        image = make_ct()
+        print 'image {0}, {1} CPUs, threshold {2}'.format(image.shape,
+            multiprocessing.cpu_count(), THRESHOLD)
+        save_ct(image, filename)
+        del image
+
+        print '{0:>10} {1:>10} {2:>8} {3:>10} {4:>10}'.format('mode',
+            'centroids', 'seconds', 'parent MB', 'worker MB')
+        for nr_workers in [0] + worker_counts:
+            nr, seconds, parent, worker = run_child(__file__, filename,
+                nr_workers)
+            mode = 'serial' if nr_workers == 0 else '{0} workers'.format(
+                nr_workers)
+            print '{0:>10} {1:>10} {2:>8} {3:>10} {4:>10}'.format(mode, nr,
+                seconds, parent, worker)
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(map(int, sys.argv[1:]) or [1, 2, 4])
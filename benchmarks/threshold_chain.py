@@ -0,0 +1,97 @@
+'''
+Measure the peak memory and runtime of the threshold, erode and label
+chain of the in-memory extraction, as done by identify_electrodes_in_ctspace
+before and after it kept its masks boolean.
+
+    float      the original chain, a float64 mask of zeros and ones and a
+               float64 thresholded copy of the image, with np.mean and
+               np.std of the image for the printed statistics
+    boolean    a boolean mask and isolate_masked_components, with np.mean
+               and np.std
+    streamed   the boolean chain, with intensity_statistics
+
+Each chain runs in its own process, which loads the synthetic CT before
+the measurement starts. The peak memory is the increase of the peak
+resident set size over the loaded process, and the runtime is the best
+of three runs. CT images are usually int16, for which np.std makes
+float64 copies of the image. The original benchmark used float32.
+
+The zeros of the float chain are only paid for in the pages that are
+written, so at high thresholds its peak memory is underestimated.
+
+Usage: python threshold_chain.py [threshold [dtype]]
+'''
+from __future__ import division
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from common import make_ct, save_ct, peak_rss_mb, run_child
+import extraction as ext
+
+CHAINS = ['float', 'boolean', 'streamed']
+
+def float_chain(ctd, threshold):
+    print >> sys.stderr, np.mean(ctd), np.std(ctd)
+    supthresh_locs = np.where(ctd > threshold)
+    ecs = np.zeros(ctd.shape)
+    ecs[supthresh_locs] = 1
+    cte = ndimage.binary_erosion(ecs)
+    ctpp = np.zeros(ctd.shape)
+    ctpp[np.where(cte)] = ctd[np.where(cte)]
+    return ext.isolate_components(ctpp)
+
+def boolean_chain(ctd, threshold, streamed):
+    if streamed:
+        print >> sys.stderr, ext.intensity_statistics(ctd)
+    else:
+        print >> sys.stderr, np.mean(ctd), np.std(ctd)
+    cte = ndimage.binary_erosion(ctd > threshold)
+    return ext.isolate_masked_components(cte, ctd)
+
+def measure(filename, chain, threshold):
+    ctd = np.asarray(nib.load(filename).dataobj)
+    baseline = peak_rss_mb()
+
+    times = []
+    for _ in xrange(3):
+        start = time.time()
+        if chain == 'float':
+            centroids = float_chain(ctd, threshold)
+        else:
+            centroids = boolean_chain(ctd, threshold, chain == 'streamed')
+        times.append(time.time() - start)
+
+    print '{0} {1:.1f} {2:.2f}'.format(len(centroids),
+        peak_rss_mb() - baseline, min(times))
+
+def main(threshold, dtype):
+    fd, filename = tempfile.mkstemp(suffix='.nii')
+    os.close(fd)
+    try:
+        image = make_ct().astype(dtype)
+        print 'image {0} {1}, {2:.0f} MB, threshold {3}'.format(
+            image.shape, dtype, image.nbytes / 2**20, threshold)
+        save_ct(image, filename)
+        del image
+
+        print '{0:>10} {1:>10} {2:>8} {3:>8}'.format('chain', 'centroids',
+            'peak MB', 'seconds')
+        for chain in CHAINS:
+            nr, peak, seconds = run_child(__file__, filename, chain,
+                threshold)
+            print '{0:>10} {1:>10} {2:>8} {3:>8}'.format(chain, nr, peak,
+                seconds)
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        measure(sys.argv[2], sys.argv[3], float(sys.argv[4]))
+    else:
+        main(float(sys.argv[1]) if len(sys.argv) > 1 else 2500,
+            sys.argv[2] if len(sys.argv) > 2 else 'int16')
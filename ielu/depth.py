@@ -0,0 +1,219 @@
+from __future__ import division
+import numpy as np
+from scipy.spatial import cKDTree
+
+#######################################
+# RANSAC detection of depth lead shafts
+#######################################
+
+def score_lines(points, origins, directions, pitches, perp_tol=.35,
+    spacing_tol=.3, max_skip=1, max_contacts=32):
+    '''
+    Score a batch of candidate shafts against a set of points. Each shaft
+    is a line through an origin point, with contacts expected at integer
+    multiples of the pitch from the origin.
+
+    A point is an inlier if it is within perp_tol pitches of the line and
+    within spacing_tol pitches of a contact position. The chain of a shaft
+    is the run of contact positions through the origin with no more than
+    max_skip consecutive positions missing.
+
+    Parameters
+    ----------
+    points : Nx3 np.ndarray
+        The contact locations
+    origins : Bx3 np.ndarray
+        A point on each line, which is a contact position
+    directions : Bx3 np.ndarray
+        The unit direction of each line
+    pitches : B np.ndarray
+        The expected distance between neighboring contacts on each line
+    perp_tol : float
+        The largest distance of a contact from the line, in pitches
+    spacing_tol : float
+        The largest distance of a contact from its position along the line,
+        in pitches
+    max_skip : int
+        The largest number of consecutive missing contacts in a chain
+    max_contacts : int
+        The farthest position from the origin that is considered on either
+        side, in pitches
+
+    Returns
+    -------
+    scores : B np.ndarray
+        The number of contact positions occupied in the chain of each line
+    positions : BxN np.ndarray
+        The contact position of every point along every line, in pitches
+        from the origin
+    members : BxN np.ndarray of bool
+        True for every point which is a contact in the chain of the line
+    '''
+    offsets = points[np.newaxis] - origins[:, np.newaxis]
+    along = np.einsum('bnk,bk->bn', offsets, directions)
+    perp_sq = np.sum(offsets**2, axis=2) - along**2
+
+    steps = along / pitches[:, np.newaxis]
+    positions = np.round(steps).astype(int)
+    inliers = ((perp_sq <= (perp_tol * pitches[:, np.newaxis])**2) &
+        (np.abs(steps - positions) <= spacing_tol) &
+        (np.abs(positions) <= max_contacts))
+
+    #occupancy of the contact positions -max_contacts..max_contacts
+    width = 2 * max_contacts + 1
+    occupied = np.zeros((len(origins), width), dtype=bool)
+    rows, cols = np.nonzero(inliers)
+    occupied[rows, positions[rows, cols] + max_contacts] = True
+
+    #walk outwards from the origin on both sides, until more than max_skip
+    #consecutive positions are empty
+    alive = np.zeros_like(occupied)
+    for side in (slice(max_contacts, None), slice(max_contacts, None, -1)):
+        occ = occupied[:, side]
+        empty = np.cumsum(~occ, axis=1)
+        gap = empty - np.maximum.accumulate(np.where(occ, empty, 0), axis=1)
+        alive[:, side] = ~np.maximum.accumulate(gap > max_skip, axis=1)
+
+    scores = np.sum(occupied & alive, axis=1)
+    members = inliers.copy()
+    members[rows, cols] = alive[rows, positions[rows, cols] + max_contacts]
+
+    return scores, positions, members
+
+def find_depth_shafts(points, min_pitch, max_pitch, min_contacts=4,
+    nr_neighbors=4, max_trials=2000, batch_size=256, center=None, seed=0,
+    **kwargs):
+    '''
+    Find depth electrode shafts, chains of collinear and evenly spaced
+    contacts, with RANSAC.
+
+    The candidate lines are drawn from pairs of nearby points, which on a
+    depth lead are usually neighboring contacts, so that each pair gives
+    both the direction and the pitch of the shaft. All of the candidates
+    are scored at once with score_lines. The best shaft is refit to its
+    contacts by least squares, its contacts are removed, and the search is
+    repeated until no shaft with at least min_contacts is left.
+
+    Parameters
+    ----------
+    points : Nx3 np.ndarray
+        The contact locations, such as the isotropic coordinates of the
+        extracted electrodes
+    min_pitch, max_pitch : float
+        The range of distances between neighboring contacts on a shaft, in
+        the units of the points. Keeping max_pitch below the spacing of
+        subdural grids keeps grid rows and strips from being detected.
+    min_contacts : int
+        The smallest number of contacts in a shaft
+    nr_neighbors : int
+        The number of nearest neighbors of each point to draw pairs from
+    max_trials : int
+        The largest number of candidate lines to score in each search. If
+        there are more pairs, a random subset is drawn.
+    batch_size : int
+        The number of candidates scored at once, which bounds memory use
+    center : None | 3-tuple
+        A point inside the brain. Each shaft is ordered starting from the
+        end nearest this point, which is the deepest contact. If None, the
+        mean of the points is used.
+    seed : int
+        The seed of the random subset of pairs, for reproducible results
+    kwargs : dict
+        The tolerances passed to score_lines
+
+    Returns
+    -------
+    shafts : List(2-tuple(np.ndarray))
+        For each shaft, the indices of its contacts in points, ordered from
+        the deepest, and the position of each contact along the shaft
+        starting from 0, which skips the positions of missing contacts
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    if center is None:
+        center = np.mean(points, axis=0)
+    rs = np.random.RandomState(seed)
+
+    remaining = np.arange(len(points))
+    shafts = []
+
+    while len(remaining) >= min_contacts:
+        pts = points[remaining]
+
+        #candidate pairs of nearby points
+        k = min(nr_neighbors + 1, len(pts))
+        dists, neighbors = cKDTree(pts).query(pts, k)
+        first = np.repeat(np.arange(len(pts)), k - 1)
+        second = neighbors[:, 1:].ravel()
+        dists = dists[:, 1:].ravel()
+        keep = (first < second) & (dists >= min_pitch) & (dists <= max_pitch)
+        first, second, dists = first[keep], second[keep], dists[keep]
+        if len(first) == 0:
+            break
+        if len(first) > max_trials:
+            subset = np.sort(rs.choice(len(first), max_trials, replace=False))
+            first, second, dists = first[subset], second[subset], dists[subset]
+
+        directions = (pts[second] - pts[first]) / dists[:, np.newaxis]
+
+        scores = np.concatenate([score_lines(pts, pts[first[b:b+batch_size]],
+            directions[b:b+batch_size], dists[b:b+batch_size], **kwargs)[0]
+            for b in xrange(0, len(first), batch_size)])
+
+        best = np.argmax(scores)
+        if scores[best] < min_contacts:
+            break
+
+        origin = pts[first[best]]
+        direction = directions[best]
+        pitch = dists[best]
+        _, positions, members = score_lines(pts, origin[np.newaxis],
+            direction[np.newaxis], np.array([pitch]), **kwargs)
+        chain, = np.nonzero(members[0])
+
+        #refit the line and pitch to the whole chain by least squares, and
+        #keep the refit if it explains at least as many contacts
+        centroid = np.mean(pts[chain], axis=0)
+        axis = np.linalg.svd(pts[chain] - centroid, full_matrices=False)[2][0]
+        index = positions[0, chain]
+        slope, intercept = np.polyfit(index,
+            np.dot(pts[chain] - centroid, axis), 1)
+        if abs(slope) >= min_pitch:
+            anchor = index[np.argmin(np.abs(index - np.mean(index)))]
+            refit = (centroid + axis * (intercept + slope * anchor),
+                axis * np.sign(slope), abs(slope))
+            score, refit_positions, refit_members = score_lines(pts,
+                refit[0][np.newaxis], refit[1][np.newaxis],
+                np.array([refit[2]]), **kwargs)
+            if score[0] >= scores[best]:
+                origin, direction, pitch = refit
+                positions, members = refit_positions, refit_members
+                chain, = np.nonzero(members[0])
+
+        index = positions[0, chain]
+
+        #only keep the point nearest each contact position
+        ideal = origin + np.outer(index * pitch, direction)
+        residual = np.linalg.norm(pts[chain] - ideal, axis=1)
+        order = np.lexsort((residual, index))
+        _, unique = np.unique(index[order], return_index=True)
+        chain = chain[order[unique]]
+        index = index[order[unique]]
+
+        #a single contact past a missing one at the end of a chain is more
+        #likely on a crossing lead than on this one
+        while len(index) > min_contacts and index[1] - index[0] > 1:
+            chain, index = chain[1:], index[1:]
+        while len(index) > min_contacts and index[-1] - index[-2] > 1:
+            chain, index = chain[:-1], index[:-1]
+
+        #order from the deepest contact
+        ends = pts[chain[[0, -1]]]
+        if (np.linalg.norm(ends[0] - center) >
+                np.linalg.norm(ends[1] - center)):
+            chain = chain[::-1]
+            index = index[::-1]
+        shafts.append((remaining[chain], np.abs(index - index[0])))
+
+        remaining = np.delete(remaining, chain)
+
+    return shafts
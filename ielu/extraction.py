@@ -0,0 +1,1713 @@
+from __future__ import division
+import numpy as np
+from scipy import ndimage
+
+##################################
+# connected component labeling API
+##################################
+
+def connectivity_structure(connectivity=26):
+    '''
+    Return the 3x3x3 structuring element for the given voxel connectivity.
+
+    Parameters
+    ----------
+    connectivity : 6 | 18 | 26
+        6 connects faces only, 18 connects faces and edges, and 26 connects
+        faces, edges and corners. The default is 26, which is what the
+        original breadth first search used.
+
+    Returns
+    -------
+    structure : 3x3x3 np.ndarray
+        A boolean structuring element suitable for scipy.ndimage
+    '''
+    ranks = {6 : 1, 18 : 2, 26 : 3}
+    if connectivity not in ranks:
+        raise ValueError('Connectivity must be one of 6, 18, or 26')
+    return ndimage.generate_binary_structure(3, ranks[connectivity])
+
+def label_components(image, connectivity=26):
+    '''
+    Label the connected nonzero regions of a 3D image.
+
+    Labels are assigned in raster order of the first voxel of each component,
+    which is the same order in which the breadth first search visits them.
+
+    Parameters
+    ----------
+    image : 3D np.ndarray
+        The image to label. Any nonzero voxel is considered foreground.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+
+    Returns
+    -------
+    labels : 3D np.ndarray
+        An integer image where each component has a unique label 1..N
+    nr_components : int
+        The number of components N
+    '''
+    return ndimage.label(image, structure=connectivity_structure(connectivity))
+
+#the per-component feature table returned by the extraction stage
+component_dtype = np.dtype([
+    ('voxel_count', np.int32),
+    ('intensity_sum', np.float64),
+    ('intensity_max', np.float32),
+    ('bbox_min', np.int32, (3,)),
+    ('bbox_max', np.int32, (3,)),
+    ('centroid', np.float64, (3,)),
+    ('axis_lengths', np.float32, (3,)),
+    ('elongation', np.float32),
+])
+
+def component_features(coords, values, labels, nr_components):
+    '''
+    Calculate a table of shape and intensity features for each component,
+    using only vectorized passes over the labeled voxels.
+
+    Parameters
+    ----------
+    coords : Nx3 np.ndarray
+        The voxel coordinates of every labeled voxel
+    values : N np.ndarray
+        The image intensity of every labeled voxel
+    labels : N np.ndarray
+        The label of every voxel, from 1..nr_components
+    nr_components : int
+        The number of components
+
+    Returns
+    -------
+    features : np.ndarray with dtype component_dtype
+        One row per component, in label order, with the fields
+        voxel_count : the number of voxels
+        intensity_sum : the summed intensity
+        intensity_max : the peak intensity
+        bbox_min, bbox_max : the inclusive bounding box in voxel space
+        centroid : the intensity weighted center of mass
+        axis_lengths : the principal axis lengths, longest first, of the
+            uniform ellipsoid with the same second moments as the voxels
+        elongation : the ratio of the longest to the second longest axis.
+            This is near 1 for spherical and disc shaped contacts, and
+            large for wires and streak artifacts.
+
+        The positions and shapes are measured in the voxels of the labeled
+        image. With the analytic isotropization of
+        identify_electrodes_in_ctspace, these are the native anisotropic
+        voxels of the CT image, so the centroid, axis_lengths and
+        elongation differ from those measured in a resampled image. A
+        contact that is round in mm looks flat in voxels of thick slices.
+    '''
+    features = np.zeros(nr_components, dtype=component_dtype)
+    if nr_components == 0:
+        return features
+
+    lab = labels - 1
+    coords = np.asarray(coords)
+    weights = values.astype(np.float64)
+
+    count = np.bincount(lab, minlength=nr_components)
+    mass = np.bincount(lab, weights=weights, minlength=nr_components)
+
+    features['voxel_count'] = count
+    features['intensity_sum'] = mass
+
+    #every label has at least one voxel so each reduceat group is nonempty
+    order = np.argsort(lab, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    features['intensity_max'] = np.maximum.reduceat(values[order], starts)
+    features['bbox_min'] = np.minimum.reduceat(coords[order], starts)
+    features['bbox_max'] = np.maximum.reduceat(coords[order], starts)
+
+    mean = np.zeros((nr_components, 3))
+    for ax in xrange(3):
+        features['centroid'][:, ax] = np.bincount(lab,
+            weights=weights*coords[:, ax], minlength=nr_components) / mass
+        mean[:, ax] = np.bincount(lab, weights=coords[:, ax],
+            minlength=nr_components) / count
+
+    #the covariance of each voxel is that of a unit cube, 1/12 on the
+    #diagonal, which also keeps the axes of single voxels nonzero
+    cov = np.zeros((nr_components, 3, 3))
+    for i in xrange(3):
+        for j in xrange(i, 3):
+            cov[:, i, j] = cov[:, j, i] = np.bincount(lab,
+                weights=coords[:, i]*coords[:, j].astype(np.float64),
+                minlength=nr_components) / count - mean[:, i]*mean[:, j]
+    cov += np.eye(3) / 12
+
+    eigvals = np.clip(np.linalg.eigvalsh(cov)[:, ::-1], 0, None)
+    features['axis_lengths'] = 2 * np.sqrt(5 * eigvals)
+    features['elongation'] = (features['axis_lengths'][:, 0] /
+        features['axis_lengths'][:, 1])
+
+    return features
+
+def select_components(features, min_voxels=None, max_voxels=None,
+    max_elongation=None, max_axis_length=None, min_intensity=None):
+    '''
+    Build a mask of the components that look like electrode contacts, from
+    the feature table. Any criterion that is None is not applied.
+
+    The voxel counts, axis lengths and elongation are in the voxels of the
+    labeled image, which are anisotropic with the analytic isotropization
+    and isotropic with resampling. The same criteria therefore select
+    different components depending on the isotropization method.
+
+    Parameters
+    ----------
+    features : np.ndarray with dtype component_dtype
+        The feature table returned by the extraction stage
+    min_voxels : int | None
+        Reject components smaller than this, such as isolated noise voxels
+    max_voxels : int | None
+        Reject components larger than this, such as skull fragments
+    max_elongation : float | None
+        Reject components more elongated than this, such as wires and
+        streak artifacts
+    max_axis_length : float | None
+        Reject components whose longest axis is longer than this, in voxels
+    min_intensity : float | None
+        Reject components whose peak intensity is below this
+
+    Returns
+    -------
+    mask : np.ndarray of bool
+        True for every component which meets all of the criteria
+    '''
+    mask = np.ones(len(features), dtype=bool)
+    if min_voxels is not None:
+        mask &= features['voxel_count'] >= min_voxels
+    if max_voxels is not None:
+        mask &= features['voxel_count'] <= max_voxels
+    if max_elongation is not None:
+        mask &= features['elongation'] <= max_elongation
+    if max_axis_length is not None:
+        mask &= features['axis_lengths'][:, 0] <= max_axis_length
+    if min_intensity is not None:
+        mask &= features['intensity_max'] >= min_intensity
+    return mask
+
+def filter_components_by_peak(values, labels, nr_components, min_peak):
+    '''
+    Keep only the components which have a voxel brighter than min_peak,
+    which is the seed test of hysteresis thresholding. The components are
+    labeled above a low threshold, and those without a seed above the high
+    threshold are dropped.
+
+    Parameters
+    ----------
+    values : N np.ndarray
+        The image intensity of every labeled voxel
+    labels : N np.ndarray
+        The label of every voxel, from 1..nr_components
+    nr_components : int
+        The number of components
+    min_peak : float
+        The high threshold. A component is kept if any of its voxels is
+        strictly brighter than this.
+
+    Returns
+    -------
+    keep : N np.ndarray of bool
+        True for the voxels of the kept components
+    labels : M np.ndarray
+        The labels of the kept voxels, renumbered 1..nr_kept in the same
+        order as before
+    nr_kept : int
+        The number of kept components
+    '''
+    seeded = np.zeros(nr_components + 1, dtype=bool)
+    seeded[labels[values > min_peak]] = True
+    keep = seeded[labels]
+
+    relabel = np.cumsum(seeded)
+    return keep, relabel[labels[keep]], int(relabel[-1])
+
+def anisotropic_erosion_structure(zf):
+    '''
+    Return the erosion kernel that approximates eroding by one voxel in
+    isotropic space, when the image is eroded in its own voxel space.
+
+    Eroding one voxel along an axis with a zoom factor of zf removes zf
+    isotropic voxels. Along axes where a voxel is two or more isotropic
+    voxels long, this would remove thin contacts entirely, so the kernel
+    does not erode along them.
+
+    Parameters
+    ----------
+    zf : 3-element array-like
+        The zoom factor from voxel space to isotropic space for each axis
+
+    Returns
+    -------
+    structure : 3x3x3 np.ndarray
+        A boolean structuring element suitable for scipy.ndimage
+    '''
+    structure = np.zeros((3,3,3), dtype=bool)
+    structure[1,1,1] = True
+    for ax in xrange(3):
+        if zf[ax] < 2:
+            arm = [1,1,1]
+            arm[ax] = slice(None)
+            structure[tuple(arm)] = True
+    return structure
+
+def round_coords(coords):
+    '''
+    Round coordinates half away from zero, as the builtin round does in
+    python 2. np.around rounds half to even, which would move some centroids
+    by one voxel relative to the original implementation.
+    '''
+    coords = np.asarray(coords, dtype=np.float64)
+    return np.sign(coords) * np.floor(np.abs(coords) + .5)
+
+def isolate_components(image, connectivity=26, return_features=False):
+    '''
+    Find the connected components of the image and return the rounded,
+    intensity weighted center of mass of each one.
+
+    Parameters
+    ----------
+    image : 3D np.ndarray
+        The thresholded intensity image. Voxels below threshold should be 0.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+    return_features : bool
+        If true, also return the feature table of the components
+
+    Returns
+    -------
+    centroids : List(3-tuple)
+        The rounded centroid of each component, in raster order of the first
+        voxel of each component
+    features : np.ndarray with dtype component_dtype
+        The feature table, in the same order as the centroids. Only
+        returned if return_features is true.
+    '''
+    return isolate_masked_components(image, image, connectivity=connectivity,
+        return_features=return_features)
+
+def isolate_masked_components(mask, image, connectivity=26,
+    seed_threshold=None, contact_volume=None, sampling=None,
+    return_features=False, return_label_map=False):
+    '''
+    Equivalent to isolate_components, for a boolean mask of the
+    suprathreshold voxels and the unthresholded image. This avoids building
+    a thresholded copy of the image, the intensities are only read at the
+    labeled voxels.
+
+    Parameters
+    ----------
+    mask : 3D np.ndarray
+        The voxels to label, typically a boolean array
+    image : 3D np.ndarray
+        The intensity image, with the same shape as the mask
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+    seed_threshold : None | float
+        If given, only the components with a voxel strictly brighter than
+        this are kept, with filter_components_by_peak
+    contact_volume : None | float | 'auto'
+        If given, components larger than the expected number of voxels in
+        a contact are split with split_merged_components
+    sampling : None | 3-tuple(float)
+        The relative size of a voxel along each axis, used when splitting
+    return_features : bool
+        If true, also return the feature table of the components
+    return_label_map : bool
+        If true, also return the LabelMap of the components
+
+    Returns
+    -------
+    centroids : List(3-tuple)
+        The rounded centroid of each component, in raster order of the first
+        voxel of each component
+    features : np.ndarray with dtype component_dtype
+        The feature table, in the same order as the centroids. Only
+        returned if return_features is true.
+    label_map : LabelMap
+        The label of every voxel of the components, in the same order as
+        the centroids. Only returned if return_label_map is true.
+    '''
+    labels, nr_components = label_components(mask, connectivity=connectivity)
+
+    locs = np.nonzero(labels)
+    coords = np.transpose(locs)
+    labels = labels[locs]
+    values = image[locs]
+    if seed_threshold is not None:
+        keep, labels, nr_components = filter_components_by_peak(values,
+            labels, nr_components, seed_threshold)
+        coords, values = coords[keep], values[keep]
+    if contact_volume is not None:
+        labels, nr_components = split_merged_components(coords, labels,
+            nr_components, contact_volume, sampling=sampling)
+
+    return _component_results(coords, values, labels, nr_components,
+        return_features=return_features, return_label_map=return_label_map)
+
+def _component_results(coords, values, labels, nr_components,
+    return_features=False, return_label_map=False):
+    #the centroids, and optionally the features and label map, of labeled
+    #voxels, which every vectorized labeling path returns
+    features = component_features(coords, values, labels, nr_components)
+    centroids = map(tuple, round_coords(features['centroid']))
+
+    results = [centroids]
+    if return_features:
+        results.append(features)
+    if return_label_map:
+        results.append(label_map_from_components(coords, labels,
+            features['centroid']))
+
+    if len(results) == 1:
+        return centroids
+    return tuple(results)
+
+#####################
+# persistent labels
+#####################
+
+class LabelMap():
+    '''
+    The labels of the extracted components, kept after extraction so that
+    any voxel of the CT image can be resolved to the component it belongs
+    to in constant time.
+
+    The labels are stored densely, in the smallest unsigned integer type
+    that holds them, but only within the bounding box of the labeled
+    voxels. The image that was labeled may be a cropped or resampled
+    version of the CT image, so points in CT voxel space are mapped to the
+    labeled image as (point - offset) * zoom.
+
+    Parameters
+    ----------
+    box : 3D np.ndarray
+        The label of each voxel in the bounding box, from 1..N, with 0 for
+        unlabeled voxels
+    box_min : 3-tuple(int)
+        The position of the bounding box in the labeled image
+    centroids : Nx3 np.ndarray
+        The intensity weighted centroid of each component, in the labeled
+        image
+    offset : None | 3-tuple
+        The position of the labeled image in CT voxel space
+    zoom : None | 3-tuple
+        The zoom factor from CT voxel space to the labeled image
+    '''
+    def __init__(self, box, box_min, centroids, offset=None, zoom=None):
+        self.box = box
+        self.box_min = np.array(box_min, dtype=int)
+        self.centroids = np.array(centroids, dtype=np.float64)
+        self.offset = np.zeros(3) if offset is None else np.array(offset,
+            dtype=np.float64)
+        self.zoom = np.ones(3) if zoom is None else np.array(zoom,
+            dtype=np.float64)
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def lookup(self, point):
+        '''
+        Return the index of the component at a point in CT voxel space, or
+        None if the point is not in any component.
+        '''
+        voxel = round_coords((np.asarray(point) - self.offset) *
+            self.zoom).astype(int) - self.box_min
+        if np.any(voxel < 0) or np.any(voxel >= self.box.shape):
+            return None
+        label = self.box[tuple(voxel)]
+        if label == 0:
+            return None
+        return int(label) - 1
+
+    def centroid(self, index):
+        '''
+        Return the centroid of a component in CT voxel space.
+        '''
+        return tuple(self.centroids[index] / self.zoom + self.offset)
+
+def label_map_from_components(coords, labels, centroids):
+    '''
+    Build a LabelMap from the coordinates and labels 1..N of the labeled
+    voxels, and the centroid of each component, all in the labeled image.
+    The caller sets the offset and zoom of the labeled image.
+    '''
+    coords = np.reshape(coords, (-1, 3))
+    if len(coords) == 0:
+        return LabelMap(np.zeros((0, 0, 0), dtype=np.uint8), (0, 0, 0),
+            np.zeros((0, 3)))
+
+    box_min = np.min(coords, axis=0)
+    box = np.zeros(np.max(coords, axis=0) - box_min + 1,
+        dtype=np.min_scalar_type(len(centroids)))
+    box[tuple((coords - box_min).T)] = labels
+    return LabelMap(box, box_min, centroids)
+
+def grow_region(dataobj, seed, radius=8, search_radius=2, min_contrast=5.):
+    '''
+    Find the bright blob at a voxel which is not in any extracted component,
+    such as a contact below the extraction threshold, by growing a region
+    in a small window around it.
+
+    The peak of the blob is the brightest voxel within search_radius of the
+    seed. The blob is the 26-connected region around the peak of voxels
+    brighter than halfway between the peak and the median of the window.
+    Noise is told apart from a blob by the contrast of the peak to the
+    window, in robust standard deviations estimated from the median
+    absolute deviation.
+    Only the window is read from dataobj, so this is fast even for an image
+    that is not loaded into memory.
+
+    Parameters
+    ----------
+    dataobj : 3D np.ndarray | nibabel array proxy
+        The CT image
+    seed : 3-tuple
+        The voxel, such as a point that the user clicked on
+    radius : int
+        The half width of the window in voxels. A blob larger than the
+        window is cut off at its edge.
+    search_radius : int
+        The half width of the neighborhood of the seed searched for the peak
+    min_contrast : float
+        The smallest contrast of the peak of a blob
+
+    Returns
+    -------
+    centroid : None | 3-tuple
+        The intensity weighted centroid of the blob, or None if there is no
+        blob brighter than its surroundings at the seed
+    '''
+    shape = dataobj.shape[:3]
+    seed = round_coords(seed).astype(int)
+    lo = np.maximum(seed - radius, 0)
+    hi = np.minimum(seed + radius + 1, shape)
+    if np.any(lo >= hi):
+        return None
+    window = np.asarray(dataobj[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]],
+        dtype=np.float64)
+
+    near = tuple(slice(max(c - search_radius, 0), c + search_radius + 1)
+        for c in seed - lo)
+    peak = np.unravel_index(np.argmax(window[near]), window[near].shape)
+    peak = tuple(p + sl.start for p, sl in zip(peak, near))
+
+    background = np.median(window)
+    spread = 1.4826 * np.median(np.abs(window - background))
+    if not window[peak] - background > min_contrast * spread:
+        return None
+    level = (window[peak] + background) / 2
+
+    labels, _ = label_components(window > level, 26)
+    blob = labels == labels[peak]
+    centroid = ndimage.center_of_mass(window * blob)
+    return tuple(np.array(centroid) + lo)
+
+##########################
+# suppression of streaks
+##########################
+
+def line_structure(angle, length, sampling=None):
+    '''
+    Return a structuring element which is a rasterized line through the
+    center, in the plane of the first two axes, at angle radians from the
+    first axis.
+
+    Parameters
+    ----------
+    angle : float
+        The direction of the line in the axial plane
+    length : float
+        The length of the line, in the units of sampling
+    sampling : None | 3-tuple
+        The size of a voxel along each axis. If None, voxels are unit cubes.
+
+    Returns
+    -------
+    structure : MxNx1 np.ndarray
+        A boolean structuring element suitable for scipy.ndimage
+    '''
+    if sampling is None:
+        sampling = np.ones(3)
+    step = np.array([np.cos(angle), np.sin(angle)]) / sampling[:2]
+
+    #sample the line at half voxel intervals and rasterize the samples
+    nr_samples = int(np.ceil(length * np.max(np.abs(step)))) + 1
+    along = np.linspace(-length / 2, length / 2, 2 * nr_samples + 1)
+    pixels = round_coords(np.outer(along, step)).astype(int)
+    half = np.max(np.abs(pixels), axis=0)
+
+    structure = np.zeros(tuple(2 * half + 1) + (1,), dtype=bool)
+    structure[pixels[:,0] + half[0], pixels[:,1] + half[1], 0] = True
+    return structure
+
+def streak_angles(length, sampling=None):
+    '''
+    Return the directions in the axial plane to search for streaks, spaced
+    closely enough that a line of the given length at any angle is within
+    half a voxel of one of them at its ends.
+    '''
+    if sampling is None:
+        sampling = np.ones(3)
+    spacing = 2 * np.arctan(np.min(sampling[:2]) / length)
+    nr_angles = int(np.ceil(np.pi / spacing))
+    return np.arange(nr_angles) * np.pi / nr_angles
+
+def suppress_streaks(mask, length, sampling=None, connectivity=26):
+    '''
+    Remove the streak artifacts of beam hardening around dense metal from
+    a thresholded CT image.
+
+    Streaks are thin bright lines radiating from the metal in the axial
+    plane, long compared to a contact. A voxel is part of a streak if it is
+    on a straight line of suprathreshold voxels at least length long, in
+    any direction in the axial plane, which is a binary opening of the mask
+    with a line in each direction of streak_angles. Contacts are shorter
+    than length in every direction and are not opened away. Where a streak
+    runs into a contact, the contact voxels on the line of the streak are
+    opened away too, so the remaining voxels are dilated by one voxel
+    within the mask to restore them. Thresholding commutes with the
+    opening, so it is applied to the boolean mask rather than to the
+    intensities.
+
+    The axial plane is taken to be the plane of the first two axes, with
+    the slices along the last axis, as in label_by_slabs.
+
+    Parameters
+    ----------
+    mask : 3D np.ndarray of bool
+        The suprathreshold voxels
+    length : float
+        The shortest streak, in the units of sampling. This should be
+        longer than a contact, and shorter than the straight stretches of
+        the streaks. The shafts of depth electrodes which lie in the axial
+        plane and are suprathreshold between contacts are straight lines
+        too, and are removed with the streaks.
+    sampling : None | 3-tuple
+        The size of a voxel along each axis. If None, voxels are unit cubes.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to restore the contacts
+
+    Returns
+    -------
+    mask : 3D np.ndarray of bool
+        The suprathreshold voxels which are not part of a streak
+    nr_eliminated : int
+        The number of 26-connected components of the mask which were
+        removed entirely
+    '''
+    if sampling is None:
+        sampling = np.ones(3)
+    sampling = np.asarray(sampling, dtype=np.float64)
+
+    structures = [line_structure(angle, length, sampling)
+        for angle in streak_angles(length, sampling)]
+    restore = connectivity_structure(connectivity)
+
+    #a rasterized line is 26-connected, so it lies within one component.
+    #only the components large enough to hold one of the lines are opened,
+    #each within its own bounding box
+    labels, nr_components = label_components(mask, 26)
+    objects = ndimage.find_objects(labels)
+
+    mask = mask.copy()
+    nr_eliminated = 0
+    for i, box in enumerate(objects):
+        shape = [sl.stop - sl.start for sl in box]
+        lines = [st for st in structures if np.all(np.less_equal(st.shape,
+            shape))]
+        if len(lines) == 0:
+            continue
+
+        component = labels[box] == i + 1
+        streaks = np.zeros_like(component)
+        for structure in lines:
+            streaks |= ndimage.binary_opening(component, structure=structure)
+        if not np.any(streaks):
+            continue
+
+        kept = component & ~streaks
+        kept |= ndimage.binary_dilation(kept, structure=restore) & component
+        mask[box] &= kept | ~component
+        if not np.any(kept):
+            nr_eliminated += 1
+
+    return mask, nr_eliminated
+
+###############################
+# splitting of merged contacts
+###############################
+
+def estimate_contact_volume(voxel_counts, min_voxels=4):
+    '''
+    Estimate the number of voxels in a single contact as the median size of
+    the components, ignoring noise components smaller than min_voxels. Most
+    contacts are not merged with their neighbors, so the median is robust
+    to the few merged ones.
+    '''
+    voxel_counts = np.asarray(voxel_counts)
+    voxel_counts = voxel_counts[voxel_counts >= min_voxels]
+    if len(voxel_counts) == 0:
+        return None
+    return float(np.median(voxel_counts))
+
+def split_merged_components(coords, labels, nr_components, contact_volume,
+    max_ratio=1.5, sampling=None):
+    '''
+    Split components that are too large to be a single contact, such as
+    neighboring contacts on a depth electrode that have fused together, with
+    a marker based watershed of their Euclidean distance transform.
+
+    A component of V voxels is split if V is more than max_ratio times the
+    contact volume, into round(V / contact_volume) pieces. One marker is
+    placed per piece, at the deepest voxel of each equal sized slice of the
+    component along its principal axis, and the watershed then divides the
+    component along the narrowest necks between the markers. Only the
+    bounding boxes of the oversized components are ever built.
+
+    Parameters
+    ----------
+    coords : Nx3 np.ndarray
+        The voxel coordinates of every labeled voxel, in raster order
+    labels : N np.ndarray
+        The label of every voxel, from 1..nr_components
+    nr_components : int
+        The number of components
+    contact_volume : float | 'auto'
+        The expected number of voxels in a single contact. If 'auto', it is
+        estimated with estimate_contact_volume.
+    max_ratio : float
+        Components larger than this many contact volumes are split
+    sampling : None | 3-tuple(float)
+        The relative size of a voxel along each axis, for anisotropic
+        images. If None, voxels are assumed to be isotropic.
+
+    Returns
+    -------
+    labels : N np.ndarray
+        The new label of every voxel, from 1..nr_components, in raster order
+        of the first voxel of each component as in label_components
+    nr_components : int
+        The number of components after splitting
+    '''
+    if nr_components == 0:
+        return labels, nr_components
+
+    counts = np.bincount(labels, minlength=nr_components+1)[1:]
+    if contact_volume == 'auto':
+        contact_volume = estimate_contact_volume(counts)
+        if contact_volume is None:
+            return labels, nr_components
+        print 'ESTIMATED CONTACT VOLUME {0} VOXELS'.format(contact_volume)
+
+    nr_pieces = round_coords(counts / contact_volume).astype(int)
+    oversized, = np.nonzero((counts > max_ratio * contact_volume) &
+        (nr_pieces >= 2))
+    if len(oversized) == 0:
+        return labels, nr_components
+
+    scale = np.ones(3) if sampling is None else np.asarray(sampling, float)
+
+    order = np.argsort(labels, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(counts)))
+
+    new_labels = labels - 1
+    next_label = nr_components
+    for lab in oversized:
+        members = order[starts[lab]:starts[lab+1]]
+        nr = nr_pieces[lab]
+
+        #the bounding box of the component, with a background border
+        lo = np.min(coords[members], axis=0) - 1
+        local = coords[members] - lo
+        mask = np.zeros(np.max(local, axis=0) + 2, dtype=bool)
+        mask[tuple(local.T)] = True
+
+        dist = ndimage.distance_transform_edt(mask, sampling=scale)
+        depth = dist[tuple(local.T)]
+
+        #equal sized slices along the principal axis
+        centered = (local - np.mean(local, axis=0)) * scale
+        axis = np.linalg.svd(centered, full_matrices=False)[2][0]
+        rank = np.empty(len(members), dtype=np.intp)
+        rank[np.argsort(np.dot(centered, axis), kind='mergesort')] = (
+            np.arange(len(members)))
+        piece = rank * nr // len(members)
+
+        #the deepest voxel of each slice is its marker
+        deepest = np.lexsort((-depth, piece))
+        first = np.concatenate(([0], np.nonzero(np.diff(
+            piece[deepest]))[0] + 1))
+        markers = np.where(mask, 0, -1).astype(np.int16)
+        markers[tuple(local[deepest[first]].T)] = np.arange(1, nr+1)
+
+        #watershed_ift floods uint16 costs, lowest first
+        cost = np.round((1 - dist / np.max(dist)) * 65535).astype(np.uint16)
+        basins = ndimage.watershed_ift(cost, markers)[tuple(local.T)]
+        basins = np.where(basins > 0, basins, piece + 1)
+
+        new_labels[members] = np.where(basins == 1, lab,
+            next_label + basins - 2)
+        next_label += nr - 1
+
+    return raster_order_labels(new_labels, next_label), next_label
+
+#######################################
+# sparse, slab streamed extraction API
+#######################################
+
+def iter_slabs(dataobj, slab_size=32, halo=1, crop=None):
+    '''
+    Iterate over a 3D image in slabs along the last (slice) axis.
+
+    Only one slab is read into memory at a time. If the image is a
+    memory mapped nibabel array proxy, only the slices in the slab are read
+    from disk.
+
+    Parameters
+    ----------
+    dataobj : 3D array-like
+        The image, typically the dataobj of a nibabel image
+    slab_size : int
+        The number of slices in each slab, excluding the halo
+    halo : int
+        The number of extra slices to read on each side of the slab, where
+        they exist. This lets neighborhood operations be computed exactly
+        at the slab seams.
+    crop : None | 3-tuple(slice)
+        If given, only iterate over this subvolume, with explicit start and
+        stop values. The subvolume is treated as the entire image, and the
+        yielded indices are relative to it.
+
+    Yields
+    ------
+    z0 : int
+        The index of the first slice of the slab, excluding the halo
+    z1 : int
+        One past the index of the last slice of the slab, excluding the halo
+    lo : int
+        The index of the first slice that was actually read
+    slab : 3D np.ndarray
+        The slices lo through min(z1+halo, nz) of the image
+    '''
+    if crop is None:
+        crop = tuple(slice(0, n) for n in dataobj.shape)
+    xs, ys, zs = crop
+
+    nz = zs.stop - zs.start
+    for z0 in xrange(0, nz, slab_size):
+        z1 = min(z0 + slab_size, nz)
+        lo = max(z0 - halo, 0)
+        hi = min(z1 + halo, nz)
+        yield z0, z1, lo, np.asarray(dataobj[xs, ys,
+            zs.start+lo:zs.start+hi])
+
+def intensity_statistics(dataobj, slab_size=32):
+    '''
+    Calculate the mean and standard deviation of an image one slab at a
+    time, so that no float64 copy of the entire image is made.
+
+    Parameters
+    ----------
+    dataobj : 3D array-like
+        The image, loaded or a memory mapped nibabel array proxy
+    slab_size : int
+        The number of slices to read at a time
+
+    Returns
+    -------
+    mean : float
+        The mean intensity of the image
+    std : float
+        The standard deviation of the intensity of the image
+    '''
+    total = 0.
+    total_sq = 0.
+    count = 0
+    for z0, z1, lo, slab in iter_slabs(dataobj, slab_size=slab_size,
+            halo=0):
+        total += np.sum(slab, dtype=np.float64)
+        total_sq += np.sum(np.square(slab, dtype=np.float64))
+        count += slab.size
+
+    mean = total / count
+    return mean, np.sqrt(max(total_sq / count - mean**2, 0))
+
+def label_by_slabs(dataobj, threshold, use_erosion=True, slab_size=32,
+    structure=None, crop=None, connectivity=26):
+    '''
+    Threshold, optionally erode and label an image one slab at a time,
+    keeping only the sparse set of surviving voxels and their labels.
+
+    Each slab is labeled densely with label_components, and components
+    that touch across the seam between two slabs are merged with
+    merge_labels. The result is identical to thresholding, eroding and
+    labeling the entire volume at once, but apart from the surviving
+    voxels, the peak memory use is bounded by the size of a slab.
+
+    Parameters
+    ----------
+    dataobj : 3D array-like
+        The image, typically the dataobj of a memory mapped nibabel image
+    threshold : float
+        Voxels strictly above this value are kept
+    use_erosion : bool
+        If true, apply binary erosion with the default 6-connected kernel
+    slab_size : int
+        The number of slices to read at a time
+    structure : None | 3x3x3 np.ndarray
+        The erosion kernel. If None, the 6-connected kernel is used.
+    crop : None | 3-tuple(slice)
+        If given, only process this subvolume, as in iter_slabs
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+
+    Returns
+    -------
+    coords : Nx3 np.ndarray of int32
+        The voxel coordinates of the surviving voxels, in raster order,
+        relative to the subvolume if crop is given
+    values : N np.ndarray
+        The image intensities at these voxels
+    labels : N np.ndarray
+        The label of each voxel, from 1..nr_components. As in
+        label_components, labels are assigned in raster order of the first
+        voxel of each component.
+    nr_components : int
+        The number of components
+    mean : float
+        The mean intensity of the entire image
+    std : float
+        The standard deviation of the intensity of the entire image
+    '''
+    halo = 1 if use_erosion else 0
+
+    #the in plane offsets that connect a voxel to the next slice
+    seam_offsets = np.transpose(np.nonzero(connectivity_structure(
+        connectivity)[:, :, 2])) - 1
+
+    coords = []
+    values = []
+    labels = []
+    seam_a = []
+    seam_b = []
+    nr_labels = 0
+    last_slice = None
+    total = 0.
+    total_sq = 0.
+    count = 0
+
+    for z0, z1, lo, slab in iter_slabs(dataobj, slab_size=slab_size,
+            halo=halo, crop=crop):
+        core = slab[:, :, z0-lo:z1-lo]
+        total += np.sum(core, dtype=np.float64)
+        total_sq += np.sum(np.square(core, dtype=np.float64))
+        count += core.size
+
+        mask = slab > threshold
+        if use_erosion:
+            mask = ndimage.binary_erosion(mask, structure=structure)
+        mask = mask[:, :, z0-lo:z1-lo]
+
+        #labels 1..n of this slab become nr_labels+1..nr_labels+n
+        slab_labels, n = label_components(mask, connectivity=connectivity)
+        slab_labels[mask] += nr_labels
+
+        if last_slice is not None:
+            first_slice = slab_labels[:, :, 0]
+            nx, ny = first_slice.shape
+            for dx, dy in seam_offsets:
+                a = last_slice[max(0, -dx):nx-max(0, dx),
+                    max(0, -dy):ny-max(0, dy)]
+                b = first_slice[max(0, dx):nx-max(0, -dx),
+                    max(0, dy):ny-max(0, -dy)]
+                joined = (a > 0) & (b > 0)
+                seam_a.append(a[joined] - 1)
+                seam_b.append(b[joined] - 1)
+        last_slice = slab_labels[:, :, -1].copy()
+
+        x, y, z = np.nonzero(mask)
+        coords.append(np.transpose((x, y, z + z0)).astype(np.int32))
+        values.append(core[x, y, z])
+        labels.append((slab_labels[x, y, z] - 1).astype(np.int32))
+        nr_labels += n
+
+    coords = np.concatenate(coords)
+    values = np.concatenate(values)
+    labels = np.concatenate(labels)
+
+    #merge the labels of each slab, before the voxels are reordered
+    nr_components = 0
+    if nr_labels > 0:
+        roots = merge_labels(np.concatenate(seam_a + [[]]).astype(np.intp),
+            np.concatenate(seam_b + [[]]).astype(np.intp), nr_labels)
+        merged, compact = np.unique(roots, return_inverse=True)
+        nr_components = len(merged)
+        labels = compact.astype(np.int32)[labels]
+
+    #put the voxels in raster order one column at a time, so that only
+    #one column is ever copied
+    shape = dataobj.shape if crop is None else tuple(
+        sl.stop - sl.start for sl in crop)
+    order = np.argsort(np.ravel_multi_index(coords.T, shape),
+        kind='mergesort')
+    for ax in xrange(3):
+        coords[:, ax] = coords[order, ax]
+    values = values[order]
+    labels = labels[order]
+    del order
+
+    if nr_components > 0:
+        labels = raster_order_labels(labels, nr_components)
+
+    mean = total / count
+    std = np.sqrt(max(total_sq / count - mean**2, 0))
+
+    return coords, values, labels, nr_components, mean, std
+
+def sparse_neighbor_pairs(coords, shape, connectivity=26):
+    '''
+    Find every pair of neighboring voxels in a sparse set of voxels.
+
+    Parameters
+    ----------
+    coords : Nx3 np.ndarray
+        The voxel coordinates, in raster order
+    shape : 3-tuple
+        The shape of the volume that the coordinates lie in
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+
+    Returns
+    -------
+    rows, cols : np.ndarray
+        The indices into coords of each pair of neighbors. Each pair is
+        only listed once, with the voxel earlier in raster order first.
+    '''
+    nr_voxels = len(coords)
+    shape = np.array(shape)
+    lin = np.ravel_multi_index(coords.T, shape)
+
+    #only look at the half of the neighborhood that comes later in raster
+    #order, the graph is undirected
+    rows = [np.zeros(0, dtype=np.intp)]
+    cols = [np.zeros(0, dtype=np.intp)]
+    for offset in np.transpose(np.nonzero(connectivity_structure(
+            connectivity))) - 1:
+        if tuple(offset) <= (0, 0, 0):
+            continue
+
+        neighbor = coords + offset
+        valid = np.all((neighbor >= 0) & (neighbor < shape), axis=1)
+        src, = np.nonzero(valid)
+        target = np.ravel_multi_index(neighbor[src].T, shape)
+
+        dst = np.searchsorted(lin, target)
+        dst[dst == nr_voxels] = 0
+        found = lin[dst] == target
+
+        rows.append(src[found])
+        cols.append(dst[found])
+
+    return np.concatenate(rows), np.concatenate(cols)
+
+def raster_order_labels(raw_labels, nr_components):
+    '''
+    Renumber component labels 0..N-1 of voxels listed in raster order, so
+    that the components are numbered 1..N in order of their first voxel.
+    '''
+    _, first = np.unique(raw_labels, return_index=True)
+    relabel = np.zeros(nr_components, dtype=np.int32)
+    relabel[raw_labels[np.sort(first)]] = np.arange(1, nr_components+1)
+    return relabel[raw_labels]
+
+def isolate_sparse_components(coords, values, labels, nr_components,
+    seed_threshold=None, contact_volume=None, sampling=None,
+    return_features=False, return_label_map=False):
+    '''
+    Equivalent to isolate_components, for a sparse set of labeled voxels
+    returned by label_by_slabs.
+
+    Parameters
+    ----------
+    coords : Nx3 np.ndarray
+        The voxel coordinates, in raster order
+    values : N np.ndarray
+        The image intensities at these voxels
+    labels : N np.ndarray
+        The label of every voxel, from 1..nr_components
+    nr_components : int
+        The number of components
+    seed_threshold : None | float
+        If given, only the components with a voxel strictly brighter than
+        this are kept, with filter_components_by_peak
+    contact_volume : None | float | 'auto'
+        If given, components larger than the expected number of voxels in
+        a contact are split with split_merged_components
+    sampling : None | 3-tuple(float)
+        The relative size of a voxel along each axis, used when splitting
+    return_features : bool
+        If true, also return the feature table of the components
+    return_label_map : bool
+        If true, also return the LabelMap of the components
+
+    Returns
+    -------
+    centroids : List(3-tuple)
+        The rounded centroid of each component
+    features : np.ndarray with dtype component_dtype
+        The feature table, in the same order as the centroids. Only
+        returned if return_features is true.
+    label_map : LabelMap
+        The label of every voxel of the components, in the same order as
+        the centroids. Only returned if return_label_map is true.
+    '''
+    if seed_threshold is not None:
+        keep, labels, nr_components = filter_components_by_peak(values,
+            labels, nr_components, seed_threshold)
+        coords, values = coords[keep], values[keep]
+    if contact_volume is not None:
+        labels, nr_components = split_merged_components(coords, labels,
+            nr_components, contact_volume, sampling=sampling)
+
+    return _component_results(coords, values, labels, nr_components,
+        return_features=return_features, return_label_map=return_label_map)
+
+#######################################
+# parallel slab labeling with seam merge
+#######################################
+
+#the image shared with the slab labeling workers. It is set in the parent
+#before the pool is created, so the forked workers inherit the already
+#loaded image without copying it
+_shared_image = {}
+
+def _label_slab(args):
+    '''
+    Threshold, erode and label slices z0 through z1 of the shared image,
+    in a worker process. Returns the surviving voxels and their labels,
+    which are local to the slab.
+    '''
+    z0, z1, threshold, use_erosion, structure, connectivity = args
+    image = _shared_image['image']
+
+    halo = 1 if use_erosion else 0
+    lo = max(z0 - halo, 0)
+    hi = min(z1 + halo, image.shape[2])
+    slab = image[:, :, lo:hi]
+
+    mask = slab > threshold
+    if use_erosion:
+        mask = ndimage.binary_erosion(mask, structure=structure)
+    mask = mask[:, :, z0-lo:z1-lo]
+
+    labels, nr_components = label_components(mask,
+        connectivity=connectivity)
+
+    x, y, z = np.nonzero(labels)
+    coords = np.transpose((x, y, z + z0)).astype(np.int32)
+    return coords, slab[x, y, z + z0 - lo], labels[x, y, z], nr_components
+
+def merge_labels(labels_a, labels_b, nr_labels):
+    '''
+    Merge labels that are joined across a slab seam, by finding the
+    connected components of the graph of joined labels.
+
+    Parameters
+    ----------
+    labels_a, labels_b : np.ndarray
+        Pairs of labels from 0..nr_labels-1 that belong to the same
+        component
+    nr_labels : int
+        The total number of labels
+
+    Returns
+    -------
+    roots : nr_labels np.ndarray
+        The smallest label of the merged component of each label
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    labels_a = np.asarray(labels_a, dtype=np.intp)
+    labels_b = np.asarray(labels_b, dtype=np.intp)
+    graph = coo_matrix((np.ones(len(labels_a), dtype=np.int8),
+        (labels_a, labels_b)), shape=(nr_labels, nr_labels))
+    _, merged = connected_components(graph, directed=False)
+
+    #labels are visited in increasing order, so the first label of each
+    #merged component is its smallest
+    _, first = np.unique(merged, return_index=True)
+    return first[merged]
+
+def isolate_components_in_parallel(image, threshold, use_erosion=True,
+    structure=None, connectivity=26, nr_workers=2, nr_slabs=None,
+    seed_threshold=None, contact_volume=None, sampling=None,
+    return_features=False, return_label_map=False):
+    '''
+    Threshold, erode and label an image in axial slabs on a pool of worker
+    processes, and merge the components that cross the slab seams.
+
+    The workers are forked after the image is loaded, so they read their
+    slabs from the parent's image without copying it. This needs the fork
+    start method of multiprocessing, the default on linux and OS X. Each
+    worker labels its slab independently, and then components with
+    neighboring voxels on either side of a seam are merged with
+    merge_labels. The voxels are put back in
+    raster order before the features are calculated, so the result is
+    identical to thresholding and eroding the entire image and calling
+    isolate_components.
+
+    Parameters
+    ----------
+    image : 3D np.ndarray
+        The CT image, before thresholding
+    threshold : float
+        Voxels strictly above this value are kept
+    use_erosion : bool
+        If true, apply binary erosion to the thresholded image
+    structure : None | 3x3x3 np.ndarray
+        The erosion kernel. If None, the 6-connected kernel is used.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+    nr_workers : int
+        The number of worker processes
+    nr_slabs : None | int
+        The number of slabs to split the image into. If None, one slab is
+        used per worker.
+    seed_threshold : None | float
+        If given, only the components with a voxel strictly brighter than
+        this are kept, with filter_components_by_peak. The threshold is
+        then the low threshold of hysteresis thresholding.
+    contact_volume : None | float | 'auto'
+        If given, components larger than the expected number of voxels in
+        a contact are split with split_merged_components
+    sampling : None | 3-tuple(float)
+        The relative size of a voxel along each axis, used when splitting
+    return_features : bool
+        If true, also return the feature table of the components
+    return_label_map : bool
+        If true, also return the LabelMap of the components
+
+    Returns
+    -------
+    centroids : List(3-tuple)
+        The rounded centroid of each component, in raster order of the first
+        voxel of each component
+    features : np.ndarray with dtype component_dtype
+        The feature table, in the same order as the centroids. Only
+        returned if return_features is true.
+    label_map : LabelMap
+        The label of every voxel of the components, in the same order as
+        the centroids. Only returned if return_label_map is true.
+    '''
+    import multiprocessing
+
+    image = np.asarray(image)
+    shape = image.shape
+
+    if nr_slabs is None:
+        nr_slabs = nr_workers
+    nr_slabs = max(1, min(nr_slabs, shape[2]))
+    bounds = np.linspace(0, shape[2], nr_slabs+1).astype(int)
+
+    jobs = [(z0, z1, threshold, use_erosion, structure, connectivity)
+        for z0, z1 in zip(bounds[:-1], bounds[1:])]
+
+    _shared_image['image'] = image
+    try:
+        pool = multiprocessing.Pool(nr_workers)
+        try:
+            slabs = pool.map(_label_slab, jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _shared_image.clear()
+
+    #give every slab its own range of labels, from 0
+    offsets = np.cumsum([0] + [n for _, _, _, n in slabs])
+    nr_labels = offsets[-1]
+
+    coords = np.concatenate([c for c, _, _, _ in slabs]).astype(np.intp)
+    values = np.concatenate([v for _, v, _, _ in slabs])
+    labels = np.concatenate([l - 1 + off for (_, _, l, _), off in
+        zip(slabs, offsets)])
+
+    order = np.argsort(np.ravel_multi_index(coords.T, shape),
+        kind='mergesort')
+    coords = coords[order]
+    values = values[order]
+    labels = labels[order]
+
+    #only voxels on either side of a seam can join components across it
+    seams = bounds[1:-1]
+    seam, = np.nonzero(np.in1d(coords[:, 2], seams) |
+        np.in1d(coords[:, 2], seams - 1))
+    rows, cols = sparse_neighbor_pairs(coords[seam], shape,
+        connectivity=connectivity)
+    roots = merge_labels(labels[seam[rows]], labels[seam[cols]], nr_labels)
+
+    merged, raw_labels = np.unique(roots[labels], return_inverse=True)
+    nr_components = len(merged)
+    labels = raster_order_labels(raw_labels, nr_components)
+    if seed_threshold is not None:
+        keep, labels, nr_components = filter_components_by_peak(values,
+            labels, nr_components, seed_threshold)
+        coords, values = coords[keep], values[keep]
+    if contact_volume is not None:
+        labels, nr_components = split_merged_components(coords, labels,
+            nr_components, contact_volume, sampling=sampling)
+
+    return _component_results(coords, values, labels, nr_components,
+        return_features=return_features, return_label_map=return_label_map)
+
+#########################################
+# component tree for threshold scrubbing
+#########################################
+
+def levels_by_slabs(dataobj, min_level, use_erosion=True, slab_size=32):
+    '''
+    Calculate the threshold level of every voxel, one slab at a time.
+
+    The level of a voxel is the highest threshold at which it survives
+    thresholding and erosion. Without erosion this is just its intensity.
+    With erosion it is the minimum intensity in its 6-connected
+    neighborhood, since binary erosion of (image > T) is the same as
+    thresholding the grey level erosion of the image at T.
+
+    Parameters
+    ----------
+    dataobj : 3D array-like
+        The image, typically the dataobj of a memory mapped nibabel image
+    min_level : float
+        Only voxels with a level strictly above this value are kept
+    use_erosion : bool
+        If true, account for binary erosion with the 6-connected kernel
+    slab_size : int
+        The number of slices to read at a time
+
+    Returns
+    -------
+    coords : Nx3 np.ndarray
+        The voxel coordinates of the kept voxels, in raster order
+    values : N np.ndarray
+        The image intensities at these voxels
+    levels : N np.ndarray
+        The threshold level of these voxels
+    '''
+    halo = 1 if use_erosion else 0
+
+    coords = []
+    values = []
+    levels = []
+
+    for z0, z1, lo, slab in iter_slabs(dataobj, slab_size=slab_size,
+            halo=halo):
+        core = slab[:, :, z0-lo:z1-lo]
+
+        if use_erosion:
+            level = ndimage.minimum_filter(slab.astype(np.float64),
+                footprint=connectivity_structure(6), mode='constant',
+                cval=-np.inf)[:, :, z0-lo:z1-lo]
+        else:
+            level = core
+
+        x, y, z = np.nonzero(level > min_level)
+        coords.append(np.transpose((x, y, z + z0)))
+        values.append(core[x, y, z])
+        levels.append(level[x, y, z])
+
+    coords = np.concatenate(coords).astype(np.intp)
+    order = np.argsort(np.ravel_multi_index(coords.T, dataobj.shape))
+
+    return (coords[order], np.concatenate(values)[order],
+        np.concatenate(levels)[order])
+
+class ComponentTree():
+    '''
+    A component tree over the threshold levels of a CT image, which answers
+    which electrode clusters are found at any threshold without extracting
+    them again.
+
+    The tree is stored as the maximum spanning forest of the voxel adjacency
+    graph, where each edge is weighted by the level at which its two voxels
+    become connected. Cutting the forest at threshold T gives exactly the
+    connected components of the image thresholded at T. Voxels and edges are
+    sorted by decreasing level, so the voxels and edges present at any
+    threshold are a prefix of each list.
+
+    coords : Nx3 np.ndarray
+        The voxel coordinates, in raster order
+    values : N np.ndarray
+        The image intensity at each voxel
+    levels : N np.ndarray
+        The threshold level of each voxel, as returned by levels_by_slabs
+    shape : 3-tuple
+        The shape of the volume that the coordinates lie in
+    min_threshold : float
+        The lowest threshold that can be queried. All voxels must have a
+        level strictly above it.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join neighboring voxels
+    '''
+
+    def __init__(self, coords, values, levels, shape, min_threshold,
+            connectivity=26):
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import minimum_spanning_tree
+
+        self.shape = shape
+        self.min_threshold = min_threshold
+        self.connectivity = connectivity
+
+        nr_voxels = len(coords)
+
+        rows, cols = sparse_neighbor_pairs(coords, shape,
+            connectivity=connectivity)
+        edge_levels = np.minimum(levels[rows], levels[cols])
+
+        #zero weights mean no edge, so the weights must be strictly positive
+        top = np.max(levels) if nr_voxels else 0
+        graph = coo_matrix((top - edge_levels + 1, (rows, cols)),
+            shape=(nr_voxels, nr_voxels))
+        forest = minimum_spanning_tree(graph.tocsr()).tocoo()
+
+        order = np.argsort(-levels, kind='mergesort')
+        rank = np.empty(nr_voxels, dtype=np.intp)
+        rank[order] = np.arange(nr_voxels)
+
+        self.coords = coords[order]
+        self.values = values[order].astype(np.float64)
+        self.levels = levels[order]
+        self.raster_index = np.ravel_multi_index(coords[order].T, shape)
+
+        forest_levels = np.minimum(levels[forest.row], levels[forest.col])
+        edge_order = np.argsort(-forest_levels, kind='mergesort')
+        self.edge_levels = forest_levels[edge_order]
+        self.edges = np.transpose((rank[forest.row[edge_order]],
+            rank[forest.col[edge_order]]))
+
+        #searchsorted needs ascending order
+        self._neg_levels = -self.levels
+        self._neg_edge_levels = -self.edge_levels
+
+    def _prefix(self, threshold):
+        if threshold < self.min_threshold:
+            raise ValueError('The component tree was only built for '
+                'thresholds of at least %s' % self.min_threshold)
+        nr_voxels = np.searchsorted(self._neg_levels, -threshold)
+        nr_edges = np.searchsorted(self._neg_edge_levels, -threshold)
+        return nr_voxels, nr_edges
+
+    def count(self, threshold):
+        '''
+        Return the number of components at the given threshold. A forest
+        has one component per voxel, less one for each edge.
+        '''
+        nr_voxels, nr_edges = self._prefix(threshold)
+        return nr_voxels - nr_edges
+
+    def centroids(self, threshold, return_features=False):
+        '''
+        Return the electrode centroids found at the given threshold.
+
+        Parameters
+        ----------
+        threshold : float
+            The threshold, which must be at least min_threshold
+        return_features : bool
+            If true, also return the feature table of the components
+
+        Returns
+        -------
+        centroids : List(3-tuple)
+            The rounded centroid of each component, in the same order as
+            identify_electrodes_in_ctspace returns them
+        features : np.ndarray with dtype component_dtype
+            The feature table, in the same order as the centroids. Only
+            returned if return_features is true.
+        '''
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        nr_voxels, nr_edges = self._prefix(threshold)
+        rows, cols = self.edges[:nr_edges].T
+        graph = coo_matrix((np.ones(nr_edges, dtype=np.int8), (rows, cols)),
+            shape=(nr_voxels, nr_voxels))
+        nr_components, raw_labels = connected_components(graph,
+            directed=False)
+
+        raster = np.argsort(self.raster_index[:nr_voxels])
+        labels = raster_order_labels(raw_labels[raster], nr_components)
+
+        features = component_features(self.coords[raster],
+            self.values[raster], labels, nr_components)
+        centroids = map(tuple, round_coords(features['centroid']))
+
+        if return_features:
+            return centroids, features
+        return centroids
+
+#############################################
+# intensity histogram and threshold suggestion
+#############################################
+
+class IntensityHistogram():
+    '''
+    A histogram of image intensities with fixed width bins, which grows to
+    fit the values added to it, so that it can be accumulated one slab at a
+    time without knowing the intensity range in advance.
+
+    bin_width : float
+        The width of each bin, in intensity units. The default of 1 gives an
+        exact histogram of integer CT images.
+    '''
+
+    def __init__(self, bin_width=1.):
+        self.bin_width = bin_width
+        self.first_bin = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.nr_values = 0
+        self.total = 0.
+        self.total_sq = 0.
+
+    def add(self, values):
+        '''
+        Add the finite values of an array to the histogram.
+        '''
+        values = np.ravel(values)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+
+        self.nr_values += len(values)
+        self.total += np.sum(values, dtype=np.float64)
+        self.total_sq += np.sum(np.square(values, dtype=np.float64))
+
+        bins = np.floor(values / self.bin_width).astype(np.int64)
+        lo, hi = np.min(bins), np.max(bins)
+        if len(self.counts) == 0:
+            self.first_bin = lo
+        if lo < self.first_bin:
+            self.counts = np.concatenate((np.zeros(self.first_bin - lo,
+                dtype=np.int64), self.counts))
+            self.first_bin = lo
+        if hi >= self.first_bin + len(self.counts):
+            self.counts = np.concatenate((self.counts, np.zeros(
+                hi - self.first_bin - len(self.counts) + 1, dtype=np.int64)))
+
+        self.counts += np.bincount(bins - self.first_bin,
+            minlength=len(self.counts))
+
+    def edges(self):
+        '''
+        Return the len(counts)+1 bin edges.
+        '''
+        return (self.first_bin + np.arange(len(self.counts) + 1)
+            ) * self.bin_width
+
+    def mean(self):
+        return self.total / self.nr_values
+
+    def std(self):
+        return np.sqrt(max(self.total_sq / self.nr_values - self.mean()**2,
+            0))
+
+    def percentile(self, q):
+        '''
+        Return the intensity below which q percent of the values lie,
+        interpolating linearly within a bin.
+        '''
+        target = q / 100 * self.nr_values
+        cumulative = np.cumsum(self.counts)
+        i = min(np.searchsorted(cumulative, target), len(self.counts) - 1)
+        before = cumulative[i] - self.counts[i]
+        frac = (target - before) / self.counts[i] if self.counts[i] else 0
+        return (self.first_bin + i + frac) * self.bin_width
+
+    def intensity_above(self, nr_values):
+        '''
+        Return the lowest intensity with at most nr_values values above it.
+        '''
+        return self.percentile(100 * max(1 - nr_values / self.nr_values, 0))
+
+    def metal_mode(self, floor, smoothing=25.):
+        '''
+        Return the most common intensity above the floor, after smoothing
+        the histogram, which for a CT image with electrodes in it is the
+        typical intensity of metal.
+
+        Parameters
+        ----------
+        floor : float
+            Only intensities above this value are considered, typically a
+            high percentile that excludes soft tissue and most of the bone
+        smoothing : float
+            The width of the moving average applied to the histogram, in
+            intensity units
+
+        Returns
+        -------
+        mode : float | None
+            The center of the most populated bin above the floor. If the
+            histogram peaks right at the floor, there is no distinct peak of
+            metal intensities and None is returned.
+        '''
+        start = max(int(np.ceil(floor / self.bin_width)) - self.first_bin, 0)
+        if start >= len(self.counts) - 1:
+            return None
+
+        size = max(1, int(round(smoothing / self.bin_width)))
+        smoothed = ndimage.uniform_filter1d(
+            self.counts[start:].astype(np.float64), size, mode='nearest')
+        #a peak within one smoothing width of the floor is just the tail of
+        #the bone intensities
+        peak = np.argmax(smoothed)
+        if peak < size:
+            return None
+        return (self.first_bin + start + peak + .5) * self.bin_width
+
+def histogram_by_slabs(dataobj, bin_width=1., slab_size=32, crop=None):
+    '''
+    Accumulate the intensity histogram of an image one slab at a time, so
+    that only one slab is in memory at once.
+
+    Parameters
+    ----------
+    dataobj : 3D array-like
+        The image, typically the dataobj of a memory mapped nibabel image
+    bin_width : float
+        The width of each bin, in intensity units
+    slab_size : int
+        The number of slices to read at a time
+    crop : None | 3-tuple(slice)
+        If given, only count this subvolume, as in iter_slabs
+
+    Returns
+    -------
+    histogram : IntensityHistogram
+        The histogram of every voxel in the image
+    '''
+    histogram = IntensityHistogram(bin_width=bin_width)
+    for z0, z1, lo, slab in iter_slabs(dataobj, slab_size=slab_size, halo=0,
+            crop=crop):
+        histogram.add(slab)
+    return histogram
+
+def suggest_threshold(tree, nr_contacts, candidates, tolerance=2.):
+    '''
+    Pick a threshold at which the number of components is consistent with
+    the number of electrode contacts.
+
+    The number of components found at the right threshold is usually stable
+    over a range of thresholds, while noise in the bone makes it change
+    quickly. So the candidates are split into plateaus over which the number
+    of components changes by no more than 5 percent, and the longest
+    plateau whose number of components is within a factor of tolerance of
+    the number of contacts is picked.
+
+    Parameters
+    ----------
+    tree : ComponentTree
+        The component tree of the image, built with a min_threshold no
+        greater than the lowest candidate
+    nr_contacts : int
+        The number of electrode contacts expected in the image
+    candidates : np.ndarray
+        The thresholds to consider, in increasing order
+    tolerance : float
+        The largest factor by which the number of components may differ
+        from the number of contacts
+
+    Returns
+    -------
+    threshold : float
+        The middle candidate of the longest consistent plateau, or of the
+        plateau closest to the number of contacts if none is consistent. Ties
+        go to the plateau closest to the number of contacts.
+    counts : np.ndarray
+        The number of components at each candidate
+    '''
+    counts = np.array([tree.count(t) for t in candidates])
+
+    step = np.abs(np.diff(counts)) > np.maximum(1, .05 * counts[:-1])
+    plateau = np.concatenate(([0], np.cumsum(step)))
+
+    error = np.abs(counts - nr_contacts)
+    consistent = ((counts * tolerance >= nr_contacts) &
+        (counts <= nr_contacts * tolerance))
+    if not np.any(consistent):
+        consistent = error == np.min(error)
+
+    length = np.bincount(plateau[consistent], minlength=plateau[-1]+1)
+    #sort by length, then by the smallest error within the plateau
+    best_error = np.full(len(length), np.inf)
+    np.minimum.at(best_error, plateau[consistent], error[consistent])
+    best = np.lexsort((best_error, -length))[0]
+
+    members, = np.nonzero(consistent & (plateau == best))
+    return candidates[members[len(members) // 2]], counts
+
+##########################
+# reference implementation
+##########################
+
+class Component():
+    def __init__(self):
+        self.coor = []
+        self.intensity = []
+    def add(self, coor, intensity):
+        self.coor.append(coor)
+        self.intensity.append(intensity)
+    def center_of_mass(self):
+        M, Rx, Ry, Rz = 0,0,0,0
+        for r,m in zip(self.coor, self.intensity):
+            M+=m
+            Rx+=m*r[0]
+            Ry+=m*r[1]
+            Rz+=m*r[2]
+        return round(Rx/M), round(Ry/M), round(Rz/M)
+
+def isolate_components_bfs(image):
+    '''
+    The original pure python 26-neighbor breadth first search. It is slow
+    on large images, and is only kept as a reference implementation to check
+    and benchmark isolate_components against.
+    '''
+    from collections import deque
+    from itertools import product
+
+    offsets = [o for o in product((-1,0,1), repeat=3) if o != (0,0,0)]
+    im = image.copy()
+    sx, sy, sz = im.shape
+
+    clusters = []
+    for x,y,z in zip(*np.where(im)):
+        if im[x,y,z]==0:
+            continue
+
+        c = Component()
+        clusters.append(c)
+
+        queue = deque([(x,y,z)])
+        while queue:
+            cx, cy, cz = queue.popleft()
+
+            if not (0 <= cx < sx and 0 <= cy < sy and 0 <= cz < sz):
+                continue
+            if im[cx,cy,cz]==0:
+                continue
+
+            c.add((cx,cy,cz), im[cx,cy,cz])
+            im[cx,cy,cz]=0
+
+            for dx,dy,dz in offsets:
+                queue.append((cx+dx, cy+dy, cz+dz))
+
+    return [cluster.center_of_mass() for cluster in clusters]
@@ -112,19 +112,122 @@ def find_neighbors(p0, coords, n):
             ind.remove(ind[which_p])
         return ps
 
-def rm_pts(P, coords):
+def nearest_two_neighbors(coords):
+    '''
+    Find the two nearest neighbors of every point in coords, the same as
+    calling find_neighbors(p, coords, 2) for every point p, with a single
+    k-nearest neighbors query. Ties are broken in favor of the first point
+    in coords, as in find_nearest_pt.
+
+    With only three points, find_neighbors returns the point itself as the
+    second neighbor whenever it precedes the other remaining point, because
+    find_nearest_pt gives the point itself the distance of the farthest
+    point. Here the second neighbor is always the other point.
+
+    Returns two Nx3 arrays with the nearest and second nearest neighbor of
+    each point.
+    '''
+    n = coords.shape[0]
+    if n < 3:
+        raise ValueError('number of neighbors exceeds the total number of '
+            'points')
+
+    from scipy.spatial import cKDTree
+
+    k = min(n, 8)
+    _, ix = cKDTree(coords).query(coords, k)
+    d = np.sum((coords[ix] - coords[:, np.newaxis])**2, axis=2)
+
+    #exclude one point at distance 0, which is the point itself or a copy
+    rows = np.arange(n)
+    d[rows, np.argmin(d, axis=1)] = np.inf
+
+    order = np.lexsort((ix, d))
+    ix = ix[rows[:, np.newaxis], order]
+    d = d[rows[:, np.newaxis], order]
+    p1 = coords[ix[:, 0]]
+    p2 = coords[ix[:, 1]]
+
+    #a point beyond the queried neighbors could be tied with the second
+    #neighbor, so these few points are searched exhaustively
+    if k < n:
+        for j in np.where(d[:, 1] >= d[:, k-2])[0]:
+            p1[j], p2[j] = find_neighbors(coords[j], coords, 2)
+
+    return p1, p2
+
+def corner_angles(p0, p1, p2):
+    '''
+    Compute the angle at every corner p0 between p1 and p2, for Nx3 arrays
+    of points, and the distances from p0 to p1 and to p2.
+    '''
+    v1 = p1 - p0
+    v2 = p2 - p0
+    d1 = np.sqrt(np.sum(v1**2, axis=1))
+    d2 = np.sqrt(np.sum(v2**2, axis=1))
+
+    #handle numeric floating point errors
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.clip(np.sum(v1*v2, axis=1)/(d1*d2), -1, 1)
+
+    return 180*np.arccos(x)/np.pi, d1, d2
+
+def index_points(coords):
+    '''
+    Hash a set of points by their exact coordinates. Returns a dictionary
+    mapping each distinct point, as a tuple, to the list of indices in
+    coords where it occurs, in increasing order.
+    '''
+    index = {}
+    for i, c in enumerate(np.reshape(coords, (-1,3))):
+        index.setdefault(tuple(c), []).append(i)
+    return index
+
+def rm_pts(P, coords, index=None):
     ''' 
     This function does not mutate its arguments. It returns a numpy view
-    of the set of points coords which does not contain the set of points P
+    of the set of points coords which does not contain the set of points P.
+    Only the first occurrence of each point of P in coords is removed.
+
+    The index of coords from index_points can be given to avoid hashing
+    coords again when removing points from the same set repeatedly.
     '''
-    ind = []
+    if index is None:
+        index = index_points(coords)
+
+    keep = np.ones(coords.shape[0], dtype=bool)
     for v in P:
-        x, = np.where(np.sum(np.apply_along_axis(np.equal, 1, coords, v), axis=1) == 3)
-        if len(x) > 0:
-            ind.append(x[0])
-    ind = np.setdiff1d(range(coords.shape[0]), ind)
+        ix = index.get(tuple(v))
+        if ix is not None:
+            keep[ix[0]] = False
     
-    return coords[ind, :]
+    return coords[keep, :]
+
+def match_nearest_neighbors(P, Q, max_distance=np.inf):
+    '''
+    Match two sets of points by mutual nearest neighbors. A point p in P and
+    a point q in Q are matched if q is the nearest point in Q to p, p is the
+    nearest point in P to q, and they are no more than max_distance apart.
+
+    Returns the indices of the matched points in P, the indices of the
+    points they are matched to in Q, and the displacements Q - P.
+    '''
+    from scipy.spatial import cKDTree
+
+    P = np.reshape(P, (-1, 3))
+    Q = np.reshape(Q, (-1, 3))
+    if len(P) == 0 or len(Q) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros((0, 3))
+
+    d_pq, nearest_q = cKDTree(Q).query(P)
+    _, nearest_p = cKDTree(P).query(Q)
+
+    p_ix, = np.where((nearest_p[nearest_q] == np.arange(len(P))) &
+        (d_pq <= max_distance))
+    q_ix = nearest_q[p_ix]
+
+    return p_ix, q_ix, Q[q_ix] - P[p_ix]
 
 ############################
 # compound utility functions
@@ -172,6 +275,20 @@ def binarize(W):
     W[W!=0]=1
     return W
 
+def window_sums(W, h, w):
+    '''
+    Sum the nonzero entries of W in every h by w window, from a summed area
+    table of binarize(W). Entry (i, j) of the result is the number of
+    nonzero entries of W[i:i+h, j:j+w].
+    '''
+    if h > W.shape[0] or w > W.shape[1]:
+        return np.zeros((max(W.shape[0]-h+1, 0), max(W.shape[1]-w+1, 0)),
+            dtype=int)
+
+    S = np.zeros((W.shape[0]+1, W.shape[1]+1), dtype=int)
+    S[1:, 1:] = np.cumsum(np.cumsum(W!=0, axis=0), axis=1)
+    return S[h:, w:] - S[:-h, w:] - S[h:, :-w] + S[:-h, :-w]
+
 def truncate(f, n):
     return math.floor(f*10**n)/10**n
 
@@ -1,23 +1,35 @@
 from __future__ import division
 import numpy as np
 from numpy.linalg import norm
-from geometry import (angle, is_parallel, is_perpend, within_distance, rm_pts,
-    find_nearest_pt, find_neighbors, binarize)
+from scipy.spatial import cKDTree
+from geometry import (angle, is_parallel, is_perpend, within_distance,
+    find_nearest_pt, index_points, nearest_two_neighbors, corner_angles,
+    window_sums)
 from utils import SortingLabelingError
 
-class GridPoint():
-    #this is just a class to make 3D arrays hashable
+class GridPoint(object):
+    #this is just a class to make 3D arrays hashable. the point is kept as a
+    #tuple of its exact coordinates, which is hashed and compared directly
+    #instead of formatting the array as a string on every lookup
+    __slots__ = ('key',)
 
     #def __init__(self, 3d_loc, 2d_loc):
         #self.2d_loc = 2d_loc
     def __init__(self, loc_3d):
-        self.loc_3d = np.array(loc_3d)
+        self.key = tuple(map(float, np.ravel(loc_3d)))
+
+    @property
+    def loc_3d(self):
+        return np.array(self.key)
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(self.key)
 
     def __eq__(self, other):
-        return np.all(self.loc_3d == other.loc_3d)
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
 
     def __str__(self):
         return str(self.loc_3d)
@@ -74,6 +86,14 @@ class Grid():
         #save the unfiltered set of all electrodes
         self.all_elecs = all_elecs
 
+        #maintain a spatial index over all electrodes, and a mask of the
+        #electrodes that have been used, so that the nearest available
+        #electrode is found without scanning every electrode
+        self._elecs = np.reshape(all_elecs, (-1, 3))
+        self._tree = cKDTree(self._elecs)
+        self._removed = np.zeros(len(self._elecs), dtype=bool)
+        self._index = index_points(self._elecs)
+
         #maintain a list of points (3D coordinates) that have been used so far
         #to easily calculate set of available points to draw from
         if is_line:
@@ -81,6 +101,9 @@ class Grid():
         else:
             self.points = [p0, p1, p2]
 
+        for p in self.points:
+            self._remove_point(p)
+
         #maintain an unsorted list of distances that have been created so far
         #to easily calculate the average distance
         self.distances = [norm(p0-p1)]
@@ -118,6 +141,13 @@ class Grid():
 
         self.marked = {}
 
+        #maintain the index in self.points of each 2D location, and the
+        #indices of the points whose local connectivity has changed since
+        #the frontier of the grid extension was last updated
+        self._point_index = dict((self.connectivity[GridPoint(p)], i)
+            for i, p in enumerate(self.points))
+        self._changed = []
+
         #define some constraint parameters 
         #self.delta = .35
 
@@ -174,20 +204,48 @@ class Grid():
 
         return graph
 
+    def _remove_point(self, p):
+        #mark the electrode at this point as used. points which are not
+        #electrodes, such as interpolated points, remove nothing
+        try:
+            self._removed[self._index[tuple(p)][0]] = True
+        except (KeyError, TypeError):
+            pass
+
     def remaining_points(self):
-        return rm_pts( self.points, self.all_elecs )
+        return self._elecs[~self._removed]
 
     def critdist(self):
         return np.mean(self.distances)
 
     def nearest(self, p0, allow_self=True):
-        try:
-            p,_ = find_nearest_pt(p0, self.remaining_points(), 
+        n = len(self._removed)
+        if np.all(self._removed):
+            return np.array((np.inf, np.inf, np.inf))
+
+        if not np.all(np.isfinite(p0)):
+            p,_ = find_nearest_pt(p0, self.remaining_points(),
                 allow_self=allow_self)
             return p
-        except (IndexError, ValueError):
-        #except IndexError:
-            return np.array((np.inf, np.inf, np.inf))
+
+        #query more neighbors until the nearest available electrode, and
+        #every electrode tied with it, is among them
+        k = min(8, n)
+        while True:
+            dists, ix = self._tree.query(p0, k)
+            dists, ix = np.atleast_1d(dists), np.atleast_1d(ix)
+            avail = ix[~self._removed[ix]]
+
+            if len(avail) > 0:
+                d = np.sum((self._elecs[avail] - p0)**2, axis=1)
+                if not allow_self and d.min() == 0 and len(avail) > 1:
+                    d[np.argmin(d)] = np.inf
+                if k == n or dists[-1] > np.sqrt(d.min()) + 1e-9:
+                    break
+            k = min(2*k, n)
+
+        #break ties in favor of the first electrode, like find_nearest_pt
+        return self._elecs[np.min(avail[d == d.min()])]
 
     def add_point(self, pJ, coord_2d=None):
         if coord_2d is None:
@@ -195,25 +253,30 @@ class Grid():
 
         #update the set of all 3D coordinates for easy removal of coordinates
         self.points.append(pJ)
+        self._remove_point(pJ)
 
         #update the set of distances for easy calculation of the average distance
+        #and note the points whose local connectivity has changed
         x,y = coord_2d
         i=0
         for coord in ((x,y+1), (x+1,y), (x,y-1), (x-1,y)):
             p = self.get_3d_point(coord)
             if p is not None:
                 self.distances.append( norm(pJ - p) )
+                self._changed.append(self._point_index[coord])
                 i+=1
         if i==0:
             raise ValueError("Internal error: No distances were added")
 
         #update the connectivity dictionary with the proper 2D coordinate
         p = GridPoint( pJ ) 
-        if p in self.connectivity.keys():
+        if p in self.connectivity:
             print self
             raise ValueError("Tried to reproduce an existing 2D grid point")
         self.connectivity[p] = coord_2d
         self.reverse_connectivity[coord_2d] = pJ
+        self._point_index[coord_2d] = len(self.points) - 1
+        self._changed.append(len(self.points) - 1)
 
     def get_3d_point(self, coord_2d):
         try:
@@ -436,15 +499,43 @@ class Grid():
         return (distance_cond and angle_cond and parallel_cond)
 
     def extend_grid_arbitrarily(self):
-        points = []
-        while len(self.points) != len(points):
-            for point in map(GridPoint, self.points):
-
-                if point not in points:
-                    points.append(point)
-
-            self.extend_grid_systematically()
-            print 'started with %i points, now has %i' % (len(points), len(self.points))
+        '''
+        extends the grid until no point can be extended further. this gives
+        the same grid as calling extend_grid_systematically until no points
+        are added, but each pass only visits the frontier of points whose
+        local connectivity has changed since they were last examined, or
+        which added points when they were last examined
+        '''
+        import heapq
+
+        #the frontier of this pass, in order of the points in self.points,
+        #and of the next pass for points before the current point
+        frontier = range(len(self.points))
+        next_frontier = []
+        queued = set(frontier)
+        del self._changed[:]
+
+        while True:
+            nr_points = len(self.points)
+            while frontier:
+                i = heapq.heappop(frontier)
+                queued.discard(i)
+
+                if self.extend_from_point(self.points[i]):
+                    self._changed.append(i)
+
+                for j in self._changed:
+                    if j not in queued:
+                        queued.add(j)
+                        heapq.heappush(next_frontier if j <= i else frontier,
+                            j)
+                del self._changed[:]
+
+            print 'started with %i points, now has %i' % (nr_points,
+                len(self.points))
+            if len(self.points) == nr_points:
+                break
+            frontier, next_frontier = next_frontier, []
 
     def recreate_geometry(self):
         '''
@@ -470,175 +561,188 @@ class Grid():
         in the plane
         '''
         for p0 in self.points:
-            pts_added = False
+            self.extend_from_point(p0)
 
-            local_connectivity, orient = self.get_local_connectivity_3d(p0)
+        del self._changed[:]
 
-            if local_connectivity in ('FULL', 'SINGLETON'):
-                continue
+    def extend_from_point(self, p0):
+        '''
+        tries to extend the grid in all directions in the plane from the point
+        p0. returns true if any points were added. points that are fully
+        connected, or that were already examined with the same local
+        connectivity without adding any points, are skipped
+        '''
+        pts_added = False
 
-            x,y = self.connectivity[GridPoint(p0)]
-        
-            if self.is_marked((x,y), local_connectivity):
-                continue
+        local_connectivity, orient = self.get_local_connectivity_3d(p0)
 
-            p1 = self.get_3d_point( (
-                x-int(orient=='west')+int(orient=='east'),
-                y+int(orient=='north')-int(orient=='south') ))
-                
-            if local_connectivity == 'MOTIF':
-                #check to extend the motif in both directions
-                p2 = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
-                pJa = self.nearest( 2*p0-p2 )
-                pJa_coord = self.ccw_point(orient, p1, nr_rot=3)
-                if self.fits_cross_motif(pJa, p0, p1, p2):
-                    self.add_point(pJa, pJa_coord)
+        if local_connectivity in ('FULL', 'SINGLETON'):
+            return False
+
+        x,y = self.connectivity[GridPoint(p0)]
+    
+        if self.is_marked((x,y), local_connectivity):
+            return False
+
+        p1 = self.get_3d_point( (
+            x-int(orient=='west')+int(orient=='east'),
+            y+int(orient=='north')-int(orient=='south') ))
+            
+        if local_connectivity == 'MOTIF':
+            #check to extend the motif in both directions
+            p2 = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
+            pJa = self.nearest( 2*p0-p2 )
+            pJa_coord = self.ccw_point(orient, p1, nr_rot=3)
+            if self.fits_cross_motif(pJa, p0, p1, p2):
+                self.add_point(pJa, pJa_coord)
+                pts_added = True
+
+            pJb = self.nearest( 2*p0-p1 )
+            pJb_coord = self.ccw_point(orient, p1, nr_rot=2)
+            if self.fits_cross_motif(pJb, p0, p2, p1):
+                self.add_point(pJb, pJb_coord)
+                pts_added = True
+
+        if local_connectivity == 'TSHAPE':
+            # figure out which side of the T is not covered and extend to it using some combination of
+            # the two available motif extensions and the line extension
+
+            pA = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
+            pB = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=3) )
+
+            pJ = self.nearest( 2*p0 - p1 )
+            pJ_coord = self.ccw_point(orient, p1, nr_rot=2)
+
+            line_cond = self.fits_line( pJ, p0, p1 )
+            left_motif_cond = self.fits_cross_motif( pJ, p0, pA, p1 )
+            right_motif_cond = self.fits_cross_motif( pJ, p0, pB, p1 )
+
+            if (line_cond + left_motif_cond + right_motif_cond >= 2):
+                self.add_point(pJ, pJ_coord)
+                pts_added = True
+
+        if local_connectivity == 'LEAF':
+            # do the line extension 
+            pL = self.nearest( 2*p0-p1 )
+            pL_coord = self.ccw_point(orient, p1, nr_rot=2)
+            if self.fits_line( pL, p0, p1 ):
+                self.add_point(pL, pL_coord) 
+                pts_added = True
+
+            # check for corner extension
+            opp_orient = self.ccw_orientation(orient, nr_rot=2)
+            pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
+            pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
+
+            pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=3 ))
+            if pSa is not None:
+                pCa = self.nearest( p0+pSa-p1 )
+                if self.fits_corner( pCa, p1, p0, pSa):
+                    self.add_point(pCa, pCa_coord)
+                    pts_added = True
+            pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=1 ))
+            if pSb is not None:
+                pCb = self.nearest( p0+pSb-p1 )
+                if self.fits_corner( pCb, p1, p0, pSb):
+                    self.add_point(pCb, pCb_coord) 
                     pts_added = True
 
-                pJb = self.nearest( 2*p0-p1 )
-                pJb_coord = self.ccw_point(orient, p1, nr_rot=2)
-                if self.fits_cross_motif(pJb, p0, p2, p1):
-                    self.add_point(pJb, pJb_coord)
+            # check for parallel extension
+            pX = self.get_3d_point( self.ccw_point( opp_orient, p0,  
+                nr_rot=2))
+            pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=3))
+            if pZa is not None and pX is not None:
+                pIa = self.nearest( p0+pZa-pX )
+                if self.fits_parallel( pIa, p0, p1, pX, pZa):
+                    self.add_point(pIa, pCa_coord) 
+                    pts_added = True
+            pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=1))
+            if pZb is not None and pX is not None:
+                pIb = self.nearest( p0+pZb-pX )
+                if self.fits_parallel( pIb, p0, p1, pX, pZb):
+                    self.add_point(pIb, pCb_coord)
                     pts_added = True
 
-            if local_connectivity == 'TSHAPE':
-                # figure out which side of the T is not covered and extend to it using some combination of
-                # the two available motif extensions and the line extension
+        if local_connectivity == 'LINE':
+
+            p2 = self.get_3d_point( self.ccw_point( orient, p1, nr_rot=2))
+            pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
+            pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
+            opp_orient = self.ccw_orientation(orient, nr_rot=2)
+
+            pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=3 ))
+            pSd = self.get_3d_point( self.ccw_point( orient, p0, 
+                nr_rot=1 ))
+
+            if pSa is not None or pSd is not None: 
+                pCa = (self.nearest(p0+pSa-p1) if pSa is not None else 
+                    self.nearest(p0+pSd-p2))
+                corner_1 = self.fits_corner(pCa, p1, pSa, p0)
+                corner_2 = self.fits_corner(pCa, p2, pSd, p0)
+                if corner_1 or corner_2:
+                    self.add_point(pCa, pCa_coord)
+                    pts_added = True
 
-                pA = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
-                pB = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=3) )
+            pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=1 ))
+            pSc = self.get_3d_point( self.ccw_point( orient, p0, 
+                nr_rot=3 ))
+
+            if pSb is not None or pSc is not None:
+                pCb = (self.nearest(p0+pSb-p1) if pSb is not None else
+                    self.nearest(p0+pSc-p2))
+                corner_1 = self.fits_corner(pCb, p1, pSb, p0)
+                corner_2 = self.fits_corner(pCb, p2, pSc, p0)
+                if corner_1 or corner_2:
+                    self.add_point(pCb, pCb_coord)
+                    pts_added = True
 
-                pJ = self.nearest( 2*p0 - p1 )
-                pJ_coord = self.ccw_point(orient, p1, nr_rot=2)
+            # check for parallel extension
+            pX = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=2))
+            pY = self.get_3d_point( self.ccw_point( orient, p0, nr_rot=2))
 
-                line_cond = self.fits_line( pJ, p0, p1 )
-                left_motif_cond = self.fits_cross_motif( pJ, p0, pA, p1 )
-                right_motif_cond = self.fits_cross_motif( pJ, p0, pB, p1 )
+            pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=3))
+            pZd = self.get_3d_point( self.ccw_point( orient, p2, 
+                nr_rot=1 ))
 
-                if (line_cond + left_motif_cond + right_motif_cond >= 2):
-                    self.add_point(pJ, pJ_coord)
+            if ((pZa is not None and pX is not None) or 
+                    (pZd is not None and pY is not None)):
+                if pX is not None and pZa is not None:
+                    pIa = self.nearest( p0+pZa-pX )
+                elif pY is not None and pZd is not None:
+                    pIa = self.nearest( p0+pZd-pY )
+                parallel_1 = self.fits_parallel(pIa, p0, p1, pX, pZa)
+                parallel_2 = self.fits_parallel(pIa, p0, p2, pY, pZd)
+                if parallel_1 or parallel_2:
+                    self.add_point(pIa, pCa_coord) 
                     pts_added = True
-
-            if local_connectivity == 'LEAF':
-                # do the line extension 
-                pL = self.nearest( 2*p0-p1 )
-                pL_coord = self.ccw_point(orient, p1, nr_rot=2)
-                if self.fits_line( pL, p0, p1 ):
-                    self.add_point(pL, pL_coord) 
+            pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=1))
+            pZc = self.get_3d_point( self.ccw_point( orient, p2, 
+                nr_rot=3 ))
+            if ((pZb is not None and pX is not None) or 
+                    (pZc is not None and pY is not None)):
+                if pX is not None and pZb is not None:
+                    pIb = self.nearest( p0+pZb-pX )
+                elif pY is not None and pZc is not None:
+                    pIb = self.nearest( p0+pZc-pY )
+                parallel_1 = self.fits_parallel(pIb, p0, p1, pX, pZb)
+                parallel_2 = self.fits_parallel(pIb, p0, p2, pY, pZc)
+                if parallel_1 or parallel_2:
+                    self.add_point(pIb, pCb_coord)
                     pts_added = True
 
-                # check for corner extension
-                opp_orient = self.ccw_orientation(orient, nr_rot=2)
-                pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
-                pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
-
-                pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=3 ))
-                if pSa is not None:
-                    pCa = self.nearest( p0+pSa-p1 )
-                    if self.fits_corner( pCa, p1, p0, pSa):
-                        self.add_point(pCa, pCa_coord)
-                        pts_added = True
-                pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=1 ))
-                if pSb is not None:
-                    pCb = self.nearest( p0+pSb-p1 )
-                    if self.fits_corner( pCb, p1, p0, pSb):
-                        self.add_point(pCb, pCb_coord) 
-                        pts_added = True
-
-                # check for parallel extension
-                pX = self.get_3d_point( self.ccw_point( opp_orient, p0,  
-                    nr_rot=2))
-                pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=3))
-                if pZa is not None and pX is not None:
-                    pIa = self.nearest( p0+pZa-pX )
-                    if self.fits_parallel( pIa, p0, p1, pX, pZa):
-                        self.add_point(pIa, pCa_coord) 
-                        pts_added = True
-                pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=1))
-                if pZb is not None and pX is not None:
-                    pIb = self.nearest( p0+pZb-pX )
-                    if self.fits_parallel( pIb, p0, p1, pX, pZb):
-                        self.add_point(pIb, pCb_coord)
-                        pts_added = True
-
-            if local_connectivity == 'LINE':
-
-                p2 = self.get_3d_point( self.ccw_point( orient, p1, nr_rot=2))
-                pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
-                pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
-                opp_orient = self.ccw_orientation(orient, nr_rot=2)
-
-                pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=3 ))
-                pSd = self.get_3d_point( self.ccw_point( orient, p0, 
-                    nr_rot=1 ))
-
-                if pSa is not None or pSd is not None: 
-                    pCa = (self.nearest(p0+pSa-p1) if pSa is not None else 
-                        self.nearest(p0+pSd-p2))
-                    corner_1 = self.fits_corner(pCa, p1, pSa, p0)
-                    corner_2 = self.fits_corner(pCa, p2, pSd, p0)
-                    if corner_1 or corner_2:
-                        self.add_point(pCa, pCa_coord)
-                        pts_added = True
-
-                pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=1 ))
-                pSc = self.get_3d_point( self.ccw_point( orient, p0, 
-                    nr_rot=3 ))
-
-                if pSb is not None or pSc is not None:
-                    pCb = (self.nearest(p0+pSb-p1) if pSb is not None else
-                        self.nearest(p0+pSc-p2))
-                    corner_1 = self.fits_corner(pCb, p1, pSb, p0)
-                    corner_2 = self.fits_corner(pCb, p2, pSc, p0)
-                    if corner_1 or corner_2:
-                        self.add_point(pCb, pCb_coord)
-                        pts_added = True
-
-                # check for parallel extension
-                pX = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=2))
-                pY = self.get_3d_point( self.ccw_point( orient, p0, nr_rot=2))
-
-                pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=3))
-                pZd = self.get_3d_point( self.ccw_point( orient, p2, 
-                    nr_rot=1 ))
-
-                if ((pZa is not None and pX is not None) or 
-                        (pZd is not None and pY is not None)):
-                    if pX is not None and pZa is not None:
-                        pIa = self.nearest( p0+pZa-pX )
-                    elif pY is not None and pZd is not None:
-                        pIa = self.nearest( p0+pZd-pY )
-                    parallel_1 = self.fits_parallel(pIa, p0, p1, pX, pZa)
-                    parallel_2 = self.fits_parallel(pIa, p0, p2, pY, pZd)
-                    if parallel_1 or parallel_2:
-                        self.add_point(pIa, pCa_coord) 
-                        pts_added = True
-                pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=1))
-                pZc = self.get_3d_point( self.ccw_point( orient, p2, 
-                    nr_rot=3 ))
-                if ((pZb is not None and pX is not None) or 
-                        (pZc is not None and pY is not None)):
-                    if pX is not None and pZb is not None:
-                        pIb = self.nearest( p0+pZb-pX )
-                    elif pY is not None and pZc is not None:
-                        pIb = self.nearest( p0+pZc-pY )
-                    parallel_1 = self.fits_parallel(pIb, p0, p1, pX, pZb)
-                    parallel_2 = self.fits_parallel(pIb, p0, p2, pY, pZc)
-                    if parallel_1 or parallel_2:
-                        self.add_point(pIb, pCb_coord)
-                        pts_added = True
-
-            if not pts_added:
-                self.marked[(x,y)] = local_connectivity
+        if not pts_added:
+            self.marked[(x,y)] = local_connectivity
+
+        return pts_added
 
     def extract_strip(self, N, M):
         '''
@@ -742,181 +846,227 @@ class Grid():
         #best_loc = None
         best_loc = potential_strip_locs[0]
 
-        origin = v,w = zip(*np.where(graph==2))[0]
-
         #set the critical distance before we start adding points
         critdist = self.critdist()
 
-        for r,c,orient in potential_strip_locs:
-
-            cur_penalty = 0
-            cur_points = []
-            interpolated_points = []
-            interpolated_gridpoints = []
-            #total_points = 0
+        origin = zip(*np.where(graph==2))[0]
 
-            strip_graph = (graph[r:r+N,c:c+M] if orient=='horiz' else 
-                graph[c:c+M, r:r+N])
+        strips = [self.interpolate_strip(r, c, orient, M, N, graph, origin)
+            for r,c,orient in potential_strip_locs]
+        penalties = self.strip_penalties(strips, critdist)
 
-            for x,y in zip(*np.where(strip_graph)):
-                #print "Added the existing point (%i,%i)"%(x+r-v,y+c-w)
-                #print ("Added the existing point "
-                #    "(%i,%i) which is %s"%(x+c-v,y+r-w,
-                #    None if self.get_3d_point((x+c-v, y+r-w)) is None 
-                #    else 'not None')
-                cur_points.append(self.get_3d_point( (x+r-v, y+c-w) if 
-                    orient=='horiz' else (x+c-v, y+r-w) ))
-                #total_points += 1
-
-            print 'starting disambiguation with %i points'%(len(cur_points))
+        #update the winner, the first strip with the lowest penalty
+        for loc, (cur_points, interpolated_points), cur_penalty in zip(
+                potential_strip_locs, strips, penalties):
+            if cur_penalty < best_penalty:
+                best_penalty = cur_penalty
+                best_points = cur_points
+                best_points.extend(interpolated_points)
+                best_loc = loc
+            
+        return best_loc, best_points 
 
-            iter = 0
-            while len(interpolated_points) < M*N - len(cur_points):
-            #for iter in xrange(M*N):
-                iter += 1
-                if iter > M*N:
-                    raise ValueError("Infinite loop")
-                for x,y in zip(*np.where(strip_graph==0)):
+    def interpolate_strip(self, r, c, orient, M, N, graph, origin):
+        '''
+        interpolate the missing points of the strip at the location (r,c) 
+        with the given orientation, adding them to the grid. origin is the
+        location of the grid origin in the graph.
 
-                    i = x+r-v if orient=='horiz' else x+c-v
-                    j = y+c-w if orient=='horiz' else y+r-w
+        returns the existing points in the strip and the interpolated points
+        '''
+        v,w = origin
+
+        cur_points = []
+        interpolated_points = []
+        interpolated_gridpoints = []
+        #total_points = 0
+
+        strip_graph = (graph[r:r+N,c:c+M] if orient=='horiz' else 
+            graph[c:c+M, r:r+N])
+
+        for x,y in zip(*np.where(strip_graph)):
+            #print "Added the existing point (%i,%i)"%(x+r-v,y+c-w)
+            #print ("Added the existing point "
+            #    "(%i,%i) which is %s"%(x+c-v,y+r-w,
+            #    None if self.get_3d_point((x+c-v, y+r-w)) is None 
+            #    else 'not None')
+            cur_points.append(self.get_3d_point( (x+r-v, y+c-w) if 
+                orient=='horiz' else (x+c-v, y+r-w) ))
+            #total_points += 1
+
+        print 'starting disambiguation with %i points'%(len(cur_points))
+
+        iter = 0
+        while len(interpolated_points) < M*N - len(cur_points):
+        #for iter in xrange(M*N):
+            iter += 1
+            if iter > M*N:
+                raise ValueError("Infinite loop")
+            for x,y in zip(*np.where(strip_graph==0)):
+
+                i = x+r-v if orient=='horiz' else x+c-v
+                j = y+c-w if orient=='horiz' else y+r-w
+
+                if (i,j) in interpolated_gridpoints:
+                    continue
+
+                connectivity, orientation = (self.
+                    get_local_connectivity_2d( (i,j) ))
+
+                pN = self.get_3d_point( (i, j+1) ) 
+                pE = self.get_3d_point( (i+1, j) )
+                pS = self.get_3d_point( (i, j-1) )
+                pW = self.get_3d_point( (i-1, j) )
+
+                pNN = self.get_3d_point( (i, j+2) )
+                pEE = self.get_3d_point( (i+2, j) )
+                pSS = self.get_3d_point( (i, j-2) )
+                pWW = self.get_3d_point( (i-2, j) )
+
+                if connectivity == 'FULL':
+                    pInterp = (pN+pE+pS+pW)/4
+
+                elif connectivity=='TSHAPE':
+                    if orientation in ('north','south'):
+                        pInterp = (pE+pW)/2
+                    else:
+                        pInterp = (pN+pS)/2
 
-                    if (i,j) in interpolated_gridpoints:
+                elif connectivity=='LINE':
+                    if orientation in ('north','south'):
+                        pInterp = (pN+pS)/2
+                    else:
+                        pInterp = (pE+pW)/2
+
+                elif connectivity in ('MOTIF', 'LEAF'):
+                    if pNN is not None and (orientation=='north' 
+                            or (connectivity=='MOTIF' and
+                            orientation=='east')):
+                        pInterp = 2*pN-pNN
+                    elif pWW is not None and (orientation=='west' 
+                            or (connectivity=='MOTIF' and 
+                            orientation=='north')):
+                        pInterp = 2*pW-pWW
+                    elif pSS is not None and (orientation=='south' 
+                            or (connectivity=='MOTIF' and 
+                            orientation=='west')):
+                        pInterp = 2*pS-pSS
+                    elif pEE is not None and (orientation=='east' 
+                            or (connectivity=='MOTIF' and 
+                            orientation=='south')):
+                        pInterp = 2*pE-pEE
+                    else:
                         continue
 
-                    connectivity, orientation = (self.
-                        get_local_connectivity_2d( (i,j) ))
-
-                    pN = self.get_3d_point( (i, j+1) ) 
-                    pE = self.get_3d_point( (i+1, j) )
-                    pS = self.get_3d_point( (i, j-1) )
-                    pW = self.get_3d_point( (i-1, j) )
-
-                    pNN = self.get_3d_point( (i, j+2) )
-                    pEE = self.get_3d_point( (i+2, j) )
-                    pSS = self.get_3d_point( (i, j-2) )
-                    pWW = self.get_3d_point( (i-2, j) )
-
-                    if connectivity == 'FULL':
-                        pInterp = (pN+pE+pS+pW)/4
-
-                    elif connectivity=='TSHAPE':
-                        if orientation in ('north','south'):
-                            pInterp = (pE+pW)/2
-                        else:
-                            pInterp = (pN+pS)/2
-
-                    elif connectivity=='LINE':
-                        if orientation in ('north','south'):
-                            pInterp = (pN+pS)/2
-                        else:
-                            pInterp = (pE+pW)/2
-
-                    elif connectivity in ('MOTIF', 'LEAF'):
-                        if pNN is not None and (orientation=='north' 
-                                or (connectivity=='MOTIF' and
-                                orientation=='east')):
-                            pInterp = 2*pN-pNN
-                        elif pWW is not None and (orientation=='west' 
-                                or (connectivity=='MOTIF' and 
-                                orientation=='north')):
-                            pInterp = 2*pW-pWW
-                        elif pSS is not None and (orientation=='south' 
-                                or (connectivity=='MOTIF' and 
-                                orientation=='west')):
-                            pInterp = 2*pS-pSS
-                        elif pEE is not None and (orientation=='east' 
-                                or (connectivity=='MOTIF' and 
-                                orientation=='south')):
-                            pInterp = 2*pE-pEE
-                        else:
-                            continue
-
-                    # if we found a singleton it means not enough of the other 
-                    # points have been interpolated yet
-                    # we pass and wait
-                    elif connectivity == 'SINGLETON':
-                        pInterp = None
-                        continue
+                # if we found a singleton it means not enough of the other 
+                # points have been interpolated yet
+                # we pass and wait
+                elif connectivity == 'SINGLETON':
+                    pInterp = None
+                    continue
+                
+                if pInterp is None:
+                    raise ValueError('Could not interpolate point with ' 
+                        'current methods')
+                elif self.get_3d_point((i,j)) is not None:
+                    # in case the nonexistent point was added in a 
+                    # previous iteration dont add it again
+                    #if GridPoint(pInterp) in interpolated_gridpoints:
+                    #    continue
+                    # greedily growing the grid here might cause bias. but 
+                    # check for bugs adding the same point multiple times
+                    if (i,j) in interpolated_gridpoints:
+                        raise ValueError("Internal error: should never be" 
+                            "adding a point that already exists")
                     
-                    if pInterp is None:
-                        raise ValueError('Could not interpolate point with ' 
-                            'current methods')
-                    elif self.get_3d_point((i,j)) is not None:
-                        # in case the nonexistent point was added in a 
-                        # previous iteration dont add it again
-                        #if GridPoint(pInterp) in interpolated_gridpoints:
-                        #    continue
-                        # greedily growing the grid here might cause bias. but 
-                        # check for bugs adding the same point multiple times
-                        if (i,j) in interpolated_gridpoints:
-                            raise ValueError("Internal error: should never be" 
-                                "adding a point that already exists")
-                        
-                        #otherwise, we added this point on another strip 
-                        #choice. We should add it to the interpolated
-                        #points  as normally, but not add the point to the Grid
+                    #otherwise, we added this point on another strip 
+                    #choice. We should add it to the interpolated
+                    #points  as normally, but not add the point to the Grid
 
-                    else:
-                        print 'adding the point (%i,%i), %s'%(i,j,str(pInterp))
-                        self.add_point(pInterp, (i,j)) 
-                        if graph[i,j] == 0:
-                            graph[i,j] = 1
-                        #total_points += 1
+                else:
+                    print 'adding the point (%i,%i), %s'%(i,j,str(pInterp))
+                    self.add_point(pInterp, (i,j)) 
+                    if graph[i,j] == 0:
+                        graph[i,j] = 1
+                    #total_points += 1
 
-                    interpolated_points.append(pInterp) 
-                    #interpolated_gridpoints.append(GridPoint(pInterp))
-                    interpolated_gridpoints.append((i,j))
+                interpolated_points.append(pInterp) 
+                #interpolated_gridpoints.append(GridPoint(pInterp))
+                interpolated_gridpoints.append((i,j))
 
-                    points_left = rm_pts(cur_points, self.all_elecs)
-                    
-                    if len(points_left) > 0:
-                        pPenalty, _ = find_nearest_pt(pInterp, 
-                            rm_pts(cur_points, self.all_elecs))
-                        cur_penalty += np.min((norm(pPenalty-pInterp), 
-                            2*self.delta*critdist))
-                    else:
-                        cur_penalty = np.inf
+        return cur_points, interpolated_points
 
-            #update the winner
-            if cur_penalty < best_penalty:
-                best_penalty = cur_penalty
-                best_points = cur_points
-                best_points.extend(interpolated_points)
-                best_loc = (r,c,orient)
-            
-        return best_loc, best_points 
+    def strip_penalties(self, strips, critdist):
+        '''
+        given a list of strips, as their existing points and their
+        interpolated points, compute the penalty of each strip. this is the
+        sum over its interpolated points of the distance to the nearest
+        electrode that is not an existing point of the strip, with each
+        distance capped at 2*delta*critdist.
+
+        the nearest electrodes to the interpolated points of all of the
+        strips are found with a single query of the spatial index
+        '''
+        n = len(self._elecs)
+        penalties = np.zeros(len(strips))
+
+        owner = np.array([s for s, (_, interpolated_points) in 
+            enumerate(strips) for _ in interpolated_points], dtype=int)
+        if len(owner) == 0:
+            return penalties
+        if n == 0:
+            penalties[owner] = np.inf
+            return penalties
+
+        query = np.reshape([p for _, interpolated_points in strips 
+            for p in interpolated_points], (-1,3))
+
+        #the electrodes at the existing points of each strip, encoded with
+        #the index of the strip
+        excluded = []
+        for s, (cur_points, _) in enumerate(strips):
+            for p in cur_points:
+                try:
+                    excluded.append(s*n + self._index[tuple(p)][0])
+                except (KeyError, TypeError):
+                    pass
+
+        #with at most k-1 excluded electrodes per strip, the nearest
+        #electrode that is not excluded is among the k nearest, if any
+        k = min(n, max(len(cur_points) for cur_points, _ in strips) + 1)
+        _, ix = self._tree.query(query, k)
+        ix = np.reshape(ix, (len(query), k))
+        avail = np.reshape(np.in1d(owner[:, np.newaxis]*n + ix, excluded,
+            invert=True), ix.shape)
+
+        rows = np.arange(len(query))
+        first = np.argmax(avail, axis=1)
+        pPenalty = self._elecs[ix[rows, first]]
+        d = np.minimum(np.sqrt(np.sum((pPenalty - query)**2, axis=1)),
+            2*self.delta*critdist)
+        d[~avail[rows, first]] = np.inf
+
+        #add up the distances of each strip in order
+        np.add.at(penalties, owner, d)
+        return penalties
 
     def matches_strip_geometry(self, M, N, graph):
         #graph = self.repr_as_2d_graph(pad_zeros = max(M,N))
 
-        best_locs = []
-        best_fit = -1
-
         #If the orientation is 'horiz', then the row dimension corresponds to N.
         #if is 'vert', the row dimension corresponds to M
-        for orient in ('horiz', 'vert'):
-            for r in xrange(graph.shape[int(orient=='vert')]-N+1):
-                for c in xrange(graph.shape[int(orient=='horiz')]-M+1):
-                    cur_loc = (r, c, orient)
-                    subgraph = (graph[r:r+N, c:c+M] if orient=='horiz' 
-                        else graph[c:c+M, r:r+N])
-
-                    #if the control points are not present, reject this choice 
-                    #of strip immediately
-                    #this causes problems
-                    #if (2 not in subgraph or 3 not in subgraph or 
-                    #        4 not in subgraph):
-                    #    continue
+        #the binary fit of connectivity of every choice of strip is counted
+        #at once from the summed area table of the graph, indexed by (r, c)
+        fits = {'horiz' : window_sums(graph, N, M),
+                'vert' : window_sums(graph, M, N).T}
 
-                    #calculate the binary fit of connectivity in this choice
-                    cur_fit = np.sum(binarize(subgraph))
+        best_fit = max([fits[orient].max() for orient in fits
+            if fits[orient].size > 0] or [-1])
 
-                    if cur_fit > best_fit:
-                        best_fit = cur_fit
-                        best_locs = [cur_loc]
-                    elif cur_fit == best_fit:
-                        best_locs.append(cur_loc)
+        best_locs = []
+        for orient in ('horiz', 'vert'):
+            for r, c in zip(*np.where(fits[orient] == best_fit)):
+                best_locs.append((int(r), int(c), orient))
 
         if best_fit < M*N*self.critical_percentage:
             return False, None, best_fit
@@ -988,46 +1138,32 @@ class Grid():
 def find_init_angles(all_elecs, mindist=10, maxdist=25):
     ''' Takes the set of all electrodes and some constraint parameters.
         Returns angle for each electrode's best match as Nx1 vector'''
-    n = all_elecs.shape[0]
-    angles = np.zeros(n)
-    dists = np.zeros((n,2))
-    actual_points = np.zeros((n,3,3))
-
-    for k in xrange(n):
-        p0 = all_elecs[k,:]
-        p1, p2 = find_neighbors(p0, all_elecs, 2)
-
-        if ((mindist < norm(p1-p0) < maxdist) and (mindist 
-                < norm(p2-p0) < maxdist)):
-            angles[k] = angle(p1-p0, p2-p0)
-            dists[k] = norm(p1-p0), norm(p2-p0)
-            actual_points[k] = (p0,p1,p2)
-        else:
-            angles[k] = np.inf
-            dists[k] = (np.inf, np.inf)
-            actual_points[k] = (p0,p1,p2)
+    all_elecs = np.asarray(all_elecs, dtype=float)
+    p1, p2 = nearest_two_neighbors(all_elecs)
+    angles, d1, d2 = corner_angles(all_elecs, p1, p2)
+
+    fits = ((mindist < d1) & (d1 < maxdist) & (mindist < d2) &
+        (d2 < maxdist))
+    angles[~fits] = np.inf
+    dists = np.where(fits[:, np.newaxis], np.transpose((d1, d2)), np.inf)
+    actual_points = np.stack((all_elecs, p1, p2), axis=1)
 
     return angles, dists, actual_points
 
 def find_init_pts(init_coords, dist=25, min_angle=10):
-    n_p = init_coords.shape[0]    
-    As = np.zeros(n_p)
-    for k in range(n_p):
-        p0 = init_coords[k, :]
-        p1, p2 = find_neighbors(p0, init_coords, 2)
-        
-        if (norm(p1 - p0) < dist) and (norm(p2 - p0) < dist):
-            As[k] = angle(p1 - p0, p2 - p0)
-        elif (sum(p1 == p0) == 3) or (sum(p2 == p0) == 3):
-            As[k] = 400             
-        else:
-            As[k] = 500
+    init_coords = np.asarray(init_coords, dtype=float)
+    p1, p2 = nearest_two_neighbors(init_coords)
+    As, d1, d2 = corner_angles(init_coords, p1, p2)
+
+    coincident = (np.all(p1 == init_coords, axis=1) | 
+        np.all(p2 == init_coords, axis=1))
+    As = np.where((d1 < dist) & (d2 < dist), As,
+        np.where(coincident, 400, 500))
 
     As[np.where(np.isnan(As))]=np.inf
     
     if np.abs(As - 90).min() < min_angle:
-        p0 = init_coords[np.abs(As - 90).argmin(), :]
-        p1, p2 = find_neighbors(p0, init_coords, 2)
-        return [p0, p1, p2]
+        k = np.abs(As - 90).argmin()
+        return [init_coords[k, :], p1[k], p2[k]]
     else:
         return -1
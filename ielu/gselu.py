@@ -1,6 +1,7 @@
 from __future__ import division
 import os
 import sys
+import threading
 import numpy as np
 from mayavi.core.ui.api import MayaviScene, SceneEditor, MlabSceneModel
 from traits.api import (Bool, Button, cached_property, File, HasTraits,
@@ -9,9 +10,10 @@ from traits.api import (Bool, Button, cached_property, File, HasTraits,
     Color)
 from traitsui.api import (View, Item, Group, OKCancelButtons, ShellEditor,
     HGroup, VGroup, InstanceEditor, TextEditor, ListEditor, CSVListEditor,
-    Handler, Label, OKCancelButtons, VSplit)
+    Handler, Label, OKCancelButtons, VSplit, RangeEditor)
 from traitsui.message import error as error_dialog
 from traitsui.api import MenuBar, Menu, Action
+from pyface.api import GUI
 
 from custom_list_editor import CustomListEditor
 
@@ -134,7 +136,27 @@ class ElectrodePositionsModel(HasPrivateTraits):
     ct_registration = File
 
     ct_threshold = Float(2500.)
+    use_hysteresis = Bool(False)
+    ct_low_threshold = Float(1500.)
     dilation_iterations = Int(25)
+    low_memory_extraction = Bool(False)
+    ct_slab_size = Int(32)
+    extraction_workers = Int(1)
+    cache_extraction = Bool(True)
+    split_merged_contacts = Bool(False)
+    contact_volume = Float(0.) # mm^3, estimated from the CT if 0
+    suppress_streaks = Bool(False)
+    streak_length = Float(10.) # mm
+    detect_depth_leads = Bool(False)
+    depth_min_pitch = Float(2.) # mm
+    depth_max_pitch = Float(6.) # mm
+    crop_ct_to_brain = Bool(False)
+    crop_margin = Float(10.)
+    _component_tree = Any(transient=True) # extraction.ComponentTree
+    _building_component_tree = Bool(False, transient=True)
+    suggested_threshold = Float(transient=True)
+    _ct_histogram = Any(transient=True) # extraction.IntensityHistogram
+    _label_map = Any(transient=True) # extraction.LabelMap
 
     critical_percentage = Range(0., 1., 0.75)
 
@@ -143,6 +165,9 @@ class ElectrodePositionsModel(HasPrivateTraits):
     rho = Float(35.)
     rho_strict = Float(20.)
     rho_loose = Float(50.)
+    classification_workers = Int(1)
+    search_grid_assignment = Bool(False)
+    assignment_search_time = Float(30.) # s
 
     delta_recon = Float(0.65)
     epsilon_recon = Float(10.)
@@ -152,6 +177,7 @@ class ElectrodePositionsModel(HasPrivateTraits):
 
     isotropize = Enum('By header', 'By voxel', 'Manual override',
         'Isotropization off')
+    isotropization_method = Enum('resample', 'analytic')
 
     #this was previously marked as transient which caused a problem with
     #adding new points after load. is there a reason it needs to be transient?
@@ -179,6 +205,8 @@ class ElectrodePositionsModel(HasPrivateTraits):
     
     panel2d = Instance(HasTraits, transient=True)
     _cursor_tracker = Instance(Electrode, transient=True)
+    _threshold_preview = List(Instance(Electrode), transient=True)
+    _threshold_preview_event = Event
     
 
     #do special operations on old pickle types
@@ -434,6 +462,7 @@ class ElectrodePositionsModel(HasPrivateTraits):
         self._snapping_completed = False
         self._noise_hidden = False
         self._visualization_ready = False
+        self.preview_threshold(None)
 
         #pipeline
         import pipeline as pipe
@@ -450,11 +479,39 @@ class ElectrodePositionsModel(HasPrivateTraits):
             self.ct_scan, subjects_dir=self.subjects_dir, 
             subject=self.subject)
 
-        self._electrodes = pipe.identify_electrodes_in_ctspace(
+        #I considered allowing the user to manually specify a different
+        #registration but we don't currently do this
+        aff = self.acquire_affine()
+
+        if self.crop_ct_to_brain:
+            bounding_box = pipe.get_brain_bounding_box_in_ctspace(
+                self.ct_scan, aff, margin=self.crop_margin,
+                subjects_dir=self.subjects_dir, subject=self.subject)
+        else:
+            bounding_box = None
+
+        self._electrodes, self._label_map = (
+            pipe.identify_electrodes_in_ctspace(
             self.ct_scan, mask=ct_mask, threshold=self.ct_threshold,
             use_erosion=(not self.disable_erosion),
             isotropization_type=self.isotropize,
-            iso_vector_override=self.isotropization_override) 
+            iso_vector_override=self.isotropization_override,
+            slab_size=(self.ct_slab_size if self.low_memory_extraction
+                else None),
+            isotropization_method=self.isotropization_method,
+            bounding_box=bounding_box,
+            nr_workers=(1 if self.low_memory_extraction or
+                self.suppress_streaks else self.extraction_workers),
+            cache_dir=(os.path.join(self.subjects_dir, self.subject, 'mri')
+                if self.cache_extraction else None),
+            contact_volume=(None if not self.split_merged_contacts
+                else 'auto' if self.contact_volume <= 0
+                else self.contact_volume),
+            streak_length=(self.streak_length if self.suppress_streaks and
+                not self.low_memory_extraction else None),
+            return_label_map=True,
+            low_threshold=(self.ct_low_threshold if self.use_hysteresis
+                else None)))
 
         pipe.linearly_transform_electrodes_to_isotropic_coordinate_space(
             self._electrodes, self.ct_scan, 
@@ -465,10 +522,6 @@ class ElectrodePositionsModel(HasPrivateTraits):
 
         self._electrodes = np.unique(self._electrodes).tolist()
 
-        #I considered allowing the user to manually specify a different
-        #registration but we don't currently do this
-        aff = self.acquire_affine()
-
         pipe.create_dural_surface(subjects_dir=self.subjects_dir, 
             subject=self.subject)
 
@@ -491,23 +544,52 @@ class ElectrodePositionsModel(HasPrivateTraits):
             for e in removals:
                 self._electrodes.remove(e)
 
+        #find the depth leads first, so that grid fitting only sees the
+        #remaining electrodes
+        if self.detect_depth_leads:
+            depth_leads = pipe.identify_depth_leads(self._electrodes,
+                self.ct_scan, isotropization_type=self.isotropize,
+                iso_vector_override=self.isotropization_override,
+                min_pitch=self.depth_min_pitch,
+                max_pitch=self.depth_max_pitch)
+        else:
+            depth_leads = []
+
+        on_leads = set(id(e) for lead in depth_leads for e in lead)
+        grid_candidates = [e for e in self._electrodes
+            if id(e) not in on_leads]
+
         #initial sorting
         #self._grids, self._colors = pipe.classify_electrodes(
         try:
             self._colors, self._grid_geom, self._grids, self._color_scheme = (
-                pipe.classify_electrodes(self._electrodes,
+                pipe.classify_electrodes(grid_candidates,
                                          self.electrode_geometry,
                                          delta = self.delta,
                                          epsilon = self.epsilon,
                                          rho = self.rho,
                                          rho_strict = self.rho_strict,
                                          rho_loose = self.rho_loose,
-                                         crit_pct = self.critical_percentage
+                                         crit_pct = self.critical_percentage,
+                                         nr_workers = (1 if
+                                            self.search_grid_assignment else
+                                            self.classification_workers),
+                                         search_time = (
+                                            self.assignment_search_time if
+                                            self.search_grid_assignment
+                                            else None)
                                         ))
         except ValueError as e:
             error_dialog(str(e))
             raise
 
+        for lead in depth_leads:
+            name = 'depth%s'%gensym()
+            self._grid_geom[name] = (1, lead[-1].geom_coords[1] + 1)
+            self._colors[name] = self.get_next_color()
+            self._grid_types[name] = 'depth'
+            self._grids[name] = lead
+
         # add grid labels to electrodes
         for key in self._grids:
             for elec in self._grids[key]:
@@ -559,10 +641,10 @@ class ElectrodePositionsModel(HasPrivateTraits):
 
 
         #set the grid type to be subdural
-        #any depth grids will not have been created by now since they have
-        #a geometry
+        #the only depth grids created by now are the detected depth leads
         for key in self._grids:
-            self._grid_types[key] = 'subdural'
+            if key not in self._grid_types:
+                self._grid_types[key] = 'subdural'
 
         # store the unsorted points in a separate map for access
         for elec in self._electrodes:
@@ -615,6 +697,109 @@ class ElectrodePositionsModel(HasPrivateTraits):
         self._rebuild_vizpanel_event = True
         self._rebuild_guipanel_event = True
 
+    def build_component_tree(self):
+        #building the tree reads the entire CT image and can take seconds,
+        #so it is done in the background
+        if self._building_component_tree:
+            return
+        self._building_component_tree = True
+        thread = threading.Thread(target=self._compute_component_tree,
+            args=(self.ct_scan, not self.disable_erosion, self.ct_slab_size))
+        thread.daemon = True
+        thread.start()
+
+    def _compute_component_tree(self, ct, use_erosion, slab_size):
+        import pipeline as pipe
+        try:
+            tree = pipe.build_ct_component_tree(ct, use_erosion=use_erosion,
+                slab_size=slab_size)
+            error = None
+        except Exception as e:
+            tree, error = None, e
+        GUI.invoke_later(self._set_component_tree, ct, use_erosion, tree,
+            error)
+
+    def _set_component_tree(self, ct, use_erosion, tree, error):
+        self._building_component_tree = False
+        if error is not None:
+            error_dialog('Failed to build the threshold preview\n{0}'.format(
+                error))
+        #the CT image or erosion may have changed while the tree was built
+        elif ct == self.ct_scan and use_erosion == (not self.disable_erosion):
+            self._component_tree = tree
+
+    @on_trait_change('ct_scan, disable_erosion')
+    def _invalidate_component_tree(self):
+        self._component_tree = None
+        self.preview_threshold(None)
+
+    def preview_threshold(self, threshold):
+        '''
+        Show the electrodes that the component tree finds at the given
+        threshold in the CT viewer. If threshold is None, the preview is
+        removed.
+        '''
+        if threshold is None or self._component_tree is None:
+            self._threshold_preview = []
+            self._threshold_preview_event = True
+            return
+
+        import pipeline as pipe
+        elecs = [Electrode(ct_coords=c) for c in
+            self._component_tree.centroids(threshold)]
+        pipe.linearly_transform_electrodes_to_isotropic_coordinate_space(
+            elecs, self.ct_scan,
+            isotropization_direction_off = 'copy_to_iso',
+            isotropization_direction_on = 'isotropize',
+            isotropization_strategy = self.isotropize,
+            iso_vector_override = self.isotropization_override)
+
+        self._threshold_preview = elecs
+        self._threshold_preview_event = True
+
+    @on_trait_change('ct_scan')
+    def _invalidate_label_map(self):
+        self._label_map = None
+
+    def suggest_ct_threshold(self):
+        import pipeline as pipe
+        self.suggested_threshold, self._ct_histogram = (
+            pipe.suggest_ct_threshold(self.ct_scan, self.electrode_geometry,
+                use_erosion=(not self.disable_erosion),
+                slab_size=self.ct_slab_size, histogram=self._ct_histogram))
+
+    @on_trait_change('ct_scan, disable_erosion')
+    def _update_suggested_threshold(self, name, new):
+        self.suggested_threshold = 0.
+        #the histogram only depends on the CT image
+        if name != 'ct_scan':
+            return
+        self._ct_histogram = None
+
+        #the histogram pass reads the entire CT image, so it is done in the
+        #background. The component tree is only built by the suggest button
+        if os.path.isfile(self.ct_scan):
+            thread = threading.Thread(target=self._compute_ct_histogram,
+                args=(self.ct_scan, self.ct_slab_size))
+            thread.daemon = True
+            thread.start()
+
+    def _compute_ct_histogram(self, ct, slab_size):
+        import extraction as ext
+        try:
+            histogram = ext.histogram_by_slabs(nib.load(ct).dataobj,
+                slab_size=slab_size)
+        except Exception as e:
+            print 'Failed to compute the histogram of {0}'.format(ct)
+            print e
+            return
+        GUI.invoke_later(self._set_ct_histogram, ct, histogram)
+
+    def _set_ct_histogram(self, ct, histogram):
+        #the CT image may have changed while the histogram was computed
+        if ct == self.ct_scan:
+            self._ct_histogram = histogram
+
     def get_next_color(self):
         color = self._color_scheme.next()
         while color in self._colors:
@@ -974,6 +1159,10 @@ class ElectrodePositionsModel(HasPrivateTraits):
             aff = self.acquire_affine()
             import pipeline as pipe
 
+            #snap to the centroid of the contact that was clicked on
+            elec.ct_coords = pipe.locate_electrode_in_ctspace(self.ct_scan,
+                (px,py,pz), label_map=self._label_map)
+
             pipe.translate_electrodes_to_surface_space( [elec], aff,
                 subjects_dir=self.subjects_dir, subject=self.subject)
 
@@ -1160,12 +1349,17 @@ class ExtractionRegistrationSortingPanel(HasTraits):
     model = Instance(ElectrodePositionsModel)
 
     ct_threshold = DelegatesTo('model')
+    use_hysteresis = DelegatesTo('model')
+    ct_low_threshold = DelegatesTo('model')
     critical_percentage = DelegatesTo('model')
     delta = DelegatesTo('model')
     epsilon = DelegatesTo('model')
     rho = DelegatesTo('model')
     rho_loose = DelegatesTo('model')
     rho_strict = DelegatesTo('model')
+    classification_workers = DelegatesTo('model')
+    search_grid_assignment = DelegatesTo('model')
+    assignment_search_time = DelegatesTo('model')
     delta_recon = DelegatesTo('model')
     epsilon_recon = DelegatesTo('model')
     rho_recon = DelegatesTo('model')
@@ -1185,8 +1379,73 @@ class ExtractionRegistrationSortingPanel(HasTraits):
     shapereg_slice_diff = DelegatesTo('model')
     zoom_factor_override = DelegatesTo('model')
     dilation_iterations = DelegatesTo('model')
+    low_memory_extraction = DelegatesTo('model')
+    ct_slab_size = DelegatesTo('model')
+    extraction_workers = DelegatesTo('model')
+    cache_extraction = DelegatesTo('model')
+    split_merged_contacts = DelegatesTo('model')
+    detect_depth_leads = DelegatesTo('model')
+    depth_min_pitch = DelegatesTo('model')
+    depth_max_pitch = DelegatesTo('model')
+    contact_volume = DelegatesTo('model')
+    suppress_streaks = DelegatesTo('model')
+    streak_length = DelegatesTo('model')
+    crop_ct_to_brain = DelegatesTo('model')
+    crop_margin = DelegatesTo('model')
     isotropize = DelegatesTo('model')
     isotropization_override = DelegatesTo('model')
+    isotropization_method = DelegatesTo('model')
+
+    threshold_preview_button = Button('Build threshold preview')
+    suggested_threshold = DelegatesTo('model')
+    suggest_threshold_button = Button('Suggest')
+    use_suggested_threshold_button = Button('Use suggestion')
+    nr_clusters_at_threshold = Str('no preview')
+    _building_component_tree = DelegatesTo('model')
+    _preview_ready = Bool(False)
+    _preview_low = Float(1000.)
+    _preview_high = Float(5000.)
+
+    def __init__(self, **kwargs):
+        super(ExtractionRegistrationSortingPanel, self).__init__(**kwargs)
+        self._update_threshold_preview()
+
+    def _suggest_threshold_button_fired(self):
+        try:
+            self.model.suggest_ct_threshold()
+        except Exception as e:
+            error_dialog('Failed to suggest a threshold\n{0}'.format(e))
+
+    def _use_suggested_threshold_button_fired(self):
+        self.ct_threshold = self.suggested_threshold
+
+    def _threshold_preview_button_fired(self):
+        self.model.build_component_tree()
+        self._update_threshold_preview()
+
+    @on_trait_change('ct_threshold, model:_component_tree, '
+        'model:_building_component_tree')
+    def _update_threshold_preview(self):
+        tree = self.model._component_tree
+        self._preview_ready = (tree is not None and
+            not self._building_component_tree)
+        if self._building_component_tree:
+            self.nr_clusters_at_threshold = 'building preview'
+            return
+        if tree is None:
+            self.nr_clusters_at_threshold = 'no preview'
+            return
+
+        self._preview_low = float(tree.min_threshold)
+        if len(tree.levels) > 0:
+            self._preview_high = float(tree.levels[0])
+
+        if self.ct_threshold < tree.min_threshold:
+            self.nr_clusters_at_threshold = 'below preview range'
+            self.model.preview_threshold(None)
+        else:
+            self.nr_clusters_at_threshold = str(tree.count(self.ct_threshold))
+            self.model.preview_threshold(self.ct_threshold)
 
     traits_view = View(
         Group(
@@ -1195,6 +1454,29 @@ class ExtractionRegistrationSortingPanel(HasTraits):
             Label('The threshold above which electrode clusters will be\n'
                 'extracted from the CT image'),
             Item('ct_threshold'),
+            HGroup(
+                Item('suggested_threshold', style='readonly',
+                    label='suggested for the electrode geometry'),
+                Item('suggest_threshold_button', show_label=False),
+                Item('use_suggested_threshold_button', show_label=False),
+            ),
+            HGroup(
+                Item('threshold_preview_button', show_label=False,
+                    enabled_when='not _building_component_tree'),
+                Item('ct_threshold', editor=RangeEditor(
+                    low_name='_preview_low', high_name='_preview_high',
+                    mode='slider'), show_label=False,
+                    enabled_when='_preview_ready'),
+                Item('nr_clusters_at_threshold', style='readonly',
+                    label='clusters'),
+            ),
+            Label('Grow clusters above the threshold into connected voxels\n'
+                'above a lower threshold'),
+            HGroup(
+                Item('use_hysteresis', show_label=False),
+                Item('ct_low_threshold', show_label=True, label='low',
+                    enabled_when='use_hysteresis'),
+            ),
             Label('Weight given to the deformation term in the snapping\n'
                 'algorithm, reduce if snapping error is very high.'),
             Item('deformation_constant'),
@@ -1208,6 +1490,46 @@ class ExtractionRegistrationSortingPanel(HasTraits):
             Item('overwrite_xfms'),
             Label('Disable binary erosion procedure to reduce CT noise'),
             Item('disable_erosion'),
+            Label('Read the CT image in slabs to reduce memory use'),
+            HGroup(
+                Item('low_memory_extraction', show_label=False),
+                Item('ct_slab_size', show_label=True, label='slices',
+                    enabled_when='low_memory_extraction'),
+            ),
+            Label('Split fused neighboring contacts, by the volume of a '
+                'contact (0 to estimate)'),
+            HGroup(
+                Item('split_merged_contacts', show_label=False),
+                Item('contact_volume', show_label=True, label='mm^3',
+                    enabled_when='split_merged_contacts'),
+            ),
+            Label('Suppress metal streaks longer than'),
+            HGroup(
+                Item('suppress_streaks', show_label=False,
+                    enabled_when='not low_memory_extraction'),
+                Item('streak_length', show_label=True, label='mm',
+                    enabled_when='suppress_streaks'),
+            ),
+            Label('Detect depth leads, by the spacing of their contacts'),
+            HGroup(
+                Item('detect_depth_leads', show_label=False),
+                Item('depth_min_pitch', show_label=True, label='min (mm)',
+                    enabled_when='detect_depth_leads'),
+                Item('depth_max_pitch', show_label=True, label='max (mm)',
+                    enabled_when='detect_depth_leads'),
+            ),
+            Label('Reuse the last extraction if the CT and its settings '
+                'are unchanged'),
+            Item('cache_extraction', show_label=False),
+            Label('Number of processes to label the CT image with'),
+            Item('extraction_workers', show_label=False,
+                enabled_when='not low_memory_extraction'),
+            Label('Only extract electrodes near the brain'),
+            HGroup(
+                Item('crop_ct_to_brain', show_label=False),
+                Item('crop_margin', show_label=True, label='margin (mm)',
+                    enabled_when='crop_ct_to_brain'),
+            ),
             HGroup(
                 VGroup(
                 Label('Type of registration'),
@@ -1229,6 +1551,8 @@ class ExtractionRegistrationSortingPanel(HasTraits):
                 Item('isotropization_override', editor=CSVListEditor(),
                     enabled_when='isotropize==\'Manual override\'',
                     show_label=False),
+                Item('isotropization_method', show_label=False,
+                    enabled_when='isotropize!=\'Isotropization off\''),
             ),
         show_labels=False),
         VGroup(
@@ -1249,6 +1573,17 @@ class ExtractionRegistrationSortingPanel(HasTraits):
             Item('rho'),
             Item('rho_strict'),
             Item('rho_loose'),
+            Label('Number of processes to try grid initializations with'),
+            Item('classification_workers',
+                enabled_when='not search_grid_assignment'),
+            Label('Search other orders of the grids for the assignment\n'
+                'which places the most electrodes'),
+            HGroup(
+                Item('search_grid_assignment', show_label=False),
+                Item('assignment_search_time', show_label=True,
+                    label='time limit (s)',
+                    enabled_when='search_grid_assignment'),
+            ),
             Label('Simulated annealing parameters'),
             HGroup(
                 Item('sa_steps_break', label='steps before convergence'),
@@ -1315,6 +1650,7 @@ class SurfaceVisualizerPanel(HasTraits):
     _grid_types = DelegatesTo('model')
 
     _cursor_tracker = DelegatesTo('model')
+    _threshold_preview = DelegatesTo('model')
 
     visualize_in_ctspace = Bool(False)
     _viz_coordtype = Property#(depends_on='visualize_in_ctspace')
@@ -1332,6 +1668,7 @@ class SurfaceVisualizerPanel(HasTraits):
     brain = Any
     gs_glyphs = Dict
     tracking_glyph = Any
+    preview_glyph = Any
 
     _lh_pysurfer_offset = Float
     _rh_pysurfer_offset = Float
@@ -1365,6 +1702,7 @@ class SurfaceVisualizerPanel(HasTraits):
             #print self.model._cursor_tracker
             #print self._cursor_tracker
             self.show_grids_on_surface()
+        self.show_threshold_preview()
 
     def show_grids_on_surface(self):
 
@@ -1473,6 +1811,35 @@ class SurfaceVisualizerPanel(HasTraits):
         picker = self.scene.mayavi_scene.on_mouse_pick( self.selectnode_cb )
         picker.tolerance = .02
 
+    @on_trait_change('model:_threshold_preview_event')
+    def show_threshold_preview(self):
+        #the preview is in CT space, before there is any registration
+        if not self.visualize_in_ctspace or self.scene.mayavi_scene is None:
+            return
+
+        from mayavi import mlab
+
+        coords = np.array([elec.asiso() for elec in self._threshold_preview])
+
+        #the preview changes with every step of the threshold slider, so
+        #the glyph is updated in place instead of redrawing the scene
+        if len(coords) == 0:
+            if self.preview_glyph is not None:
+                self.preview_glyph.visible = False
+        elif self.preview_glyph is None:
+            #the grid colors only exist once the electrodes are classified,
+            #so the preview always has the color of the selection
+            self.preview_glyph = virtual_points3d(coords, scale_factor=3.,
+                name='threshold_preview', figure=self.scene.mayavi_scene,
+                color=(1, 1, 1))
+            self.preview_glyph.actor.actor.pickable = False
+        else:
+            self.preview_glyph.mlab_source.reset(x=coords[:,0],
+                y=coords[:,1], z=coords[:,2])
+            self.preview_glyph.visible = True
+
+        mlab.draw(figure=self.scene.mayavi_scene)
+
     def redraw_single_grid(self, key):
         #this function is never called
         #it is always easier to redraw everything, and avoids memory leaks
@@ -8,6 +8,7 @@ import numpy as np
 import nibabel as nib
 import geometry as geo
 import grid as gl
+import extraction as ext
 from utils import SortingLabelingError
 from electrode import Electrode
 from scipy.spatial.distance import cdist
@@ -84,8 +85,76 @@ def create_brainmask_in_ctspace(ct, subjects_dir=None, subject=None,
 
     return ct_brain
 
+def get_brain_bounding_box_in_ctspace(ct, ct2mr, margin=10,
+    subjects_dir=None, subject=None):
+    '''
+    Find the bounding box of the freesurfer brainmask, padded by a margin,
+    in the voxel space of the CT image. Thresholding and labeling the CT
+    inside this box is much cheaper than in the entire image, and excludes
+    most of the skull and the mandible.
+
+    Parameters
+    ----------
+    ct : str
+        The filename of the CT image to use
+    ct2mr : 4x4 np.ndarray
+        Matrix containing the ct2mr affine transformation
+    margin : float
+        The padding around the brain, in voxels of orig.mgz (which is 1 mm
+        in a conformed freesurfer volume). The default value is 10.
+    subjects_dir : Str | None
+        The freesurfer subjects_dir. If this is None, it is assumed to be the
+        $SUBJECTS_DIR environment variable.
+    subject : Str | None
+        The freesurfer subject. If this is None, it is assumed to be the
+        $SUBJECT environment variable.
+
+    Returns
+    -------
+    bounding_box : 3-tuple(2-tuple(int))
+        The box ((x0, x1), (y0, y1), (z0, z1)) in CT voxel space, with
+        exclusive upper bounds, clipped to the extent of the CT image
+    '''
+    if subjects_dir is None or subjects_dir=='':
+        subjects_dir = os.environ['SUBJECTS_DIR']
+    if subject is None or subject=='':
+        subject = os.environ['SUBJECT']
+
+    brain = os.path.join(subjects_dir, subject, 'mri', 'brain.mgz')
+    maskd = nib.load(brain).get_data()
+
+    lower = []
+    upper = []
+    for ax in xrange(3):
+        other_axes = tuple(i for i in xrange(3) if i != ax)
+        ix, = np.where(np.any(maskd, axis=other_axes))
+        lower.append(ix[0] - margin)
+        upper.append(ix[-1] + margin)
+
+    #the brainmask is in orig space, which is reached from CT space through
+    #the CT to rawavg registration and then rawavg to orig
+    nas2ras = get_rawavg_to_orig_xfm(subjects_dir=subjects_dir,
+        subject=subject)
+    orig2ct = np.linalg.inv(geo.concat_affines(ct2mr, nas2ras))
+
+    from itertools import product
+    corners = geo.apply_affine(list(product(*zip(lower, upper))), orig2ct)
+
+    ct_shape = nib.load(ct).shape[:3]
+    bounding_box = tuple(
+        (int(max(np.floor(lo), 0)), int(min(np.ceil(hi) + 1, n)))
+        for lo, hi, n in zip(np.min(corners, axis=0),
+                             np.max(corners, axis=0), ct_shape))
+
+    print 'brain bounding box in CT space is {0}'.format(bounding_box)
+    return bounding_box
+
 def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500, 
-    use_erosion=True, isotropization_type=None, iso_vector_override=None):
+    use_erosion=True, isotropization_type=None, iso_vector_override=None,
+    connectivity=26, labeling_engine='ndimage', slab_size=None,
+    return_features=False, isotropization_method='resample',
+    bounding_box=None, nr_workers=1, cache_dir=None, contact_volume=None,
+    streak_length=None, return_label_map=False, low_threshold=None):
     '''
     Given a CT image, identify the electrode locations in CT space.
     Includes locations of high image intensity that are not electrodes.
@@ -109,6 +178,15 @@ def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500,
         it is ok if parts of the skull, mandibles, and image artifacts outside
         the brain exceed this threshold. The default value is 2500 which
         should be appropriate for many CT images.
+    low_threshold : None | float
+        If given, the image is thresholded by hysteresis. Clusters are
+        grown from the voxels above threshold into the connected voxels
+        above low_threshold, which is implemented as a single labeling pass
+        above low_threshold that keeps only the clusters with a voxel above
+        threshold. This captures the dim edges of contacts, and dim
+        contacts that are only just above threshold at their peak, without
+        keeping parts of the skull that never reach threshold. Must be
+        lower than threshold. Not available with the bfs labeling engine.
     use_erosion : bool
         If true, before extracting electrodes, binary erosion is applied to 
         the image using a spherical kernel of radius 1. The default value is 
@@ -125,254 +203,760 @@ def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500,
         Manual override : Provide a manual zoom vector
     iso_vector_override : List(Float)
         User specifies in manual override isotropization setting.
+    isotropization_method : 'resample' | 'analytic'
+        resample : zoom the entire CT image to isotropic voxels before
+            thresholding. This is slow and multiplies the size of the image.
+        analytic : threshold and label the CT image in its own voxel space,
+            and scale only the centroids by the zoom vector. The erosion
+            kernel only erodes along axes where a voxel is less than two
+            isotropic voxels long, to match erosion in isotropic space.
+            Not available with the bfs labeling engine.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join suprathreshold voxels into
+        electrode clusters. 6 connects faces only, 18 also connects edges,
+        and 26 also connects corners. The default value is 26.
+    labeling_engine : 'ndimage' | 'bfs'
+        ndimage : label the clusters with vectorized array operations
+        bfs : use the original pure python breadth first search. This is
+            much slower and is only kept as a reference. It always uses
+            26-connectivity.
+    slab_size : None | int
+        If None, the entire CT image is loaded into memory. Otherwise, the
+        image is read through a memory map in slabs of this many axial
+        slices, which are thresholded, eroded and labeled one at a time.
+        Only the suprathreshold voxels are kept, about 20 bytes each, so
+        apart from them the memory use is bounded by the slab size rather
+        than the size of the image. This cannot be combined
+        with an isotropization that would resample the image, use the
+        analytic isotropization method instead.
+    nr_workers : int
+        If greater than 1, the image is split into this many axial slabs,
+        which are thresholded, eroded and labeled in parallel on a pool of
+        worker processes that share the image in memory. Components that
+        cross the slab seams are merged afterwards, so the result is
+        identical to labeling the image in one piece. Not available with
+        the bfs labeling engine or with slab streamed extraction.
+    contact_volume : None | float | 'auto'
+        If given, electrode clusters much larger than this volume in mm^3,
+        such as neighboring contacts on a depth electrode that have fused
+        together, are split into one cluster per contact by a watershed of
+        their distance transform. If 'auto', the volume of a contact is
+        estimated as the median size of the clusters, which assumes that
+        most contacts are not fused at this threshold. Not available with
+        the bfs labeling engine.
+    streak_length : None | float
+        If given, the streak artifacts of beam hardening around dense
+        grids are removed after thresholding. Every suprathreshold voxel on
+        a straight line of suprathreshold voxels in the axial plane at
+        least this long in mm is removed, which leaves the contacts, which
+        are shorter. This should be longer than a contact and shorter than
+        the streaks, typically 8 to 15 mm. Depth electrodes in the axial
+        plane with a suprathreshold shaft are removed as well. Not
+        available with slab streamed or parallel extraction.
+    cache_dir : None | Str
+        If given, the extraction result is cached in this directory, keyed
+        by a hash of the contents of the CT image and of every parameter
+        that changes the result. If the CT image and the parameters have
+        not changed since the last extraction, the cached result is loaded
+        instead of extracting the electrodes again. Usually this is the
+        mri directory of the subject.
+    bounding_box : None | 3-tuple(2-tuple(int))
+        If given, only threshold and label the subvolume of the CT image
+        ((x0, x1), (y0, y1), (z0, z1)) in voxel space, with exclusive
+        upper bounds, such as the box returned by
+        get_brain_bounding_box_in_ctspace. Coordinates are still returned
+        relative to the entire image.
+    return_features : bool
+        If true, also return a table of features of each component, which
+        can be used to filter out components that are not electrodes without
+        extracting them again. Not available with the bfs labeling engine.
+    return_label_map : bool
+        If true, also return the label map of the components, for looking
+        up which electrode a voxel belongs to. Not available with the bfs
+        labeling engine.
 
     Returns
     -------
     electrodes : List(Electrode)
         an list of Electrode objects with only the ct coords indicated.
+    features : np.ndarray with dtype extraction.component_dtype
+        One row per electrode, in the same order, with the voxel count,
+        summed and peak intensity, bounding box, centroid, principal axis
+        lengths and elongation of its component, measured in the voxel
+        space the image was labeled in. Only returned if return_features
+        is true.
+    label_map : None | extraction.LabelMap
+        The label of every voxel of the components, in the same order as
+        the electrodes, which resolves a voxel of the CT image to the
+        electrode it belongs to. Only built and returned if
+        return_label_map is true.
     '''
     print 'identifying electrode locations from CT image'
 
+    if return_features and labeling_engine == 'bfs':
+        raise ValueError('The bfs labeling engine does not calculate '
+            'component features')
+    if low_threshold is not None and labeling_engine == 'bfs':
+        raise ValueError('The bfs labeling engine does not support '
+            'hysteresis thresholding')
+    if low_threshold is not None and not low_threshold < threshold:
+        raise ValueError('The low threshold must be lower than the '
+            'threshold')
+    if return_label_map and labeling_engine == 'bfs':
+        raise ValueError('The bfs labeling engine does not keep a label '
+            'map')
+    if isotropization_method == 'analytic' and labeling_engine == 'bfs':
+        raise ValueError('The bfs labeling engine does not support analytic '
+            'isotropization')
+    if nr_workers > 1 and labeling_engine == 'bfs':
+        raise ValueError('The bfs labeling engine cannot label in parallel')
+    if nr_workers > 1 and slab_size is not None:
+        raise ValueError('Slab streamed extraction cannot label in parallel')
+    if contact_volume is not None and labeling_engine == 'bfs':
+        raise ValueError('The bfs labeling engine cannot split merged '
+            'contacts')
+    if streak_length is not None and (slab_size is not None or
+            nr_workers > 1):
+        raise ValueError('Streaks can only be suppressed when the entire '
+            'CT image is labeled in one process')
+
     from scipy import ndimage
-    import sys
+
+    #with hysteresis, the mask is thresholded at the low threshold and the
+    #threshold only selects the seeded components
+    if low_threshold is None:
+        mask_threshold, seed_threshold = threshold, None
+    else:
+        mask_threshold, seed_threshold = low_threshold, threshold
+
+    def get_centerofmass_by_slabs(cti, crop, structure=None,
+        split_volume=None, sampling=None):
+        if isotropization_method != 'analytic':
+            zf = get_isotropization_zoom_factor(cti, isotropization_type,
+                iso_vector_override)
+            if not np.all(zf == 1):
+                raise ValueError('Slab streamed extraction cannot resample '
+                    'the CT image, use analytic isotropization instead')
+
+        coords, values, labels, nr_components, mean, std = (
+            ext.label_by_slabs(cti.dataobj, mask_threshold,
+                use_erosion=use_erosion, slab_size=slab_size,
+                structure=structure, crop=crop, connectivity=connectivity))
+
+        print mean, 'CT MEAN'
+        print std, 'CT STDEV'
+        print threshold, 'COMPROMISE'
+        if low_threshold is not None:
+            print low_threshold, 'HYSTERESIS LOW THRESHOLD'
+
+        return ext.isolate_sparse_components(coords, values, labels,
+            nr_components, seed_threshold=seed_threshold,
+            contact_volume=split_volume, sampling=sampling,
+            return_features=True, return_label_map=return_label_map)
 
     def get_centerofmass(isotropize=None):
         cti = nib.load(ct)   
-        ctd = cti.get_data()
 
-        if isotropization_type == 'By voxel':
-            initial_shape = ctd.shape
-
-            max_axis = np.max(ctd.shape)
+        if bounding_box is None:
+            crop = tuple(slice(0, n) for n in cti.shape)
+        else:
+            crop = tuple(slice(int(lo), int(hi)) for lo, hi in bounding_box)
+            print 'CROPPED CT IMAGE TO {0}'.format(bounding_box)
+        offset = np.array([sl.start for sl in crop])
+
+        if isotropization_method == 'analytic':
+            zf = get_isotropization_zoom_factor(cti, isotropization_type,
+                iso_vector_override, resample=False)
+            structure = ext.anisotropic_erosion_structure(zf)
+        else:
+            zf = get_isotropization_zoom_factor(cti, isotropization_type,
+                iso_vector_override, resample=True)
+            structure = None
 
-            #WARNING: this is not the true isotropization
-            #factor. To get the true isotropization factor we would have to
-            #trust the image to tell us its correct slice thickness.
-            #But this is usually a good approximation of the shitty slice
-            #thickness scans we have been getting.
+        #the contact volume in voxels of the image that is labeled
+        if contact_volume is None or contact_volume == 'auto':
+            split_volume = contact_volume
+        else:
+            voxel_volume = np.prod(cti.get_header().get_zooms()[:3])
+            if isotropization_method != 'analytic':
+                voxel_volume /= np.prod(zf)
+            split_volume = contact_volume / voxel_volume
+        sampling = zf if isotropization_method == 'analytic' else None
+
+        #the size of a voxel in mm, in the image that is labeled
+        voxel_size = np.array(cti.get_header().get_zooms()[:3])
+        if isotropization_method != 'analytic':
+            voxel_size /= zf
+
+        #the label map box is as large as the extent of the components, so
+        #it is only built when it is requested
+        if slab_size is not None:
+            results = get_centerofmass_by_slabs(cti, crop,
+                structure=structure, split_volume=split_volume,
+                sampling=sampling)
+        else:
+            results = get_centerofmass_in_memory(cti, crop, zf,
+                resample=(isotropization_method != 'analytic'),
+                structure=structure, split_volume=split_volume,
+                sampling=sampling, voxel_size=voxel_size)
+        centroids, features = results[:2]
+        label_map = results[2] if return_label_map else None
+
+        if label_map is not None:
+            label_map.offset = offset
+            if isotropization_method != 'analytic':
+                label_map.zoom = zf
+
+        #the features are measured in the labeled image, which is resampled
+        #unless the isotropization is analytic
+        if isotropization_method == 'analytic':
+            shift = offset
+        else:
+            shift = offset * zf
+        if features is not None:
+            features['centroid'] += shift
+            features['bbox_min'] += ext.round_coords(shift).astype(np.int32)
+            features['bbox_max'] += ext.round_coords(shift).astype(np.int32)
+
+        if isotropization_method == 'analytic':
+            print 'SCALED CENTROIDS BY {0} INSTEAD OF RESAMPLING'.format(zf)
+            return (map(tuple, ext.round_coords(features['centroid'] * zf)),
+                features, label_map)
+
+        #resampling zooms the cropped image, the offset must be zoomed too
+        return (map(tuple, ext.round_coords(np.reshape(centroids, (-1, 3)) +
+            shift)), features, label_map)
+
+    def get_centerofmass_in_memory(cti, crop, zoom, resample=False,
+        structure=None, split_volume=None, sampling=None, voxel_size=None):
+        ctd = np.asarray(cti.dataobj[crop])
+
+        #the caller scales the centroids instead when not resampling. The
+        #zoom factor comes from the shape of the full image, a cropped image
+        #would be zoomed differently than the offset is
+        if resample and not np.all(zoom == 1):
+            initial_shape = ctd.shape
 
-            zf = np.array([max_axis, max_axis, max_axis]) // ctd.shape
             print 'DOING THE ISOTROPIC LINEARIZATION'
-            ctd = ndimage.interpolation.zoom(ctd, zf)
+            ctd = ndimage.interpolation.zoom(ctd, zoom)
             print 'FINISHED ISOTROPIC LINEARIZATION'
 
-            new_shape = ctd.shape
-
             print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(initial_shape,
-                new_shape)
+                ctd.shape)
 
-        elif isotropization_type == 'By header':
-            initial_shape = ctd.shape
+        elif resample and isotropization_type != 'Isotropization off':
+            print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
 
-            #these are the same thing
-            vox2ras = cti.get_affine()
-            #vox2ras = geo.get_vox2rasxfm(ct, stem='vox2ras')
+        #istropization done
 
-            #check orientation
-            rd, ad, sd = geo.get_std_orientation(vox2ras)
+        #np.std would make float64 copies of the entire image
+        mean, std = ext.intensity_statistics(ctd)
+        print mean, 'CT MEAN'
+        print std, 'CT STDEV'
 
-            vox2ras_rstd = np.array(
-                map( lambda ix: np.squeeze( vox2ras[ix, :3] ),
-                     (rd, ad, sd) ))
+        #threshold = np.mean(mask_test)+3*np.std(mask_test)
+        print threshold, 'COMPROMISE'
+        if low_threshold is not None:
+            print low_threshold, 'HYSTERESIS LOW THRESHOLD'
 
-            vox2ras_dg = np.abs(np.diag(vox2ras_rstd)[:3])
+        if nr_workers > 1:
+            return ext.isolate_components_in_parallel(ctd, mask_threshold,
+                use_erosion=use_erosion, structure=structure,
+                connectivity=connectivity, nr_workers=nr_workers,
+                seed_threshold=seed_threshold, contact_volume=split_volume,
+                sampling=sampling, return_features=True,
+                return_label_map=return_label_map)
 
-            min_axis = np.min( vox2ras_dg )
-            zf = vox2ras_dg / min_axis
+        #supthresh_locs = np.where(np.logical_and(ctd > threshold, maskd))
+        #keep the working arrays boolean, one byte per voxel, and never
+        #build a thresholded copy of the image
+        cte = ctd > mask_threshold
 
-            if np.all(zf == 1):
-                print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
-            else:
+        if streak_length is not None:
+            cte, nr_eliminated = ext.suppress_streaks(cte, streak_length,
+                sampling=voxel_size, connectivity=connectivity)
+            print 'STREAK SUPPRESSION ELIMINATED {0} COMPONENTS'.format(
+                nr_eliminated)
 
-                print 'DOING THE ISOTROPIC LINEARIZATION'
-                ctd = ndimage.interpolation.zoom(ctd, zf)
-                print 'FINISHED ISOTROPIC LINEARIZATION'
-                new_shape = ctd.shape
+        if use_erosion:
+            cte = ndimage.binary_erosion(cte, structure=structure)
+
+        if labeling_engine == 'bfs':
+            ctpp = np.zeros(ctd.shape)
+            np.copyto(ctpp, ctd, where=cte)
+            return ext.isolate_components_bfs(ctpp), None, None
+        elif labeling_engine == 'ndimage':
+            return ext.isolate_masked_components(cte, ctd,
+                connectivity=connectivity, seed_threshold=seed_threshold,
+                contact_volume=split_volume, sampling=sampling,
+                return_features=True, return_label_map=return_label_map)
+        else:
+            raise ValueError('Invalid labeling engine')
 
-                print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(
-                    initial_shape, new_shape)
+    if cache_dir is None:
+        cache_file = None
+    else:
+        cache_file = get_extraction_cache_file(ct, cache_dir,
+            threshold=threshold, use_erosion=use_erosion,
+            isotropization_type=isotropization_type,
+            iso_vector_override=iso_vector_override,
+            isotropization_method=isotropization_method,
+            connectivity=connectivity, labeling_engine=labeling_engine,
+            bounding_box=bounding_box, contact_volume=contact_volume,
+            streak_length=streak_length, low_threshold=low_threshold)
+
+    label_map = None
+    if cache_file is not None and os.path.exists(cache_file):
+        print 'LOADING CACHED EXTRACTION FROM {0}'.format(cache_file)
+        centroids, features, label_map = load_extraction_cache(cache_file)
+
+    #a cache saved without a label map is extracted again when one is
+    #requested, and then saved with it
+    if cache_file is None or not os.path.exists(cache_file) or (
+            return_label_map and label_map is None):
+        centroids, features, label_map = get_centerofmass(
+            isotropize=isotropization_type)
+        if cache_file is not None:
+            save_extraction_cache(cache_file, centroids, features,
+                label_map=label_map)
 
-        elif isotropization_type == 'Manual override':
-            initial_shape = ctd.shape
-            zf = np.array(iso_vector_override)
+    if isotropization_type!='Isotropization off':
+        ret_elecs = [Electrode(iso_coords=i) for i in centroids]
+    else:
+        ret_elecs = [Electrode(ct_coords=c) for c in centroids]
 
-            if np.all(zf == 1):
-                print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
-            else:
-                print 'DOING THE ISOTROPIC LINEARIZATION'
-                ctd = ndimage.interpolation.zoom(ctd, zf)
-                print 'FINISHED ISOTROPIC LINEARIZATION'
-                new_shape = ctd.shape
+    results = [ret_elecs]
+    if return_features:
+        results.append(features)
+    if return_label_map:
+        results.append(label_map)
 
-                print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(
-                    initial_shape, new_shape)
+    if len(results) == 1:
+        return ret_elecs
+    return tuple(results)
 
-        #istropization done
+def locate_electrode_in_ctspace(ct, point, label_map=None, radius=8):
+    '''
+    Resolve a point in CT voxel space, such as a click in the 2D panel, to
+    the intensity weighted centroid of the electrode under it.
 
-        print np.mean(ctd), 'CT MEAN'
-        print np.std(ctd), 'CT STDEV'
+    If the point is in a component of the label map, the centroid of that
+    component is looked up in constant time. Otherwise, a region is grown
+    around the point in a small window of the CT image, which finds
+    contacts that were not extracted, for instance because they are below
+    the threshold.
 
-        #threshold = np.mean(mask_test)+3*np.std(mask_test)
-        print threshold, 'COMPROMISE'
+    Parameters
+    ----------
+    ct : Str
+        The filename of the CT image
+    point : 3-tuple
+        The point in CT voxel space
+    label_map : None | extraction.LabelMap
+        The label map returned by identify_electrodes_in_ctspace. If None,
+        the region is always grown.
+    radius : int
+        The half width in voxels of the window the region is grown in
 
-        #supthresh_locs = np.where(np.logical_and(ctd > threshold, maskd))
-        supthresh_locs = np.where( ctd > threshold )
+    Returns
+    -------
+    centroid : 3-tuple
+        The centroid of the electrode in CT voxel space, or the point
+        itself if there is no electrode under it
+    '''
+    if label_map is not None:
+        index = label_map.lookup(point)
+        if index is not None:
+            return label_map.centroid(index)
+
+    centroid = ext.grow_region(nib.load(ct).dataobj, point, radius=radius)
+    if centroid is None:
+        return tuple(point)
+    return centroid
+
+def _identify_electrodes_worker(args):
+    ct, kwargs = args
+    electrodes, features = identify_electrodes_in_ctspace(ct,
+        return_features=True, **kwargs)
+    if kwargs['isotropization_type'] != 'Isotropization off':
+        return [e.iso_coords for e in electrodes], features
+    return [e.ct_coords for e in electrodes], features
+
+def identify_electrodes_in_multiple_cts(cts, affines=None,
+    isotropization_type='Isotropization off', iso_vector_override=None,
+    nr_workers=None, max_drift=5., **kwargs):
+    '''
+    Identify the electrodes in several CT images of the same subject, such
+    as post-operative scans from different sessions, in parallel, and match
+    the electrodes of each later session to the first one.
 
-        ecs = np.zeros(ctd.shape)
-        ecs[supthresh_locs]=1
+    Parameters
+    ----------
+    cts : List(str)
+        The filenames of the CT images, with the reference session first
+    affines : None | List(4x4 np.ndarray)
+        For each CT image, the transformation from its voxel space to a
+        space shared by all of the sessions, in mm. Usually this is the
+        registration of the CT image to the MR image, followed by the
+        vox2ras of the MR image. If None, the affine in the header of each
+        CT image is used, which only puts the sessions in the same space if
+        the scanner coordinates agree.
+    isotropization_type : 'Isotropization off' | 'By header' | 'By voxel'
+        | 'Manual override'
+        The isotropization, as in identify_electrodes_in_ctspace
+    iso_vector_override : None | 3-tuple
+        The zoom vector for the Manual override isotropization
+    nr_workers : None | int
+        The number of CT images to extract at once. If None, all of them
+        are extracted at once. Each worker process holds one CT image in
+        memory, unless slab streamed extraction is used.
+    max_drift : float
+        The largest distance in mm between the positions of an electrode in
+        two sessions. Electrodes farther apart than this are left unmatched.
+    kwargs : dict
+        Further parameters of identify_electrodes_in_ctspace, which are the
+        same for every CT image. Each CT image is labeled by a single
+        process, so nr_workers cannot be given. Each process fixes the
+        return values and extracts the features of its CT image, so
+        return_features, return_label_map and the bfs labeling engine
+        cannot be given either.
 
-        if use_erosion:
-            cte = ndimage.binary_erosion(ecs)
+    Returns
+    -------
+    electrodes : List(List(Electrode))
+        The electrodes found in each CT image, with ct and iso coords set
+    positions : List(Nx3 np.ndarray)
+        The positions of these electrodes in the shared space, in mm
+    matches : List(3-tuple(np.ndarray))
+        For each session after the first, the indices of the matched
+        electrodes of the first session, the indices of the electrodes they
+        are matched to in this session, and the drift of each matched
+        electrode in mm, as returned by geometry.match_nearest_neighbors
+    '''
+    if 'nr_workers' in kwargs:
+        raise ValueError('CT images in a batch cannot be labeled in '
+            'parallel, use the nr_workers of the batch instead')
+    for kwarg in ('return_features', 'return_label_map'):
+        if kwarg in kwargs:
+            raise ValueError('The return values of a batch are fixed, {0} '
+                'cannot be given'.format(kwarg))
+    if kwargs.get('labeling_engine') == 'bfs':
+        raise ValueError('CT images in a batch are extracted with their '
+            'features, which the bfs labeling engine does not support')
+
+    print 'identifying electrodes in {0} CT images'.format(len(cts))
+
+    #only the affines used for matching are read here, each worker loads
+    #its own CT image and the transformation of the centroids below
+    #reads the header of each CT image again
+    if affines is None:
+        affines = [nib.load(ct).get_affine() for ct in cts]
+
+    kwargs.update(isotropization_type=isotropization_type,
+        iso_vector_override=iso_vector_override)
+    jobs = [(ct, kwargs) for ct in cts]
+
+    if nr_workers is None:
+        nr_workers = len(cts)
+    nr_workers = max(1, min(nr_workers, len(cts)))
+
+    if nr_workers == 1:
+        results = map(_identify_electrodes_worker, jobs)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(nr_workers)
+        try:
+            results = pool.map(_identify_electrodes_worker, jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    electrodes = []
+    positions = []
+    for ct, aff, (centroids, _) in zip(cts, affines, results):
+        if isotropization_type != 'Isotropization off':
+            elecs = [Electrode(iso_coords=i) for i in centroids]
         else:
-            cte = ecs
-
-        ctpp = np.zeros(ctd.shape)
-        ctpp[np.where(cte)] = ctd[np.where(cte)]
-
-        class Component():
-            def __init__(self):
-                self.coor = []
-                self.intensity = []
-            def add(self, coor, intensity):
-                self.coor.append(coor)
-                self.intensity.append(intensity)
-            def center_of_mass(self):
-                M, Rx, Ry, Rz = 0,0,0,0
-                for r,m in zip(self.coor, self.intensity):
-                    M+=m
-                    Rx+=m*r[0]
-                    Ry+=m*r[1]
-                    Rz+=m*r[2]
-                return round(Rx/M), round(Ry/M), round(Rz/M)
-
-        #in principle it is possible to alter the algorithm by removing
-        #some of the subsequent categories of diagonals. in practice
-        #this makes very little difference compared to choosing an
-        #appropriate threshold and having good quality images
-        def iter_bfs(x,y,z,im,c):
-            from Queue import Queue
-            queue = Queue()
-
-            queue.put( (x,y,z) )
-
-            while not queue.empty():
-
-                cx, cy, cz = queue.get_nowait()
+            elecs = [Electrode(ct_coords=c) for c in centroids]
+        linearly_transform_electrodes_to_isotropic_coordinate_space(
+            elecs, ct, isotropization_direction_off='copy_to_iso',
+            isotropization_direction_on='deisotropize',
+            isotropization_strategy=isotropization_type,
+            iso_vector_override=iso_vector_override)
+
+        electrodes.append(elecs)
+        positions.append(np.reshape(geo.apply_affine(
+            [e.asct() for e in elecs], aff), (-1, 3)))
+
+    matches = []
+    for session, pos in enumerate(positions[1:], 1):
+        ref_ix, ix, drift = geo.match_nearest_neighbors(positions[0], pos,
+            max_distance=max_drift)
+        matches.append((ref_ix, ix, drift))
+
+        print ('SESSION {0}: {1} OF {2} ELECTRODES MATCHED, MEDIAN DRIFT '
+            '{3:.2f} MM'.format(session, len(ix), len(pos),
+            np.median(np.linalg.norm(drift, axis=1)) if len(ix) else 0))
+
+    return electrodes, positions, matches
+
+def get_extraction_cache_file(ct, cache_dir, **params):
+    '''
+    Get the name of the file that caches the extraction of electrodes from
+    a CT image with the given parameters.
 
-                try:
-                    if im[cx,cy,cz]==0:
-                        continue
-                except IndexError:
-                    continue
+    Parameters
+    ----------
+    ct : Str
+        The filename of the CT image
+    cache_dir : Str
+        The directory to keep the cache files in
+    params : dict
+        The extraction parameters that change the result. Parameters that
+        only change how the result is calculated, such as the slab size or
+        the number of workers, should not be given.
 
-                if cx < 0 or cy < 0:
-                    continue
-                
-                c.add((cx,cy,cz), im[cx,cy,cz])
-                im[cx,cy,cz]=0
-            
-                queue.put((cx-1, cy, cz))
-                queue.put((cx+1, cy, cz))
-                queue.put((cx, cy-1, cz))
-                queue.put((cx, cy+1, cz))
-                queue.put((cx, cy, cz-1))
-                queue.put((cx, cy, cz+1))
-
-                queue.put((cx-1, cy-1, cz))
-                queue.put((cx-1, cy+1, cz))
-                queue.put((cx-1, cy, cz-1))
-                queue.put((cx-1, cy, cz+1))
-                queue.put((cx+1, cy-1, cz))
-                queue.put((cx+1, cy+1, cz))
-                queue.put((cx+1, cy, cz-1))
-                queue.put((cx+1, cy, cz+1))
-                queue.put((cx, cy-1, cz-1))
-                queue.put((cx, cy-1, cz+1))
-                queue.put((cx, cy+1, cz-1))
-                queue.put((cx, cy+1, cz+1))
-                
-                queue.put((cx-1, cy-1, cz-1))
-                queue.put((cx-1, cy-1, cz+1))
-                queue.put((cx-1, cy+1, cz-1))
-                queue.put((cx-1, cy+1, cz+1))
-                queue.put((cx+1, cy-1, cz-1))
-                queue.put((cx+1, cy-1, cz+1))
-                queue.put((cx+1, cy+1, cz-1))
-                queue.put((cx+1, cy+1, cz+1))
-
-        #this recursive function occasionally caused memory problems
-        #it also caused stack size problems
-        def dfs(x,y,z,im,c):
-            try:
-                if im[x,y,z]==0:
-                    return
-            except IndexError:
-                return
-            if x<0 or y<0:
-                return 
-
-            c.add((x,y,z), im[x,y,z])
-            im[x,y,z]=0
-            dfs(x-1,y,z,im,c)
-            dfs(x+1,y,z,im,c)
-            dfs(x,y-1,z,im,c)
-            dfs(x,y+1,z,im,c)
-            dfs(x,y,z-1,im,c)
-            dfs(x,y,z+1,im,c)
-
-            dfs(x-1, y-1, z, im, c)
-            dfs(x-1, y+1, z, im, c)
-            dfs(x-1, y, z-1, im, c)
-            dfs(x-1, y, z+1, im, c)
-            dfs(x+1, y-1, z, im, c)
-            dfs(x+1, y+1, z, im, c)
-            dfs(x+1, y, z-1, im, c)
-            dfs(x+1, y, z+1, im, c)
-            dfs(x, y-1, z-1, im, c)
-            dfs(x, y-1, z+1, im, c)
-            dfs(x, y+1, z-1, im, c)
-            dfs(x, y+1, z+1, im, c)
-
-            dfs(x-1, y-1, z-1, im, c)
-            dfs(x-1, y-1, z+1, im, c)
-            dfs(x-1, y+1, z-1, im, c)
-            dfs(x-1, y+1, z+1, im, c)
-            dfs(x+1, y-1, z-1, im, c)
-            dfs(x+1, y-1, z+1, im, c)
-            dfs(x+1, y+1, z-1, im, c)
-            dfs(x+1, y+1, z+1, im, c)
-
-        def isolate_components(image):
-            im = image.copy()
-
-            clusters=[]
-            #print np.shape(im), 'gabif'
-            for x,y,z in zip(*np.where(im)):
-                if im[x,y,z]==0:
-                    continue
-                else:
-                    c = Component()
-                    clusters.append(c)
-                    iter_bfs(x,y,z,im,c) 
-                
-            return clusters
+    Returns
+    -------
+    cache_file : Str
+        The .npz file in cache_dir named after a hash of the contents of the
+        CT image and the parameters
+    '''
+    import hashlib
 
-        recursionlimit = sys.getrecursionlimit()
-        sys.setrecursionlimit(3000000)
+    sha = hashlib.sha1()
+    with open(ct, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(2**22), ''):
+            sha.update(chunk)
 
-        electrode_clusters = isolate_components(ctpp)
+    for name in sorted(params):
+        value = params[name]
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        sha.update('{0}={1!r};'.format(name, value))
 
-        sys.setrecursionlimit(recursionlimit)
+    return os.path.join(cache_dir,
+        'ct_extraction_{0}.npz'.format(sha.hexdigest()[:16]))
 
-        return [cluster.center_of_mass() for cluster in electrode_clusters]
+def save_extraction_cache(cache_file, centroids, features, label_map=None):
+    '''
+    Save the centroids, component features and label map returned by an
+    extraction to a compressed .npz file. The file is written under a
+    unique temporary name and then renamed, so an interrupted save never
+    leaves a partial cache and concurrent saves of the same cache file do
+    not write to the same temporary file.
+
+    The cache is only an optimization, so if it cannot be written, for
+    instance because the subject directory is read only, a warning is
+    printed and the extraction carries on.
+    '''
+    import tempfile
 
-    ret_elecs = []
-    if isotropization_type!='Isotropization off':
-        return [Electrode(iso_coords=i) for i in 
-            get_centerofmass(isotropize=isotropization_type)]
+    label_arrays = {}
+    if label_map is not None:
+        label_arrays = dict(label_box=label_map.box,
+            label_box_min=label_map.box_min,
+            label_centroids=label_map.centroids,
+            label_offset=label_map.offset, label_zoom=label_map.zoom)
+
+    tmp_file = None
+    try:
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp.npz',
+            prefix=os.path.basename(os.path.splitext(cache_file)[0]),
+            dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, 'wb') as fobj:
+            np.savez_compressed(fobj,
+                centroids=np.reshape(np.array(centroids, dtype=np.float64),
+                    (-1, 3)),
+                features=(np.zeros(0, dtype=ext.component_dtype)
+                    if features is None else features),
+                has_features=features is not None, **label_arrays)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        print 'WARNING: could not save the extraction cache {0}'.format(
+            cache_file)
+        print e
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def load_extraction_cache(cache_file):
+    '''
+    Load the centroids, component features and label map saved by
+    save_extraction_cache. The label map is None if it was not saved.
+    '''
+    with np.load(cache_file) as npz:
+        centroids = map(tuple, npz['centroids'])
+        features = npz['features'] if npz['has_features'] else None
+        if 'label_box' in npz.files:
+            label_map = ext.LabelMap(npz['label_box'], npz['label_box_min'],
+                npz['label_centroids'], offset=npz['label_offset'],
+                zoom=npz['label_zoom'])
+        else:
+            label_map = None
+    return centroids, features, label_map
+
+def build_ct_component_tree(ct, min_threshold=1000, use_erosion=True,
+    connectivity=26, slab_size=32):
+    '''
+    Build a component tree over the intensities of a CT image, which can
+    then report the electrode clusters found at any threshold above
+    min_threshold in milliseconds, without reloading or relabeling the CT.
+
+    The tree is built in the voxel space of the CT image, so its results
+    match identify_electrodes_in_ctspace with isotropization off.
+
+    Parameters
+    ----------
+    ct : str
+        The filename of the CT image to use
+    min_threshold : float
+        The lowest threshold the tree can be queried at. Lower values make
+        the tree larger and slower to build. The default value is 1000.
+    use_erosion : bool
+        If true, account for the binary erosion procedure as in
+        identify_electrodes_in_ctspace. The default value is true.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join suprathreshold voxels into
+        electrode clusters. The default value is 26.
+    slab_size : int
+        The number of axial slices to read into memory at a time
+
+    Returns
+    -------
+    tree : extraction.ComponentTree
+        The component tree. tree.count(T) returns the number of clusters at
+        threshold T, and tree.centroids(T) returns their centroids in CT
+        voxel space.
+    '''
+    print 'building component tree over CT intensities'
+
+    cti = nib.load(ct)
+    coords, values, levels = ext.levels_by_slabs(cti.dataobj, min_threshold,
+        use_erosion=use_erosion, slab_size=slab_size)
+
+    return ext.ComponentTree(coords, values, levels, cti.shape,
+        min_threshold, connectivity=connectivity)
+
+def suggest_ct_threshold(ct, electrode_geometry, use_erosion=True,
+    connectivity=26, slab_size=32, histogram=None, max_voxels=500000,
+    nr_candidates=64):
+    '''
+    Suggest a CT threshold from a streamed intensity histogram of the CT
+    image, at which the number of electrode clusters matches the number of
+    contacts in the electrode geometry.
+
+    The histogram gives the range of thresholds to search, from the
+    intensity with max_voxels voxels above it up to the typical intensity
+    of metal. A component tree over only the voxels in that range then
+    counts the clusters at each candidate threshold.
+
+    Parameters
+    ----------
+    ct : str
+        The filename of the CT image to use
+    electrode_geometry : List(2-tuple(int))
+        The dimensions of each grid or strip, as in the model
+    use_erosion : bool
+        If true, account for the binary erosion procedure as in
+        identify_electrodes_in_ctspace. The default value is true.
+    connectivity : 6 | 18 | 26
+        The voxel connectivity used to join suprathreshold voxels into
+        electrode clusters. The default value is 26.
+    slab_size : int
+        The number of axial slices to read into memory at a time
+    histogram : None | extraction.IntensityHistogram
+        The histogram of the CT image. If None, it is calculated.
+    max_voxels : int
+        The largest number of voxels to build the component tree over,
+        which bounds the lowest threshold that is considered
+    nr_candidates : int
+        The number of evenly spaced thresholds to consider
+
+    Returns
+    -------
+    threshold : float
+        The suggested threshold
+    histogram : extraction.IntensityHistogram
+        The histogram of the CT image, which can be reused
+    '''
+    print 'suggesting CT threshold'
+
+    cti = nib.load(ct)
+    if histogram is None:
+        histogram = ext.histogram_by_slabs(cti.dataobj, slab_size=slab_size)
+
+    nr_contacts = sum(nx * ny for nx, ny in electrode_geometry)
+
+    lo = histogram.intensity_above(max_voxels)
+    hi = histogram.metal_mode(histogram.percentile(99.9))
+    if hi is None or hi <= lo:
+        hi = histogram.edges()[-1]
+
+    print 'CT PERCENTILES 99 {0} 99.9 {1} 99.99 {2}'.format(
+        histogram.percentile(99), histogram.percentile(99.9),
+        histogram.percentile(99.99))
+    print 'METAL MODE {0}, SEARCHING THRESHOLDS {1} TO {2}'.format(
+        histogram.metal_mode(histogram.percentile(99.9)), lo, hi)
+
+    coords, values, levels = ext.levels_by_slabs(cti.dataobj, lo,
+        use_erosion=use_erosion, slab_size=slab_size)
+    tree = ext.ComponentTree(coords, values, levels, cti.shape, lo,
+        connectivity=connectivity)
+
+    threshold, counts = ext.suggest_threshold(tree, nr_contacts,
+        np.linspace(lo, hi, nr_candidates))
+    print 'SUGGESTED THRESHOLD {0} FOR {1} CONTACTS'.format(threshold,
+        nr_contacts)
+
+    return threshold, histogram
+
+def get_isotropization_zoom_factor(cti, isotropization_type,
+    iso_vector_override=None, resample=True):
+    '''
+    Calculate the zoom vector that identify_electrodes_in_ctspace uses to
+    isotropize the CT image.
+
+    Parameters
+    ----------
+    cti : nibabel image
+        The CT image
+    isotropization_type : str | None
+        The isotropization type, as in identify_electrodes_in_ctspace
+    iso_vector_override : List(Float)
+        User specifies in manual override isotropization setting.
+    resample : Bool
+        If true, return the zoom factor that the image is resampled with.
+        Otherwise, return the zoom factor that
+        linearly_transform_electrodes_to_isotropic_coordinate_space uses.
+        These only differ for 'By voxel', where the resampling zoom factor
+        is rounded down to an integer.
+
+    Returns
+    -------
+    zf : 3-element np.ndarray
+        The zoom factor for each axis. All ones if no isotropization is done.
+    '''
+    if isotropization_type == 'By voxel':
+        #WARNING: this is not the true isotropization
+        #factor. To get the true isotropization factor we would have to
+        #trust the image to tell us its correct slice thickness.
+        #But this is usually a good approximation of the shitty slice
+        #thickness scans we have been getting.
+        max_axis = np.max(cti.shape)
+        if resample:
+            return np.array([max_axis, max_axis, max_axis]) // cti.shape
+        return np.array([max_axis, max_axis, max_axis]) / cti.shape
+    elif isotropization_type == 'By header':
+        vox2ras = cti.get_affine()
+        vox2ras_rstd = np.array( map( lambda ix: vox2ras[ix, :3],
+                                      geo.get_std_orientation(vox2ras)))
+        vox2ras_dg = np.abs(np.diag(vox2ras_rstd)[:3])
+        return vox2ras_dg / np.min(vox2ras_dg)
+    elif isotropization_type == 'Manual override':
+        return np.array(iso_vector_override)
     else:
-        return [Electrode(ct_coords=c) for c in
-            get_centerofmass(isotropize=isotropization_type)]
+        return np.ones(3)
 
 def linearly_transform_electrodes_to_isotropic_coordinate_space(electrodes,
     ct, isotropization_direction_on=None,
@@ -497,9 +1081,157 @@ def identify_extracranial_electrodes_in_freesurfer_space(electrodes,
 
     return removals
 
+def _classify_initialization_worker(args):
+    p0, p1, p2, elecs, dims, name, grid_kwargs = args
+    pog = gl.Grid(p0, p1, p2, elecs, name=name, **grid_kwargs)
+    pog.extend_grid_arbitrarily()
+
+    try:
+        return pog.extract_strip(*dims)
+    except SortingLabelingError as e:
+        return None
+
+def _search_grid_assignment(electrode_arr, known_geometry, search_time,
+    epsilon=10, mindist=0, maxdist=36, **grid_kwargs):
+    '''
+    Search for the assignment of the electrodes to all of the geometries
+    which places the most electrodes, with branch and bound.
+
+    Each branch places one of the remaining geometries, in any order, with
+    one of the distinct strips that its initializations find on the
+    remaining electrodes, tried in the order of the initializations. The
+    first branch explored is therefore the greedy assignment. A branch is
+    cut when the geometries left could not place enough electrodes to beat
+    the best assignment, or when the same geometries are left with the same
+    electrodes as in a branch already explored. The extended grids and
+    extracted strips are cached by their initialization and the electrodes
+    remaining, and are shared between branches.
+
+    Returns the strip placed for each geometry, in the order of
+    known_geometry, as the result of Grid.extract_strip or None if no strip
+    was found, and the number of electrodes placed.
+    '''
+    import copy
+    import time
+
+    deadline = time.time() + search_time
+    index = geo.index_points(electrode_arr)
+    sizes = [np.prod(dims) for dims in known_geometry]
+
+    grids = {}
+    strips = {}
+
+    #the greedy assignment is always completed, even past the deadline
+    def out_of_time():
+        return best['assignment'] is not None and time.time() > deadline
+
+    def candidates(g, used):
+        dims = tuple(known_geometry[g])
+        new_elecs = electrode_arr[~used]
+        try:
+            angles, _, neighbs = gl.find_init_angles(new_elecs,
+                mindist=mindist, maxdist=maxdist)
+        except ValueError:
+            return
+
+        ranked = sorted(np.where(np.abs(90-angles)<epsilon)[0],
+            key=lambda k:np.abs(90-angles[k]))
+
+        found = set()
+        for k in ranked:
+            if out_of_time():
+                return
+
+            key = (neighbs[k].tobytes(), used.tobytes())
+            if (dims,) + key not in strips:
+                if key not in grids:
+                    pog = gl.Grid(neighbs[k][0], neighbs[k][1],
+                        neighbs[k][2], new_elecs, **grid_kwargs)
+                    pog.extend_grid_arbitrarily()
+                    grids[key] = pog
+
+                #extracting the strip interpolates points into the grid
+                pog = copy.deepcopy(grids[key])
+                try:
+                    result = pog.extract_strip(*dims)
+                    ix = [index[tuple(p)][0] for p in
+                        np.reshape(result[0], (-1,3)) if tuple(p) in index]
+                    strips[(dims,) + key] = result, ix
+                except SortingLabelingError as e:
+                    strips[(dims,) + key] = None
+
+            if strips[(dims,) + key] is None:
+                continue
+            result, ix = strips[(dims,) + key]
+            if frozenset(ix) not in found:
+                found.add(frozenset(ix))
+                yield result, ix
+
+    best = {'nr_placed' : -1, 'assignment' : None}
+    visited = set()
+
+    def search(remaining, used, assignment, width):
+        nr_placed = np.sum(used)
+        if len(remaining) == 0:
+            if nr_placed > best['nr_placed']:
+                best['nr_placed'] = nr_placed
+                best['assignment'] = dict(assignment)
+            return
+
+        if out_of_time():
+            return
+        if (nr_placed + min(np.sum(~used), sum(sizes[g] for g in remaining))
+                <= best['nr_placed']):
+            return
+
+        state = (tuple(sorted(tuple(known_geometry[g]) for g in remaining)),
+            used.tobytes())
+        if state in visited:
+            return
+        visited.add(state)
+
+        tried = set()
+        for g in remaining:
+            if tuple(known_geometry[g]) in tried:
+                continue
+            tried.add(tuple(known_geometry[g]))
+            rest = [h for h in remaining if h != g]
+
+            assignment[g] = None
+            for j, (result, ix) in enumerate(candidates(g, used)):
+                if j == width:
+                    best['truncated'] = True
+                    break
+                assignment[g] = result
+                new_used = used.copy()
+                new_used[ix] = True
+                search(rest, new_used, assignment, width)
+                if out_of_time():
+                    return
+            if assignment[g] is None:
+                search(rest, used, assignment, width)
+            del assignment[g]
+
+    #search with an increasing number of strips tried for each geometry, so
+    #that every order of the geometries is tried early
+    width = 1
+    best['truncated'] = True
+    while best['truncated'] and not out_of_time():
+        best['truncated'] = False
+        visited.clear()
+        search(range(len(known_geometry)), np.zeros(len(electrode_arr),
+            dtype=bool), {}, width)
+        width *= 2
+
+    print 'placed %i electrodes in the best assignment found' % (
+        best['nr_placed'])
+    return ([best['assignment'][g] for g in xrange(len(known_geometry))],
+        best['nr_placed'])
+
 def classify_electrodes(electrodes, known_geometry,
     delta=.35, rho=35, rho_strict=20, rho_loose=50, color_scheme=None,
-    epsilon=10, mindist=0, maxdist=36, crit_pct=.75):
+    epsilon=10, mindist=0, maxdist=36, crit_pct=.75, nr_workers=1,
+    search_time=None):
     '''
     Sort the given electrodes (generally in the space of the CT scan) into
     grids and strips matching the specified geometry.
@@ -557,6 +1289,24 @@ def classify_electrodes(electrodes, known_geometry,
     crit_pct : Float
         The critical percentage of electrodes to find before returning.
         Default value 0.75
+    nr_workers : int
+        The number of processes to try the initializations of each grid
+        with. The initializations are ranked by how close their angle is
+        to 90 degrees, and the first one in this order that fits the
+        geometry is accepted, as when they are tried one at a time, so the
+        result does not depend on the number of processes. The remaining
+        initializations are cancelled once it is found. The default value
+        is 1, which tries them one at a time in this process.
+    search_time : None | Float
+        If None, the geometries are placed greedily in the order given, each
+        with the first initialization that fits. Otherwise, the number of
+        seconds to search for the assignment of electrodes to all of the
+        geometries which places the most electrodes, exploring other orders
+        of the geometries and other initializations. The best assignment
+        found within this time is returned. It is never worse than the
+        greedy one, which is always found first. The grids are then named
+        in the order of known_geometry. This cannot be combined with
+        nr_workers.
 
     Returns
     -------
@@ -568,31 +1318,93 @@ def classify_electrodes(electrodes, known_geometry,
     '''
     from collections import OrderedDict    
 
+    if search_time is not None and nr_workers > 1:
+        raise ValueError('The assignment search cannot be run with more '
+            'than one worker')
+
     if color_scheme is None:
         from utils import get_default_color_scheme as color_scheme
 
-    def name_generator():
-        i=0
-        while True:
-            i+=1
-            yield 'grid%i'%i
-
     colors = color_scheme()
-    names = name_generator()
+    nr_names = 0
 
     #electrode_arr = map((lambda x:getattr(x, 'ct_coords')), electrodes)
-    electrode_arr = map((lambda x:getattr(x, 'iso_coords')), electrodes)
+    electrode_arr = np.reshape(map((lambda x:getattr(x, 'iso_coords')),
+        electrodes), (-1,3))
+
+    #look up electrodes by index rather than by comparing coordinates
+    electrode_index = geo.index_points(electrode_arr)
 
     found_grids = {}
     grid_colors = OrderedDict()
     grid_colors['unsorted'] = (1,0,0)
     grid_colors['selection'] = (1,1,1)
     grid_geom = {}
-    used_points = []
+    used = np.zeros(len(electrode_arr), dtype=bool)
+
+    def add_strip(name, dims, result):
+        sp, corners, final_connectivity = result
+        sp = np.reshape(sp, (-1,3))
+
+        found_grids[name] = []
+        grid_colors[name] = colors.next()
+        grid_geom[name] = dims
+        for p in sp:
+            #from PyQt4.QtCore import pyqtRemoveInputHook
+            #pyqtRemoveInputHook()
+            #import pdb
+            #pdb.set_trace()
+            ix = electrode_index.get(tuple(p))
+            if ix is not None:
+                if len(ix) > 1:
+                    print ix
+                    print p
+                    raise SortingLabelingError(
+                        "multiple electrodes at same point")
+                used[ix[0]] = True
+                elec = electrodes[ix[0]]
+                found_grids[name].append(elec)
+            else:
+                #elec = Electrode(ct_coords=tuple(p), 
+                #    is_interpolation=True)
+                elec = Electrode(iso_coords=tuple(p),
+                    is_interpolation=True)
+                found_grids[name].append(elec)
+
+            #add corner information
+            for corner in corners:
+                if np.all(corner==np.array(elec.asiso())):
+                    elec.corner = ['corner 1']
+
+            #add experimental full geometry information
+
+            try:
+                elec.geom_coords = list(final_connectivity[
+                    elec.asiso()])
+            except KeyError:
+                pass
+
+    if search_time is not None:
+        strips, _ = _search_grid_assignment(electrode_arr, known_geometry,
+            search_time, epsilon=epsilon, mindist=mindist, maxdist=maxdist,
+            delta=delta, rho=rho, rho_strict=rho_strict,
+            rho_loose=rho_loose, critical_percentage=crit_pct)
+
+        for j, (dims, result) in enumerate(zip(known_geometry, strips)):
+            name = 'grid%i'%(j+1)
+            if result is None:
+                print ('No suitable strip found. Returning an empty '
+                    'strip in its place')
+                found_grids[name] = []
+                grid_colors[name] = colors.next()
+                grid_geom[name] = dims
+            else:
+                add_strip(name, dims, result)
+
+        return grid_colors, grid_geom, found_grids, colors
 
     for dims in known_geometry:
-        new_elecs = geo.rm_pts(np.reshape(used_points, (-1,3)), 
-            np.array(electrode_arr))
+        new_elecs = electrode_arr[~used]
 
         #TODO mindist and maxdist settable parameters
         angles, _, neighbs = gl.find_init_angles(new_elecs, mindist=mindist, 
@@ -606,75 +1418,114 @@ def classify_electrodes(electrodes, known_geometry,
         elif len(ba)==0:
             raise SortingLabelingError("Could not find any good angles")
 
-        for j,k in enumerate(ba):
-            p0,p1,p2 = neighbs[k]
-            pog = gl.Grid(p0,p1,p2,new_elecs, delta=delta,
-                rho=rho, rho_strict=rho_strict, rho_loose=rho_loose,
-                name=names.next(), critical_percentage=crit_pct)
-            pog.extend_grid_arbitrarily()
+        #every initialization is a grid with its own name, whether or not
+        #it is accepted
+        grid_kwargs = dict(delta=delta, rho=rho, rho_strict=rho_strict,
+            rho_loose=rho_loose, critical_percentage=crit_pct)
+        names = ['grid%i'%(nr_names+j+1) for j in xrange(len(ba))]
+        jobs = [list(neighbs[k]) + [new_elecs, dims, name, grid_kwargs]
+            for k, name in zip(ba, names)]
+
+        #the results are consumed in order, so that the first initialization
+        #that fits is accepted whether or not they are tried in parallel
+        pool = None
+        if nr_workers > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(nr_workers, len(jobs)))
+            results = pool.imap(_classify_initialization_worker, jobs)
+        else:
+            from itertools import imap
+            results = imap(_classify_initialization_worker, jobs)
+
+        try:
+            for j, result in enumerate(results):
+                name = names[j]
+                nr_names += 1
+                if result is not None:
+                    break
 
-            try:
-                sp, corners, final_connectivity = pog.extract_strip(*dims)
-            except SortingLabelingError as e:
                 print 'Rejected this initialization'
                 if j==len(ba)-1:
                     print ('No suitable strip found. Returning an empty '
                         'strip in its place')
-                    found_grids[pog.name] = []
-                    grid_colors[pog.name] = colors.next()
-                    grid_geom[pog.name] = dims
-                continue
-
-            sp = np.reshape(sp, (-1,3))
-
-            found_grids[pog.name] = []
-            grid_colors[pog.name] = colors.next()
-            grid_geom[pog.name] = dims
-            for p in sp:
-                used_points.append(p)
-                #from PyQt4.QtCore import pyqtRemoveInputHook
-                #pyqtRemoveInputHook()
-                #import pdb
-                #pdb.set_trace()
-                if tuple(p.tolist()) in electrode_arr:
-                    ix, = np.where(np.logical_and(np.logical_and( 
-                        np.array(electrode_arr)[:,0]==p[0], 
-                        np.array(electrode_arr)[:,1]==p[1]),
-                        np.array(electrode_arr)[:,2]==p[2]))
-                    try:
-                        elec = electrodes[ix]
-                        found_grids[pog.name].append(elec)
-                    except (IndexError, TypeError) as e:
-                        print ix
-                        print p
-                        raise SortingLabelingError(
-                            "multiple electrodes at same point")
-                else:
-                    #elec = Electrode(ct_coords=tuple(p), 
-                    #    is_interpolation=True)
-                    elec = Electrode(iso_coords=tuple(p),
-                        is_interpolation=True)
-                    found_grids[pog.name].append(elec)
-
-                #add corner information
-                for corner in corners:
-                    if np.all(corner==np.array(elec.asiso())):
-                        elec.corner = ['corner 1']
-
-                #add experimental full geometry information
+                    found_grids[name] = []
+                    grid_colors[name] = colors.next()
+                    grid_geom[name] = dims
+        finally:
+            #cancel the initializations that are still being tried
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if result is None:
+            continue
 
-                try:
-                    elec.geom_coords = list(final_connectivity[
-                        elec.asiso()])
-                except KeyError:
-                    pass
-                    
-            break
+        add_strip(name, dims, result)
 
     #return found_grids, grid_colors
     return grid_colors, grid_geom, found_grids, colors
 
 
+def identify_depth_leads(electrodes, ct, isotropization_type=None,
+    iso_vector_override=None, min_pitch=2., max_pitch=6., min_contacts=4):
+    '''
+    Find the depth leads among the electrodes, as chains of collinear and
+    evenly spaced contacts, and order the contacts of each lead.
+
+    Parameters
+    ----------
+    electrodes : List(Electrode)
+        The electrodes, with their isotropic coordinates set
+    ct : Str
+        The filename of the CT image, whose header gives the voxel size
+    isotropization_type : None | 'By header' | 'By voxel' | 'Manual override'
+        The isotropization used to extract the electrodes
+    iso_vector_override : None | 3-tuple
+        The zoom vector for the Manual override isotropization
+    min_pitch, max_pitch : float
+        The range of distances between neighboring contacts on a lead, in
+        mm. The defaults of 2 and 6 mm cover sEEG leads but not subdural
+        grids and strips, which are usually spaced 10 mm apart.
+    min_contacts : int
+        The smallest number of contacts on a lead. The default value is 4.
+
+    Returns
+    -------
+    leads : List(List(Electrode))
+        The electrodes on each lead, ordered from the deepest contact. The
+        geom_coords of each electrode are set to [0, k] for the kth contact
+        position on the lead, following the 1xN convention of depth leads.
+    '''
+    import depth
+
+    print 'identifying depth leads'
+
+    if len(electrodes) < min_contacts:
+        return []
+
+    #the size of an isotropic voxel in mm, only approximate when the
+    #isotropization is off and the voxels are not isotropic
+    cti = nib.load(ct)
+    zf = get_isotropization_zoom_factor(cti, isotropization_type,
+        iso_vector_override, resample=False)
+    voxel_size = np.mean(np.array(cti.get_header().get_zooms()[:3]) / zf)
+
+    points = np.array([e.asiso() for e in electrodes])
+    shafts = depth.find_depth_shafts(points, min_pitch / voxel_size,
+        max_pitch / voxel_size, min_contacts=min_contacts)
+
+    leads = []
+    for indices, positions in shafts:
+        lead = []
+        for ix, pos in zip(indices, positions):
+            elec = electrodes[ix]
+            elec.geom_coords = [0, int(pos)]
+            lead.append(elec)
+        leads.append(lead)
+
+    print 'found %i depth leads' % len(leads)
+    return leads
+
 def remove_large_negative_values_from_ct(ct, subjects_dir=None,
     subject=None, threshold=-200):
     '''
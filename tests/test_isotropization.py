@@ -0,0 +1,60 @@
+'''
+Analytic isotropization scales the centroids found in the native voxel
+space of the CT image, instead of resampling the image before labeling it.
+On a synthetic CT image with thick slices, both methods should find the
+same contacts at nearly the same positions.
+'''
+from __future__ import division
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy.spatial.distance import cdist
+
+from ielu import pipeline as pipe
+
+ZOOMS = np.array([1., 1., 2.5])
+SHAPE = (60, 60, 24)
+RADIUS = 2.5 # mm
+
+#two layers of a 4x4 grid of contacts, in mm
+CONTACTS = [(x, y, z) for x in (15., 25., 35., 45.)
+    for y in (15., 25., 35., 45.) for z in (20., 35.)]
+
+def make_ct(filename):
+    rng = np.random.RandomState(0)
+    image = rng.normal(0, 20, SHAPE).astype(np.int16)
+
+    positions = np.indices(SHAPE).reshape(3, -1).T * ZOOMS
+    for contact in CONTACTS:
+        distance = np.linalg.norm(positions - contact, axis=1)
+        image[np.reshape(distance <= RADIUS, SHAPE)] = 3000
+
+    nib.save(nib.Nifti1Image(image, np.diag(list(ZOOMS) + [1])), filename)
+    return filename
+
+def extract(ct, method, use_erosion):
+    electrodes = pipe.identify_electrodes_in_ctspace(ct, threshold=1000,
+        use_erosion=use_erosion, isotropization_type='By header',
+        isotropization_method=method)
+    return np.array([elec.iso_coords for elec in electrodes])
+
+@pytest.mark.parametrize('use_erosion', [False, True])
+def test_analytic_isotropization_matches_resampling(tmpdir, use_erosion):
+    ct = make_ct(os.path.join(str(tmpdir), 'ct.nii'))
+
+    resampled = extract(ct, 'resample', use_erosion)
+    analytic = extract(ct, 'analytic', use_erosion)
+
+    assert len(resampled) == len(CONTACTS)
+    assert len(analytic) == len(CONTACTS)
+
+    #the isotropic space has the voxel size of the thinnest axis, 1 mm,
+    #and the two methods round the centroids on different grids
+    distance = cdist(resampled, analytic)
+    assert np.all(np.min(distance, axis=1) <= 1.)
+    assert np.all(np.min(distance, axis=0) <= 1.)
+
+    #both are at the true contact positions
+    for found in (resampled, analytic):
+        assert np.all(np.min(cdist(CONTACTS, found), axis=1) <= 1.5)